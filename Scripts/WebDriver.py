@@ -1,11 +1,22 @@
-import sys, os, tempfile, shutil, re, base64, binascii, time, bdmesg, downloader, plist, run, utils
+import sys, os, glob, tempfile, shutil, re, base64, binascii, time, pickle, json, hashlib, threading, argparse, bdmesg, blobstore, downloader, manifest, plist, run, utils
+try:
+    from Queue import Queue, Empty
+except:
+    from queue import Queue, Empty
+
+# Manifest checksum length -> hashlib algorithm
+HASHES = {32:"md5",40:"sha1",64:"sha256",128:"sha512"}
 
 class WebDriver:
 
-    def __init__(self):
+    def __init__(self, interactive = True, refresh = False):
 
+        self.u  = utils.Utils()
+        # Non-interactive runs (like --mirror) can happen on any OS and skip
+        # everything that needs a local web driver install
+        self.interactive = interactive
         # Check the OS first
-        if not str(sys.platform) == "darwin":
+        if interactive and not str(sys.platform) == "darwin":
             self.u.head("Incompatible System")
             print(" ")
             print("This script can only be run from macOS/OS X.")
@@ -17,16 +28,30 @@ class WebDriver:
             exit(1)
 
         self.dl = downloader.Downloader()
-        self.r  = run.Run()
-        self.u  = utils.Utils()
+        # One elevated worker handles the privileged steps instead of a sudo apiece
+        self.r  = run.Run(elevated_worker=True)
         self.web_drivers = None
+        self.manifest = manifest.Manifest()
         self.os_build_number = None
         self.os_number = None
         self.wd_loc = None
         self.sip_checked = False
         self.installed_version = "Not Installed!"
-        self.get_manifest()
-        self.get_system_info()
+        self.manifest_url = "https://gfe.nvidia.com/mac-update"
+        # The manifest is cached next to the Web Drivers folder - within manifest_ttl
+        # seconds of the last check we skip the network entirely, after that we
+        # only re-download if the server says it changed
+        self.manifest_cache = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "Cache")
+        self.manifest_ttl = 3600
+        # Downloaded packages live once in a content-addressed store per root folder,
+        # and the build folders hold hardlinks into it
+        self.wd_folder = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "Web Drivers")
+        self.stores = {}
+        self.stores_lock = threading.Lock()
+        # refresh skips the cache's ttl - so --refresh only hits the server once
+        self.get_manifest(refresh)
+        if interactive:
+            self.get_system_info()
 
     def _check_info(self):
         if os.path.exists("/System/Library/Extensions/NVDAStartupWeb.kext"):
@@ -151,58 +176,130 @@ class WebDriver:
         print("www.reddit.com/u/corpnewt")
         print("www.github.com/corpnewt\n")
         print("Have a nice day/night!\n\n")
+        self.r.close()
         exit(0)
 
-    def get_manifest(self):
-        self.u.head("Retrieving Manifest...")
-        print(" ")
-        print("Retrieving manifest from \"https://gfe.nvidia.com/mac-update\"...\n")
+    def _load_manifest_cache(self):
+        # Returns the cached manifest info dict - or None if missing/unreadable
+        cache_file = os.path.join(self.manifest_cache, "manifest.pickle")
+        raw_file = os.path.join(self.manifest_cache, "mac-update.plist")
+        try:
+            with open(cache_file, "rb") as f:
+                cache = pickle.load(f)
+            if cache.get("url") == self.manifest_url and isinstance(cache.get("manifest"), dict):
+                return cache
+        except:
+            pass
+        # The parsed copy is no good - fall back on the raw plist if we have it
+        try:
+            cache = {"url":self.manifest_url,"etag":None,"last_modified":None,"checked":0}
+            cache["manifest"] = plist.readPlist(raw_file)
+            return cache
+        except:
+            return None
+
+    def _save_manifest_cache(self, cache, plist_data = None):
+        try:
+            if not os.path.exists(self.manifest_cache):
+                os.mkdir(self.manifest_cache)
+            if plist_data is not None:
+                with open(os.path.join(self.manifest_cache, "mac-update.plist"), "wb") as f:
+                    f.write(plist_data)
+            # Protocol 2 keeps the cache readable from both python 2 and 3
+            with open(os.path.join(self.manifest_cache, "manifest.pickle"), "wb") as f:
+                pickle.dump(cache, f, 2)
+        except:
+            pass
+
+    def _set_manifest(self, web_drivers):
+        # Keep the raw manifest and its lookup index in step
+        self.web_drivers = web_drivers
+        self.manifest = manifest.Manifest(web_drivers)
+
+    def get_manifest(self, force = False):
+        cache = self._load_manifest_cache()
+        if cache and not force and 0 <= time.time() - cache.get("checked",0) < self.manifest_ttl:
+            # Checked recently enough - don't bother the server
+            self._set_manifest(cache["manifest"])
+            return
+        if self.interactive:
+            self.u.head("Retrieving Manifest...")
+            print(" ")
+        print("Retrieving manifest from \"{}\"...\n".format(self.manifest_url))
+        headers = dict(self.dl.ua)
+        if cache and cache.get("etag"):
+            headers["If-None-Match"] = cache["etag"]
+        if cache and cache.get("last_modified"):
+            headers["If-Modified-Since"] = cache["last_modified"]
         try:
-            plist_data = self.dl.get_bytes("https://gfe.nvidia.com/mac-update")
+            response = self.dl.open_url(self.manifest_url, headers)
+            if response is not None and response.getcode() == 304:
+                # Not modified - our copy is still good
+                response.close()
+                cache["checked"] = time.time()
+                self._save_manifest_cache(cache)
+                self._set_manifest(cache["manifest"])
+                return
+            plist_data = self.dl.read_response(response) if response is not None else None
             if not plist_data or not len(str(plist_data)):
+                if cache:
+                    print("Looks like that site isn't responding - using the cached manifest.")
+                    if self.interactive: self.u.grab("",timeout=3)
+                    self._set_manifest(cache["manifest"])
+                    return
                 print("Looks like that site isn't responding!\n\nPlease check your intenet connection and try again.")
-                self.u.grab("",timeout=3)
-                self.web_drivers = {}
+                if self.interactive: self.u.grab("",timeout=3)
+                self._set_manifest({})
                 return
-            self.web_drivers = plist.loads(plist_data)
+            self._set_manifest(plist.loads(plist_data))
+            self._save_manifest_cache({
+                "url"           : self.manifest_url,
+                "etag"          : response.headers.get("ETag"),
+                "last_modified" : response.headers.get("Last-Modified"),
+                "checked"       : time.time(),
+                "manifest"      : self.web_drivers
+            }, plist_data)
         except:
+            if cache:
+                print("Something went wrong while getting the manifest - using the cached manifest.")
+                if self.interactive: self.u.grab("",timeout=3)
+                self._set_manifest(cache["manifest"])
+                return
             print("Something went wrong while getting the manifest!\n\nPlease check your intenet connection and try again.")
-            self.u.grab("",timeout=3)
-            self.web_drivers = {}
+            if self.interactive: self.u.grab("",timeout=3)
+            self._set_manifest({})
 
     def get_system_info(self):
         self.installed_version = "Not Installed!"
         self.os_build_number = self.r.run({"args" : ["sw_vers", "-buildVersion"]})[0].strip()
         self.os_number       = self.r.run({"args" : ["sw_vers", "-productVersion"]})[0].strip()
         if self.wd_loc:
-            info_plist = plist.readPlist(self.wd_loc + "/Contents/Info.plist")            
-            self.installed_version = info_plist["CFBundleGetInfoString"].split(" ")[-1].replace("(", "").replace(")", "")
+            info_string = plist.get_path(self.wd_loc + "/Contents/Info.plist", "CFBundleGetInfoString", "")
+            self.installed_version = info_string.split(" ")[-1].replace("(", "").replace(")", "")
 
-    def check_dir(self, build):
-        os.chdir(os.path.dirname(os.path.realpath(__file__)))
-        os.chdir("../")
-        if not os.path.exists("Web Drivers"):
-            os.mkdir("Web Drivers")
-        os.chdir("Web Drivers")
-        if not os.path.exists(build):
-            os.mkdir(build)
-        os.chdir(build)
-        return os.getcwd()
+    def check_dir(self, build, root = None):
+        # Returns the absolute path to root/build, creating it if needed - we
+        # don't chdir here so several downloads can run at once
+        path = os.path.join(self.wd_folder if root is None else root, build)
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path): raise
+        return path
 
     def download_for_build(self, build):
         self.u.head("Downloading for " + build)
         print(" ")
-        dl_update = None
         if not "updates" in self.web_drivers:
             print("The manifest was unreachable!\n\nPlease check your internet connection and update the manifest.")
             self.u.grab("",timeout=5)
             return
-        for update in self.web_drivers.get("updates", []):
-            if update["OS"].lower() == build.lower():
-                dl_update = update
-                break 
+        dl_update = self.manifest.get(build)
         if not dl_update:
             print("There isn't a version available for that build number!")
+            closest = self.manifest.nearest(build)
+            if closest:
+                print("\nThe closest build in the manifest is {} ({}).".format(closest["OS"], closest["version"]))
             self.u.grab("",timeout=5)
             return
         print("Downloading " + dl_update["version"])
@@ -210,13 +307,136 @@ class WebDriver:
         # Get the OS version + build number 10.xx.x (xxAxxxx)
         folder_name = "{} ({})".format(self.get_os(build), build)
         # self.check_dir(build)
-        self.check_dir(folder_name)
-        dl_file = self.dl.stream_to_file(dl_update["downloadURL"], dl_update["downloadURL"].split("/")[-1])
+        folder = self.check_dir(folder_name)
+        dl_file = None
+        try:
+            blob = self.get_store().fetch(self.dl, dl_update["downloadURL"], sha256=self._sha256(dl_update))
+        except Exception as e:
+            print("Download failed: {}".format(e))
+            blob = None
+        if blob:
+            dl_file = self.get_store().link(blob, os.path.join(folder, dl_update["downloadURL"].split("/")[-1]))
         if dl_file:
-            print(dl_file + " downloaded successfully!")
-            self.r.run({"args":["open", os.getcwd()]})
+            print(os.path.basename(dl_file) + " downloaded successfully!")
+            self.r.run({"args":["open", folder]})
             self.u.grab("",timeout=5)
 
+    def get_store(self, root = None):
+        # One blob store per root folder - kept in a hidden .store folder so the
+        # hardlinks stay on the same filesystem
+        root = self.wd_folder if root is None else root
+        # Mirror workers all ask at once - they have to share one store (and its locks)
+        with self.stores_lock:
+            if not root in self.stores:
+                self.stores[root] = blobstore.BlobStore(os.path.join(root, ".store"))
+            return self.stores[root]
+
+    def _check_existing(self, update, file_path):
+        # Returns True if file_path already holds this update's package - we check
+        # the manifest's checksum/size when it has them, else the server's size
+        if not os.path.isfile(file_path):
+            return False
+        checksum = str(update.get("checksum","")).lower()
+        if len(checksum) in HASHES:
+            h = hashlib.new(HASHES[len(checksum)])
+            with open(file_path, "rb") as f:
+                for chunk in iter(lambda: f.read(self.dl.chunk), b""):
+                    h.update(chunk)
+            return h.hexdigest() == checksum
+        try: size = int(update["size"])
+        except: size = -1
+        if size < 0:
+            response = self.dl.open_url(update["downloadURL"])
+            if response is None: return False
+            try: size = int(response.headers["Content-Length"])
+            except: size = -1
+            response.close()
+        return size >= 0 and os.path.getsize(file_path) == size
+
+    def _sha256(self, update):
+        # The manifest's checksum if it's a sha256 - the blob store can check those as it downloads
+        checksum = str(update.get("checksum","")).lower()
+        return checksum if HASHES.get(len(checksum)) == "sha256" else None
+
+    def _mirror_worker(self, jobs, root, results, lock):
+        while True:
+            try: index, update = jobs.get_nowait()
+            except Empty: return
+            build = update.get("OS")
+            file_path = None
+            result = {"build":build,"version":update.get("version"),"url":update.get("downloadURL"),"path":None}
+            start = time.time()
+            try:
+                folder = self.check_dir("{} ({})".format(self.get_os(build), build), root)
+                file_path = os.path.join(folder, update["downloadURL"].split("/")[-1])
+                result["path"] = file_path
+                store = self.get_store(root)
+                blob = store.get(update["downloadURL"])
+                if blob and len(str(update.get("checksum",""))) in HASHES and not self._check_existing(update, blob):
+                    # The manifest's checksum has the last word - a bad blob gets fetched again
+                    store.forget(update["downloadURL"])
+                    blob = None
+                if (blob and store.holds(update["downloadURL"], file_path)) or self._check_existing(update, file_path):
+                    result["status"] = "skipped"
+                elif blob:
+                    # Already have these bytes from another build - just link them in
+                    store.link(blob, file_path)
+                    result["status"] = "linked"
+                else:
+                    blob = store.fetch(self.dl, update["downloadURL"], False, self._sha256(update))
+                    if blob:
+                        store.link(blob, file_path)
+                    result["status"] = "downloaded" if blob else "failed"
+            except Exception as e:
+                result["status"] = "failed"
+                result["error"] = str(e)
+            result["seconds"] = round(time.time()-start, 2)
+            result["size"] = os.path.getsize(file_path) if file_path and os.path.isfile(file_path) else 0
+            with lock:
+                results[index] = result
+                print("{} {} ({}) - {}".format(result["status"].capitalize().ljust(10), build, update.get("version"), os.path.basename(file_path or "") or result.get("error")))
+
+    def mirror(self, updates, workers = 4, root = None):
+        # Non-interactive - downloads every update passed with a bounded pool of
+        # threads, then writes a Mirror Report.json summary to the root folder
+        if root is None:
+            root = self.wd_folder
+        jobs = Queue()
+        for job in enumerate(updates):
+            jobs.put(job)
+        # Each worker fills in its own slot so the report keeps manifest order
+        results = [None]*len(updates)
+        lock = threading.Lock()
+        start = time.time()
+        threads = []
+        for x in range(max(1, min(workers, len(updates)))):
+            t = threading.Thread(target=self._mirror_worker, args=(jobs, root, results, lock))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        # A worker that died outright never filled in its slot - that's a failure too
+        for index, update in enumerate(updates):
+            if results[index] is None:
+                results[index] = {"build":update.get("OS"),"version":update.get("version"),"url":update.get("downloadURL"),"path":None,"status":"failed","error":"Worker stopped","size":0}
+        report = {
+            "started"    : time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(start)),
+            "seconds"    : round(time.time()-start, 2),
+            "downloaded" : len([x for x in results if x["status"] == "downloaded"]),
+            "linked"     : len([x for x in results if x["status"] == "linked"]),
+            "skipped"    : len([x for x in results if x["status"] == "skipped"]),
+            "failed"     : len([x for x in results if x["status"] == "failed"]),
+            "results"    : results
+        }
+        if not os.path.exists(root):
+            os.makedirs(root)
+        with open(os.path.join(root, "Mirror Report.json"), "w") as f:
+            json.dump(report, f, indent=2)
+        print(" ")
+        print("Downloaded {}, linked {}, skipped {}, failed {} in {}s.".format(report["downloaded"], report["linked"], report["skipped"], report["failed"], report["seconds"]))
+        return report
+
     def format_table(self, items, columns):
         max_length = 0
         current_row = 0
@@ -250,29 +470,10 @@ class WebDriver:
 
     def get_os(self, build_number):
         # Returns the best-guess OS version for the build number
-        alpha = "abcdefghijklmnopqrstuvwxyz"
-        os_version = "Unknown"
-        major = minor = ""
-        try:
-            # Formula looks like this:  AAB; AA - 4 = 10.## version
-            # B index in "ABCDEFGHIJKLMNOPQRSTUVXYZ" = 10.##.## version
-            split = re.findall(r"[^\W\d_]+|\d+", build_number)
-            major = int(split[0])-4
-            minor = alpha.index(split[1].lower())
-            os_version = "10.{}.{}".format(major, minor)
-        except:
-            pass
-        return os_version
+        return manifest.get_os(build_number)
     
     def get_value(self, build_number):
-        alpha = "abcdefghijklmnopqrstuvwxyz"
-        # Split them up
-        split = re.findall(r"[^\W\d_]+|\d+", build_number)
-        start = split[0].rjust(4, "0")
-        alph  = split[1]
-        end   = split[2].rjust(6, "0")
-        alpha_num = str(alpha.index(alph.lower())).rjust(2, "0")
-        return int(start + alpha_num + end)
+        return manifest.get_value(build_number)
 
     def build_search(self):
         self.u.head("Web Drivers Search")
@@ -300,7 +501,7 @@ class WebDriver:
             self.custom_quit()
 
         # At this point, we have a build to search for
-        mwd = next((x for x in self.web_drivers.get("updates", []) if x["OS"].lower() == menu.lower()), None)
+        mwd = self.manifest.get(menu)
         if mwd:
             # Found it - download it!
             self.download_for_build(mwd["OS"])
@@ -314,7 +515,7 @@ class WebDriver:
             self.build_search()
             return
         # We have . separated stuffs
-        wd_list = [x for x in self.web_drivers.get("updates", []) if self.get_os(x["OS"]).startswith(menu)]
+        wd_list = self.manifest.search_os(menu)
         if len(wd_list) == 0:
             # No matches
             self.u.head("Searching For {}".format(menu))
@@ -363,14 +564,12 @@ class WebDriver:
         # Print 8 columns
         self.u.head("Web Drivers By Build Number")
         print(" ")
-        build_list = []
         if not "updates" in self.web_drivers:
             # No manifest
             print("The manifest was unreachable!\n\nPlease check your internet connection and update the manifest.")
             self.u.grab("",timeout=5)
             return
-        for update in self.web_drivers.get("updates", []):
-            build_list.append(update["OS"])
+        build_list = self.manifest.builds()
 
         print("OS Build Number:  {}".format(self.os_build_number))
         print(" ")
@@ -392,10 +591,10 @@ class WebDriver:
         elif menu[:1].lower() == "q":
             self.custom_quit()
 
-        for build in build_list:
-            if build.lower() == menu.lower():
-                self.download_for_build(build)
-                return
+        update = self.manifest.get(menu)
+        if update:
+            self.download_for_build(update["OS"])
+            return
         self.build_list()
 
     def patch_menu(self):
@@ -408,8 +607,7 @@ class WebDriver:
             print("Please make sure you have the Web Drivers installed.")
             self.u.grab("",timeout=5)
             return
-        info_plist = plist.readPlist(self.wd_loc + "/Contents/Info.plist")
-        current_build = info_plist.get("IOKitPersonalities", {}).get("NVDAStartup", {}).get("NVDARequiredOS", None)
+        current_build = plist.get_path(self.wd_loc + "/Contents/Info.plist", "IOKitPersonalities/NVDAStartup/NVDARequiredOS")
 
         print("OS Build Number:  {}".format(self.os_build_number))
         print("WD Target Build:  {}".format(current_build))
@@ -473,20 +671,26 @@ class WebDriver:
                 "message" : "Removing " + self.wd_loc + "/Contents/Info.plist...\n" 
             },
             { 
+                "id" : "mv",
                 "args" : ["mv", "-f", self.wd_loc + "/Contents/Info.plist.bak", self.wd_loc + "/Contents/Info.plist"], 
                 "sudo" : True,
                 "message" : "Renaming Info.plist.bak to Info.plist...\n"
             },
             { 
+                "id" : "chown",
+                "after" : "mv",
                 "args" : ["chown", "0:0", self.wd_loc + "/Contents/Info.plist"], 
                 "sudo" : True, 
                 "message" : "Updating ownership and permissions...\n" 
             },
             { 
+                "id" : "chmod",
+                "after" : "mv",
                 "args" : ["chmod", "755", self.wd_loc + "/Contents/Info.plist"], 
                 "sudo" : True
             },
             { 
+                "after" : ["chown", "chmod"],
                 "args" : ["kextcache", "-i", "/"], 
                 "sudo" : True,
                 "stream" : True,
@@ -535,7 +739,6 @@ class WebDriver:
         # Start our command list
         c = []
 
-        info_plist = plist.readPlist(self.wd_loc + "/Contents/Info.plist")
         if not os.path.exists(self.wd_loc + "/Contents/Info.plist.bak"):
             # Create a backup
             self.r.run({
@@ -546,27 +749,33 @@ class WebDriver:
             # plist.writePlist(info_plist, self.wd_loc + "/Contents/Info.plist.bak")
         # Change the build number and write to the main plist
         print("Patching plist for build \"{}\"...\n".format(build_number))
-        info_plist["IOKitPersonalities"]["NVDAStartup"]["NVDARequiredOS"] = build_number
         # Make a temp folder for our plist
         temp_folder = tempfile.mkdtemp()
-        # Write the changes
-        plist.writePlist(info_plist, temp_folder + "/Info.plist")
+        # Copy it over and patch just the one value - the rest of the file stays as-is
+        shutil.copyfile(self.wd_loc + "/Contents/Info.plist", temp_folder + "/Info.plist")
+        plist.patch_value(temp_folder + "/Info.plist", "IOKitPersonalities/NVDAStartup/NVDARequiredOS", build_number)
         # Build and run commands
         c = [
             {
+                "id" : "mv",
                 "args" : ["mv", "-f", temp_folder + "/Info.plist", self.wd_loc + "/Contents/Info.plist"],
                 "sudo" : True
             },
             {
+                "id" : "chown",
+                "after" : "mv",
                 "args" : ["chown", "0:0", self.wd_loc + "/Contents/Info.plist"],
                 "sudo" : True,
                 "message" : "Updating ownership and permissions...\n"
             },
             {
+                "id" : "chmod",
+                "after" : "mv",
                 "args" : ["chmod", "755", self.wd_loc + "/Contents/Info.plist"],
                 "sudo" : True
             },
             {
+                "after" : ["chown", "chmod"],
                 "args" : ["kextcache", "-i", "/"],
                 "sudo" : True,
                 "stream" : True,
@@ -597,8 +806,7 @@ class WebDriver:
             print("Please make sure you have the Web Drivers installed.")
             self.u.grab("",timeout=5)
             return
-        info_plist = plist.readPlist(self.wd_loc + "/Contents/Info.plist")
-        current_build = info_plist.get("IOKitPersonalities", {}).get("NVDAStartup", {}).get("NVDARequiredOS", None)
+        current_build = plist.get_path(self.wd_loc + "/Contents/Info.plist", "IOKitPersonalities/NVDAStartup/NVDARequiredOS")
 
         print("OS Build Number:  {}".format(self.os_build_number))
         print("WD Target Build:  {}".format(current_build))
@@ -766,18 +974,15 @@ class WebDriver:
                 print("Couldn't find Info.plist to patch!")
                 return
             print("    Patching Info.plist for {}...".format(build))
-            # Got the info.plist - load it and patch it
-            info_plist = plist.readPlist(os.path.realpath(info_path))
-            info_plist["IOKitPersonalities"]["NVDAStartup"]["NVDARequiredOS"] = build
-            # Write the changes
-            plist.writePlist(info_plist, os.path.realpath(info_path))
+            # Got the info.plist - patch the build in place
+            plist.patch_value(os.path.realpath(info_path), "IOKitPersonalities/NVDAStartup/NVDARequiredOS", build)
             # Remove the old Payload and BOM
             print("    Removing old Payload and BOM...")
             self.r.run({"args" : ["rm", "../Payload"]})
             self.r.run({"args" : ["rm", "../BOM"]})
             # Repacking Payload
             print("    Setting ownership...")
-            stat = self.r.run({"args" : "sudo chown -R 0:0 ./*", "shell" : True})
+            stat = self.r.run({"args" : ["chown", "-R", "0:0"] + sorted(glob.glob("./*")), "sudo" : True})
             if not stat[2] == 0:
                 print("Something went wrong!\n")
                 print(stat[1])
@@ -804,14 +1009,13 @@ class WebDriver:
                 print(stat[1])
                 return
 
-        self.check_dir("Patched")
+        patched = self.check_dir("Patched")
         print("Repacking...\n")
         os.chdir(os.path.dirname(os.path.realpath(__file__)))
-        os.chdir("../Web Drivers/Patched/")
         suffix = " (Patched).pkg" if build == None else " ({}).pkg".format(build)
-        self.r.run({"args" : ["pkgutil", "--flatten", temp + "/package", os.getcwd() + "/" + os.path.basename(package)[:-4] + suffix]})
+        self.r.run({"args" : ["pkgutil", "--flatten", temp + "/package", os.path.join(patched, os.path.basename(package)[:-4] + suffix)]})
         print("Done.")
-        self.r.run({"args":["open", os.getcwd()]})
+        self.r.run({"args":["open", patched]})
         self.u.grab("",timeout=5)
 
     def remove_drivers(self):
@@ -837,8 +1041,7 @@ class WebDriver:
             print("Please make sure you have the Web Drivers installed.")
             self.u.grab("",timeout=5)
             return
-        info_plist = plist.readPlist(self.wd_loc + "/Contents/Info.plist")
-        current_build = info_plist.get("IOKitPersonalities", {}).get("NVDAStartup", {}).get("NVDARequiredOS", None)
+        current_build = plist.get_path(self.wd_loc + "/Contents/Info.plist", "IOKitPersonalities/NVDAStartup/NVDARequiredOS")
 
         print("OS Build Number:  {}".format(self.os_build_number))
         print("WD Target Build:  {}".format(current_build))
@@ -875,8 +1078,7 @@ class WebDriver:
             print("Please make sure you have the Web Drivers installed.")
             self.u.grab("",timeout=5)
             return
-        info_plist = plist.readPlist(self.wd_loc + "/Contents/Info.plist")
-        current_build = info_plist.get("IOKitPersonalities", {}).get("NVDAStartup", {}).get("NVDARequiredOS", None)
+        current_build = plist.get_path(self.wd_loc + "/Contents/Info.plist", "IOKitPersonalities/NVDAStartup/NVDARequiredOS")
         if build == current_build:
             print("Both builds are the same - this defeats the purpose of the patch.")
             self.u.grab("",timeout=5)
@@ -973,18 +1175,16 @@ class WebDriver:
         print("WD Version:       " + self.installed_version)
 
         if self.wd_loc:
-            info_plist = plist.readPlist(self.wd_loc + "/Contents/Info.plist")
-            current_build = info_plist.get("IOKitPersonalities", {}).get("NVDAStartup", {}).get("NVDARequiredOS", None)
+            current_build = plist.get_path(self.wd_loc + "/Contents/Info.plist", "IOKitPersonalities/NVDAStartup/NVDARequiredOS")
             print("WD Target Build:  {}".format(current_build))
         
         if not "updates" in self.web_drivers:
             newest_version = "Manifest not available!"
         else:
             newest_version = "None for this build number!"
-        for update in self.web_drivers.get("updates", []):
-            if update["OS"].lower() == self.os_build_number.lower():
-                newest_version = update["version"]
-                break 
+        update = self.manifest.get(self.os_build_number)
+        if update:
+            newest_version = update["version"]
 
         if self.installed_version.lower() == newest_version.lower():
             print("Newest:           " + newest_version + " (Current)")
@@ -1041,7 +1241,7 @@ class WebDriver:
         elif menu[:1].lower() == "i":
             self.patch_installer_build()
         elif menu[:1].lower() == "u":
-            self.get_manifest()
+            self.get_manifest(True)
         elif menu[:1].lower() == "r":
             self.remove_drivers()
         elif menu[:1].lower() == "c":
@@ -1067,6 +1267,39 @@ class WebDriver:
         
         return
 
+if len(sys.argv) > 1:
+    # Command line use - mirror the manifest without any menus
+    parser = argparse.ArgumentParser(description="Download every matching web driver package from the manifest.")
+    parser.add_argument("-m", "--mirror", action="store_true", help="mirror the packages (required)")
+    parser.add_argument("-o", "--os", help="only builds whose OS version starts with this (e.g. 10.13)")
+    parser.add_argument("-f", "--from-build", help="only builds at or after this build number")
+    parser.add_argument("-t", "--to-build", help="only builds at or before this build number")
+    parser.add_argument("-w", "--workers", type=int, default=4, help="number of simultaneous downloads (default 4)")
+    parser.add_argument("-d", "--dest", help="folder to mirror into (default ../Web Drivers)")
+    parser.add_argument("-l", "--max-rate", type=float, help="cap the combined download speed in MB/s")
+    parser.add_argument("-r", "--refresh", action="store_true", help="check for a newer manifest even if the cache is fresh")
+    args = parser.parse_args()
+    if not args.mirror:
+        parser.error("nothing to do - did you mean --mirror?")
+    wd = WebDriver(interactive=False, refresh=args.refresh)
+    if args.max_rate:
+        wd.dl.limiter = downloader.RateLimiter(args.max_rate*1000000)
+    if not "updates" in wd.web_drivers:
+        print("The manifest was unreachable!")
+        exit(1)
+    updates = wd.manifest.updates
+    if args.from_build or args.to_build:
+        builds = wd.manifest.sorted_builds()
+        updates = wd.manifest.in_range(args.from_build or builds[0], args.to_build or builds[-1]) if builds else []
+    if args.os:
+        updates = [x for x in updates if wd.get_os(x["OS"]).startswith(args.os)]
+    if not updates:
+        print("No builds matched!")
+        exit(1)
+    print("Mirroring {} build{}...\n".format(len(updates), "" if len(updates) == 1 else "s"))
+    report = wd.mirror(updates, args.workers, os.path.abspath(args.dest) if args.dest else None)
+    exit(1 if report["failed"] else 0)
+
 wd = WebDriver()
 
 while True:
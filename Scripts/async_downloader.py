@@ -0,0 +1,327 @@
+import asyncio, os, time, zlib, threading
+from email.message import Message
+from urllib.parse import urlsplit, urljoin
+import downloader
+
+# Python 3 only - asyncio counterpart to downloader.Downloader.  Every transfer runs
+# on non-blocking sockets through asyncio streams, so a single thread can drive as
+# many downloads at once as you gather() - and SyncDownloader wraps it all back up
+# for blocking callers.
+
+class AsyncResponse:
+    # Minimal HTTP/1.1 response over an asyncio stream pair - handles Content-Length,
+    # chunked and read-until-close bodies, and hands the connection back to the pool
+    # once the body has been read to the end
+
+    def __init__(self, status, headers, reader, writer, release):
+        self.status = status
+        self.headers = headers
+        self._reader = reader
+        self._writer = writer
+        self._release = release
+        self._chunked = headers.get("Transfer-Encoding","").lower() == "chunked"
+        self._chunk_left = 0
+        try: self._left = int(headers["Content-Length"])
+        except: self._left = None if self._chunked or status not in (204, 304) else 0
+        self._done = False
+        if self._left == 0: self._finish()
+
+    def getcode(self):
+        return self.status
+
+    def _finish(self):
+        if self._done: return
+        self._done = True
+        reuse = self._left is not None or self._chunked
+        reuse = reuse and self.headers.get("Connection","").lower() != "close"
+        self._release(self._reader, self._writer, reuse)
+
+    async def _read_chunked(self, amt):
+        if self._chunk_left == 0:
+            line = await self._reader.readline()
+            self._chunk_left = int(line.split(b";")[0].strip() or b"0", 16)
+            if self._chunk_left == 0:
+                # Last chunk - skip any trailers up to the blank line
+                while (await self._reader.readline()).strip():
+                    pass
+                self._finish()
+                return b""
+        data = await self._reader.read(min(amt, self._chunk_left))
+        if not data:
+            raise ConnectionError("Connection closed mid-chunk")
+        self._chunk_left -= len(data)
+        if self._chunk_left == 0:
+            await self._reader.readline() # CRLF after each chunk
+        return data
+
+    async def read(self, amt = -1):
+        if self._done: return b""
+        if amt is None or amt < 0:
+            chunks = []
+            while True:
+                chunk = await self.read(1048576)
+                if not chunk: break
+                chunks.append(chunk)
+            return b"".join(chunks)
+        if self._chunked:
+            return await self._read_chunked(amt)
+        if self._left is not None:
+            amt = min(amt, self._left)
+        data = await self._reader.read(amt)
+        if self._left is not None:
+            self._left -= len(data)
+        if not data or self._left == 0:
+            self._finish()
+        return data
+
+    def close(self):
+        if self._done: return
+        # Didn't read to the end - the connection can't be reused
+        self._done = True
+        self._release(self._reader, self._writer, False)
+
+class AsyncDownloader:
+
+    def __init__(self, **kwargs):
+        self.ua = kwargs.get("useragent",{"User-Agent":"Mozilla"})
+        self.chunk = 1048576 # 1024 x 1024 i.e. 1MiB
+        self.ssl_context = downloader._get_ssl_context()
+        self.max_per_host = kwargs.get("max_per_host",4)
+        self.idle_timeout = kwargs.get("idle_timeout",30)
+        self.max_redirects = 10
+        self.connections_made = 0
+        self._idle = {}
+        # Borrow the size formatting and progress output from the blocking Downloader
+        self._dl = downloader.Downloader(keep_alive=False)
+
+    def _decode(self, value, encoding="utf-8", errors="ignore"):
+        return self._dl._decode(value, encoding, errors)
+
+    def get_size(self, *args, **kwargs):
+        return self._dl.get_size(*args, **kwargs)
+
+    def _progress_hook(self, bytes_so_far, total_size):
+        self._dl._progress_hook(bytes_so_far, total_size)
+
+    async def _get_connection(self, scheme, host, port):
+        key = (scheme, host, port)
+        now = time.time()
+        idle = self._idle.get(key, [])
+        while idle:
+            reader, writer, last_used = idle.pop()
+            if now - last_used <= self.idle_timeout and not reader.at_eof():
+                return (reader, writer, True)
+            writer.close()
+        self.connections_made += 1
+        reader, writer = await asyncio.open_connection(
+            host, port,
+            ssl=self.ssl_context if scheme == "https" else None,
+            server_hostname=host if scheme == "https" else None
+        )
+        return (reader, writer, False)
+
+    def _release(self, key, reader, writer, reuse):
+        idle = self._idle.setdefault(key, [])
+        if reuse and len(idle) < self.max_per_host:
+            idle.append((reader, writer, time.time()))
+        else:
+            writer.close()
+
+    async def _request(self, url, headers):
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        if not scheme in ("http","https"):
+            raise ValueError("Unsupported scheme: {}".format(scheme))
+        port = parts.port or (443 if scheme == "https" else 80)
+        path = (parts.path or "/") + ("?"+parts.query if parts.query else "")
+        host = parts.hostname if parts.port is None else "{}:{}".format(parts.hostname, parts.port)
+        lines = ["GET {} HTTP/1.1".format(path), "Host: {}".format(host)]
+        lines.extend("{}: {}".format(k, v) for k, v in headers.items() if k.lower() != "host")
+        request = ("\r\n".join(lines)+"\r\n\r\n").encode("latin-1")
+        key = (scheme, parts.hostname, port)
+        while True:
+            reader, writer, reused = await self._get_connection(*key)
+            try:
+                writer.write(request)
+                await writer.drain()
+                status_line = await reader.readline()
+                if not status_line:
+                    raise ConnectionError("Connection closed before a response")
+                break
+            except Exception:
+                writer.close()
+                # A pooled connection may have been dropped while idle - retry on a fresh one
+                if not reused: raise
+        status = int(status_line.split()[1])
+        response_headers = Message()
+        while True:
+            line = await reader.readline()
+            if not line.strip(): break
+            name, _, value = line.decode("latin-1").partition(":")
+            response_headers[name.strip()] = value.strip()
+        return AsyncResponse(status, response_headers, reader, writer, lambda r, w, reuse: self._release(key, r, w, reuse))
+
+    async def open_url(self, url, headers = None):
+        # Fall back on the default ua if none provided
+        headers = self.ua if headers is None else headers
+        try:
+            for x in range(self.max_redirects+1):
+                response = await self._request(url, headers)
+                if response.status in (301, 302, 303, 307, 308) and response.headers.get("Location"):
+                    # Follow the redirect
+                    await response.read()
+                    url = urljoin(url, response.headers["Location"])
+                    continue
+                if response.status >= 400:
+                    response.close()
+                    return None
+                return response
+        except Exception:
+            pass
+        # No fixing this - bail
+        return None
+
+    async def get_string(self, url, progress = True, headers = None, expand_gzip = True):
+        response = await self.get_bytes(url,progress,headers,expand_gzip)
+        if response is None: return None
+        return self._decode(response)
+
+    async def get_bytes(self, url, progress = True, headers = None, expand_gzip = True):
+        response = await self.open_url(url, headers)
+        if response is None: return None
+        bytes_so_far = 0
+        try: total_size = int(response.headers['Content-Length'])
+        except: total_size = -1
+        inflater = None
+        if expand_gzip and response.headers.get("Content-Encoding","unknown").lower() == "gzip":
+            inflater = zlib.decompressobj(16+zlib.MAX_WBITS)
+        chunks = []
+        try:
+            while True:
+                chunk = await response.read(self.chunk)
+                bytes_so_far += len(chunk)
+                if progress: self._progress_hook(bytes_so_far,total_size)
+                if not chunk: break
+                if inflater:
+                    chunk = inflater.decompress(chunk)
+                    while inflater.unused_data:
+                        # Another gzip member follows - start a fresh inflater on the leftovers
+                        leftover = inflater.unused_data
+                        inflater = zlib.decompressobj(16+zlib.MAX_WBITS)
+                        chunk += inflater.decompress(leftover)
+                chunks.append(chunk)
+        except Exception:
+            response.close()
+            if progress: print("")
+            return None
+        if inflater:
+            chunks.append(inflater.flush())
+        if progress: print("") # Add a newline so our last progress prints completely
+        return b"".join(chunks)
+
+    async def stream_to_file(self, url, file_path, progress = True, headers = None, ensure_size_if_present = True):
+        response = await self.open_url(url, headers)
+        if response is None: return None
+        bytes_so_far = 0
+        try: total_size = int(response.headers['Content-Length'])
+        except: total_size = -1
+        try:
+            with open(file_path, 'wb') as f:
+                while True:
+                    chunk = await response.read(self.chunk)
+                    bytes_so_far += len(chunk)
+                    if progress: self._progress_hook(bytes_so_far,total_size)
+                    if not chunk: break
+                    f.write(chunk)
+        except Exception:
+            response.close()
+            if progress: print("")
+            return None
+        if progress: print("") # Add a newline so our last progress prints completely
+        if ensure_size_if_present and total_size != -1:
+            # We're verifying size - make sure we got what we asked for
+            if bytes_so_far != total_size:
+                return None # We didn't - imply it failed
+        return file_path if os.path.exists(file_path) else None
+
+    def close(self):
+        for conns in self._idle.values():
+            for reader, writer, last_used in conns:
+                writer.close()
+        self._idle = {}
+
+class _SyncResponse:
+    # Blocking view of an AsyncResponse living on SyncDownloader's loop
+
+    def __init__(self, response, run):
+        self._response = response
+        self._run = run
+        self.headers = response.headers
+        self.status = response.status
+
+    def getcode(self):
+        return self.status
+
+    def read(self, amt = -1):
+        return self._run(self._response.read(amt))
+
+    def close(self):
+        self._run(self._close())
+
+    async def _close(self):
+        self._response.close()
+
+class SyncDownloader:
+    # Drop-in blocking wrapper - runs an AsyncDownloader on its own event loop in a
+    # background thread, so the same engine serves synchronous code like WebDriver.py.
+    # run_all() lets blocking callers fan out many transfers on that single loop.
+
+    def __init__(self, **kwargs):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        self.engine = self._run(self._create(kwargs))
+
+    async def _create(self, kwargs):
+        return AsyncDownloader(**kwargs)
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def __getattr__(self, attr):
+        # Plain helpers like get_size() just pass through
+        return getattr(self.engine, attr)
+
+    def open_url(self, url, headers = None):
+        response = self._run(self.engine.open_url(url, headers))
+        return None if response is None else _SyncResponse(response, self._run)
+
+    def get_string(self, url, progress = True, headers = None, expand_gzip = True):
+        return self._run(self.engine.get_string(url, progress, headers, expand_gzip))
+
+    def get_bytes(self, url, progress = True, headers = None, expand_gzip = True):
+        return self._run(self.engine.get_bytes(url, progress, headers, expand_gzip))
+
+    def stream_to_file(self, url, file_path, progress = True, headers = None, ensure_size_if_present = True):
+        return self._run(self.engine.stream_to_file(url, file_path, progress, headers, ensure_size_if_present))
+
+    def run_all(self, coros, limit = None):
+        # Runs engine coroutines concurrently (at most limit at a time) and returns
+        # their results in order - e.g. run_all([s.engine.get_bytes(u, False) for u in urls])
+        async def gather():
+            semaphore = asyncio.Semaphore(limit) if limit else None
+            async def bounded(coro):
+                if semaphore is None: return await coro
+                async with semaphore:
+                    return await coro
+            return await asyncio.gather(*(bounded(c) for c in coros))
+        return self._run(gather())
+
+    def close(self):
+        self._run(self._close())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    async def _close(self):
+        self.engine.close()
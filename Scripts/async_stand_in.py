@@ -0,0 +1,64 @@
+import asyncio, gzip, threading
+from io import BytesIO
+
+# Python 3 only - a bare-bones asyncio HTTP/1.1 server for exercising
+# async_downloader without touching the network (see download_bench.py).  Routes
+# are /<kind>/<n>: data (Content-Length), chunked, gzip, redirect (302 to /data/n)
+# and close (no length - the body runs until the server hangs up).  Connections
+# stay open between requests so the engine's pool gets used.
+
+def start(body, delay):
+    # Runs the server on its own thread and returns (port, stop) - body(n) gives the
+    # payload for /<kind>/<n>
+    loop = asyncio.new_event_loop()
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                request = await reader.readline()
+                if not request: break
+                while (await reader.readline()).strip():
+                    pass # Skip the request headers
+                kind, _, size = request.split()[1].decode("latin-1").strip("/").partition("/")
+                data = body(int(size or 0))
+                if delay: await asyncio.sleep(delay)
+                if kind == "redirect":
+                    writer.write("HTTP/1.1 302 Found\r\nLocation: /data/{}\r\nContent-Length: 0\r\n\r\n".format(len(data)).encode("latin-1"))
+                elif kind == "chunked":
+                    writer.write(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n")
+                    for i in range(0, len(data), 4096):
+                        piece = data[i:i+4096]
+                        writer.write("{:x}\r\n".format(len(piece)).encode("latin-1") + piece + b"\r\n")
+                    writer.write(b"0\r\n\r\n")
+                elif kind == "gzip":
+                    out = BytesIO()
+                    with gzip.GzipFile(fileobj=out, mode="wb") as f:
+                        f.write(data)
+                    packed = out.getvalue()
+                    writer.write("HTTP/1.1 200 OK\r\nContent-Encoding: gzip\r\nContent-Length: {}\r\n\r\n".format(len(packed)).encode("latin-1") + packed)
+                elif kind == "close":
+                    # No length - the body runs until we hang up
+                    writer.write(b"HTTP/1.1 200 OK\r\nConnection: close\r\n\r\n" + data)
+                    await writer.drain()
+                    break
+                else:
+                    writer.write("HTTP/1.1 200 OK\r\nContent-Length: {}\r\n\r\n".format(len(data)).encode("latin-1") + data)
+                await writer.drain()
+        except (ConnectionError, ValueError, IndexError):
+            pass
+        writer.close()
+
+    server = loop.run_until_complete(asyncio.start_server(handle, "127.0.0.1", 0))
+    t = threading.Thread(target=loop.run_forever)
+    t.daemon = True
+    t.start()
+
+    def stop():
+        async def close():
+            server.close()
+            await server.wait_closed()
+        asyncio.run_coroutine_threadsafe(close(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        t.join()
+        loop.close()
+    return (server.sockets[0].getsockname()[1], stop)
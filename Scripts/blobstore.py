@@ -0,0 +1,132 @@
+import os, json, shutil, hashlib, threading
+
+class BlobStore:
+    # Content-addressed storage for downloaded packages.  Every unique file lives
+    # once under blobs/<first 2 hex digits>/<sha256>, and index.json maps each url
+    # we've fetched to its digest so we never download the same url twice.  Build
+    # folders get hardlinks to the blobs (or copies where linking isn't possible).
+
+    def __init__(self, root):
+        self.root = root
+        self.blobs = os.path.join(root, "blobs")
+        self.temp = os.path.join(root, "temp")
+        self.index_path = os.path.join(root, "index.json")
+        self._lock = threading.Lock()
+        self._url_locks = {}
+        self.index = self._load_index()
+
+    def _load_index(self):
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+            if isinstance(index, dict):
+                return index
+        except:
+            pass
+        return {}
+
+    def _save_index(self):
+        # Write to a temp file first so a crash can't leave a half-written index
+        self._makedirs(self.root)
+        temp_path = self.index_path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.index, f, indent=2, sort_keys=True)
+        if os.name == "nt" and os.path.exists(self.index_path):
+            os.remove(self.index_path) # Windows won't rename over an existing file
+        os.rename(temp_path, self.index_path)
+
+    def _makedirs(self, path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path): raise
+
+    def blob_path(self, digest):
+        return os.path.join(self.blobs, digest[:2], digest)
+
+    def get(self, url):
+        # Returns the path of the blob we already hold for url - or None
+        with self._lock:
+            entry = self.index.get(url)
+        if not entry:
+            return None
+        path = self.blob_path(entry["sha256"])
+        if not os.path.isfile(path) or os.path.getsize(path) != entry.get("size", -1):
+            return None
+        return path
+
+    def add_file(self, file_path, url = None, digest = None):
+        # Moves file_path into the store and returns the blob path - if we already have
+        # the same bytes the incoming copy is just dropped
+        if digest is None:
+            h = hashlib.sha256()
+            with open(file_path, "rb") as f:
+                for chunk in iter(lambda: f.read(1048576), b""):
+                    h.update(chunk)
+            digest = h.hexdigest()
+        path = self.blob_path(digest)
+        with self._lock:
+            if os.path.isfile(path):
+                os.remove(file_path)
+            else:
+                self._makedirs(os.path.dirname(path))
+                shutil.move(file_path, path)
+            if url:
+                self.index[url] = {"sha256":digest,"size":os.path.getsize(path)}
+                self._save_index()
+        return path
+
+    def fetch(self, dl, url, progress = True, sha256 = None):
+        # Returns the blob path for url, downloading it only if we don't hold it already.
+        # If the caller knows the sha256 up front we can also match identical content
+        # that was fetched from a different url.
+        with self._lock:
+            url_lock = self._url_locks.setdefault(url, threading.Lock())
+        # Only one thread downloads a given url - the rest wait and reuse its blob
+        with url_lock:
+            return self._fetch(dl, url, progress, sha256)
+
+    def _fetch(self, dl, url, progress, sha256):
+        path = self.get(url)
+        if path:
+            return path
+        if sha256 and os.path.isfile(self.blob_path(sha256.lower())):
+            with self._lock:
+                self.index[url] = {"sha256":sha256.lower(),"size":os.path.getsize(self.blob_path(sha256.lower()))}
+                self._save_index()
+            return self.blob_path(sha256.lower())
+        self._makedirs(self.temp)
+        # Name the temp file after the url so an interrupted download can resume
+        temp_path = os.path.join(self.temp, hashlib.sha256(url.encode("utf-8")).hexdigest())
+        hasher = hashlib.sha256()
+        if not dl.stream_to_file(url, temp_path, progress, hasher=hasher):
+            return None
+        if sha256 and hasher.hexdigest() != sha256.lower():
+            # Not what the caller expected - don't file it away under this url
+            os.remove(temp_path)
+            return None
+        return self.add_file(temp_path, url, hasher.hexdigest())
+
+    def forget(self, url):
+        # Drops url from the index - e.g. when its blob turned out to be bad
+        with self._lock:
+            if self.index.pop(url, None) is not None:
+                self._save_index()
+
+    def link(self, blob, dest):
+        # Points dest at blob - replacing whatever was there before
+        if os.path.exists(dest):
+            if os.path.samefile(blob, dest):
+                return dest
+            os.remove(dest)
+        try:
+            os.link(blob, dest)
+        except (OSError, AttributeError):
+            # Different filesystem, or no hardlink support - fall back on a copy
+            shutil.copy2(blob, dest)
+        return dest
+
+    def holds(self, url, dest):
+        # True if dest is already linked to the blob we hold for url
+        path = self.get(url)
+        return bool(path) and os.path.exists(dest) and os.path.samefile(path, dest)
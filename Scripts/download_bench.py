@@ -0,0 +1,280 @@
+import sys, os, time, ssl, gzip, hashlib, threading, argparse, tempfile, shutil, subprocess, downloader
+from io import BytesIO
+if sys.version_info >= (3, 0):
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+else:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+# Benchmarks downloader.py against local servers - nothing leaves the machine:
+#
+# handshake - a batch of small requests to a local HTTPS server (self-signed cert
+#             made with openssl) from a keep-alive Downloader and from one with the
+#             pool turned off, counting the TLS handshakes the server saw next to
+#             the pool's connections_made.
+# rate      - a large file from a local HTTP server (byte ranges supported) under a
+#             download_rate cap at 1 and --connections connections, showing how far
+#             the achieved rate lands from the cap - then uncapped, comparing adaptive
+#             read sizes against a fixed 1MiB read (median of --repeat runs).
+# async     - checks async_downloader's engine against async_stand_in.py's local server
+#             (Content-Length, chunked, gzip, redirect and read-until-close bodies),
+#             then times a batch of requests sequentially on the blocking Downloader
+#             and concurrently through SyncDownloader.run_all.  Python 3 only.
+#
+#   python download_bench.py --requests 200 --delay 0.01
+#   python download_bench.py -b rate --mb 40 --cap 10 --connections 4
+
+def body(size):
+    # Deterministic payload so the client side can check what it got
+    return (b"0123456789abcdef" * (size // 16 + 1))[:size]
+
+###                  ###
+# HTTP(S) Test Servers #
+###                  ###
+
+def make_cert(folder):
+    # Returns (cert, key) for 127.0.0.1 - or None without openssl
+    cert = os.path.join(folder, "cert.pem")
+    key  = os.path.join(folder, "key.pem")
+    try:
+        subprocess.check_call(
+            ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+             "-keyout", key, "-out", cert, "-subj", "/CN=127.0.0.1",
+             "-addext", "subjectAltName=IP:127.0.0.1"],
+            stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return (cert, key)
+
+class _Handler(BaseHTTPRequestHandler):
+    # GET /<n> answers with n bytes, honoring a single "Range: bytes=a-b" - HTTP/1.1
+    # so connections stay open between requests
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes - without this the body waits on
+    # the client's delayed ACK and every reused connection looks 40ms slow
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        try: size = int(self.path.strip("/"))
+        except ValueError: size = 0
+        data = self.server.body(size)
+        first, last = 0, len(data)-1
+        spec = self.headers.get("Range","")
+        if spec.startswith("bytes="):
+            a, _, b = spec[6:].partition("-")
+            first, last = int(a or 0), min(int(b) if b else last, last)
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(first, last, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", '"{}"'.format(size))
+        self.send_header("Content-Length", str(last-first+1))
+        self.end_headers()
+        view = memoryview(data) if sys.version_info >= (3, 0) else data # Python 2's write() won't take a memoryview
+        for start in range(first, last+1, 1048576):
+            self.wfile.write(view[start:min(start+1048576, last+1)])
+
+    def log_message(self, *args):
+        pass
+
+class _HTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), _Handler)
+        self._bodies = {}
+
+    def body(self, size):
+        # Built once per size - the big rate payloads would otherwise skew the timings
+        if not size in self._bodies:
+            self._bodies[size] = body(size)
+        return self._bodies[size]
+
+    def start(self):
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def handle_error(self, request, client_address):
+        # Clients hang up mid-body (parallel downloads drop their probe response) or
+        # without a TLS goodbye - that's expected here
+        pass
+
+class _HTTPSServer(_HTTPServer):
+
+    def __init__(self, cert, key):
+        _HTTPServer.__init__(self)
+        self.handshakes = 0
+        self.context = ssl.SSLContext(getattr(ssl, "PROTOCOL_TLS_SERVER", ssl.PROTOCOL_SSLv23))
+        self.context.load_cert_chain(cert, key)
+
+    def get_request(self):
+        # Each accepted connection is one full TLS handshake
+        sock, addr = self.socket.accept()
+        self.handshakes += 1
+        return (self.context.wrap_socket(sock, server_side=True), addr)
+
+def bench_handshake(requests, size):
+    folder = tempfile.mkdtemp()
+    try:
+        pair = make_cert(folder)
+        if pair is None:
+            print("handshake - skipped, needs openssl to make a test certificate")
+            return
+        server = _HTTPSServer(*pair).start()
+        # Every Downloader shares the module's context - point it at our test cert
+        downloader._ssl_context = ssl.create_default_context(cafile=pair[0])
+        url = "https://127.0.0.1:{}/{}".format(server.server_address[1], size)
+        print("{:<12} {:>8} {:>10} {:>10} {:>10} {:>10}".format("handshake", "requests", "wall s", "req/s", "handshakes", "pool conns"))
+        for name, keep_alive in (("keep-alive", True), ("no pool", False)):
+            d = downloader.Downloader(keep_alive=keep_alive)
+            server.handshakes = 0
+            start = time.time()
+            for x in range(requests):
+                if d.get_bytes(url, False) != body(size):
+                    raise RuntimeError("Bad response from {}".format(url))
+            wall = time.time() - start
+            made = d.pool.connections_made if d.pool else "-"
+            if d.pool: d.pool.clear()
+            print("{:<12} {:>8} {:>10.3f} {:>10.1f} {:>10} {:>10}".format(name, requests, wall, requests / wall, server.handshakes, made))
+        server.stop()
+    finally:
+        downloader._ssl_context = None
+        shutil.rmtree(folder, ignore_errors=True)
+
+def timed_download(url, path, expected, connections, adaptive, cap = None):
+    # One stream_to_file run - returns its wall time, raising if the file comes out wrong
+    d = downloader.Downloader(connections=connections, adaptive_chunk=adaptive, resume=False)
+    start = time.time()
+    out = d.stream_to_file(url, path, False, download_rate=cap)
+    wall = time.time() - start
+    h = hashlib.sha256()
+    if out: d._hash_file(path, h)
+    if d.pool: d.pool.clear()
+    if h.hexdigest() != expected:
+        raise RuntimeError("Bad download from {}".format(url))
+    os.remove(path)
+    return wall
+
+def bench_rate(mb, cap, connections, repeat):
+    size = int(mb * 1000000)
+    server = _HTTPServer().start()
+    folder = tempfile.mkdtemp()
+    try:
+        url = "http://127.0.0.1:{}/{}".format(server.server_address[1], size)
+        expected = hashlib.sha256(server.body(size)).hexdigest()
+        path = os.path.join(folder, "download")
+        conns = sorted(set((1, connections)))
+        print("{:<12} {:>8} {:>10} {:>8} {:>10} {:>10} {:>10}".format("rate", "conns", "chunks", "MB", "wall s", "MB/s", "vs cap"))
+        for c in conns:
+            wall = timed_download(url, path, expected, c, True, cap * 1000000)
+            rate = size / wall / 1000000
+            print("{:<12} {:>8} {:>10} {:>8.1f} {:>10.3f} {:>10.2f} {:>9.1f}%".format("capped", c, "adaptive", size / 1000000.0, wall, rate, (rate - cap) / cap * 100))
+        for c in conns:
+            for name, adaptive in (("adaptive", True), ("fixed", False)):
+                walls = sorted(timed_download(url, path, expected, c, adaptive) for x in range(repeat))
+                wall = walls[len(walls)//2]
+                print("{:<12} {:>8} {:>10} {:>8.1f} {:>10.3f} {:>10.2f} {:>10}".format("uncapped", c, name, size / 1000000.0, wall, size / wall / 1000000, "-"))
+    finally:
+        server.stop()
+        shutil.rmtree(folder, ignore_errors=True)
+
+###                   ###
+# Asyncio HTTP Stand-In #
+###                   ###
+
+def check_async(s, base, size):
+    # Every body shape through every engine call - raises on the first mismatch
+    folder = tempfile.mkdtemp()
+    try:
+        for kind in ("data", "chunked", "gzip", "redirect", "close"):
+            url = "{}/{}/{}".format(base, kind, size)
+            if s.get_bytes(url, False) != body(size):
+                raise RuntimeError("get_bytes: bad {} response".format(kind))
+            if s.get_string(url, False) != body(size).decode("utf-8"):
+                raise RuntimeError("get_string: bad {} response".format(kind))
+            path = os.path.join(folder, kind)
+            if s.stream_to_file(url, path, False) != path:
+                raise RuntimeError("stream_to_file: bad {} response".format(kind))
+            with open(path, "rb") as f:
+                saved = f.read()
+            if kind == "gzip":
+                # Saved as sent - same as the blocking Downloader
+                saved = gzip.GzipFile(fileobj=BytesIO(saved)).read()
+            if saved != body(size):
+                raise RuntimeError("stream_to_file: bad {} response".format(kind))
+            response = s.open_url(url)
+            if response is None or response.getcode() != 200:
+                raise RuntimeError("open_url: bad {} response".format(kind))
+            response.close()
+        if s.get_bytes("{}/missing".format(base.replace("http:", "ftp:")), False) is not None:
+            raise RuntimeError("get_bytes: unsupported scheme didn't fail")
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+def bench_async(requests, size, delay, limit):
+    if sys.version_info < (3, 0):
+        print("async - skipped, asyncio needs Python 3")
+        return
+    import async_downloader, async_stand_in
+    port, stop = async_stand_in.start(body, delay)
+    base = "http://127.0.0.1:{}".format(port)
+    try:
+        s = async_downloader.SyncDownloader(max_per_host=limit)
+        try:
+            check_async(s, base, size)
+            print("async stand-in checks passed\n")
+            urls = ["{}/data/{}".format(base, size) for x in range(requests)]
+            print("{:<12} {:>8} {:>10} {:>10} {:>10}".format("engine", "requests", "wall s", "req/s", "conns"))
+            d = downloader.Downloader()
+            start = time.time()
+            for url in urls:
+                if d.get_bytes(url, False) != body(size):
+                    raise RuntimeError("Bad response from {}".format(url))
+            wall = time.time() - start
+            print("{:<12} {:>8} {:>10.3f} {:>10.1f} {:>10}".format("blocking", requests, wall, requests / wall, d.pool.connections_made))
+            d.pool.clear()
+            s.engine.connections_made = 0
+            start = time.time()
+            out = s.run_all([s.engine.get_bytes(url, False) for url in urls], limit)
+            wall = time.time() - start
+            if any(x != body(size) for x in out):
+                raise RuntimeError("Bad response from run_all")
+            print("{:<12} {:>8} {:>10.3f} {:>10.1f} {:>10}".format("async", requests, wall, requests / wall, s.engine.connections_made))
+        finally:
+            s.close()
+    finally:
+        stop()
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark downloader.py against local test servers.")
+    parser.add_argument("-n", "--requests", type=int, default=200, help="requests per run (default 200)")
+    parser.add_argument("-s", "--size", type=int, default=1024, help="bytes per response (default 1024)")
+    parser.add_argument("-d", "--delay", type=float, default=0.01, help="seconds the async stand-in waits before each answer (default 0.01)")
+    parser.add_argument("-l", "--limit", type=int, default=16, help="concurrent async transfers (default 16)")
+    parser.add_argument("-m", "--mb", type=float, default=40, help="MB the rate benchmark downloads (default 40)")
+    parser.add_argument("-c", "--cap", type=float, default=10, help="download_rate cap in MB/s for the rate benchmark (default 10)")
+    parser.add_argument("--connections", type=int, default=4, help="parallel connections for the rate benchmark (default 4)")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="uncapped runs per rate measurement - the median is kept (default 5)")
+    parser.add_argument("-b", "--bench", choices=("all", "handshake", "async", "rate"), default="all", help="which benchmark to run (default all)")
+    args = parser.parse_args()
+    if args.bench in ("all", "handshake"):
+        bench_handshake(args.requests, args.size)
+    if args.bench == "all": print("")
+    if args.bench in ("all", "async"):
+        bench_async(args.requests, args.size, args.delay, args.limit)
+    if args.bench == "all": print("")
+    if args.bench in ("all", "rate"):
+        bench_rate(args.mb, args.cap, args.connections, args.repeat)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
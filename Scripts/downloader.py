@@ -1,44 +1,285 @@
-import sys, os, time, ssl, gzip
-from io import BytesIO
+import sys, os, time, ssl, zlib, threading, json
 # Python-aware urllib stuff
 if sys.version_info >= (3, 0):
-    from urllib.request import urlopen, Request
+    from urllib.request import urlopen, Request, getproxies, proxy_bypass
+    from urllib.parse import urlsplit, urljoin
+    from urllib.error import HTTPError
+    import http.client as httplib
 else:
     # Import urllib2 to catch errors
-    import urllib2
-    from urllib2 import urlopen, Request
+    import urllib2, httplib
+    from urllib2 import urlopen, Request, HTTPError
+    from urllib import getproxies, proxy_bypass
+    from urlparse import urlsplit, urljoin
+
+_ssl_context = None
+
+def _get_ssl_context():
+    # Build the context once per process - this can touch the disk and import certifi,
+    # which adds up when several Downloader instances get created
+    global _ssl_context
+    if _ssl_context is not None:
+        return _ssl_context
+    # Provide reasonable default logic to workaround macOS CA file handling 
+    cafile = ssl.get_default_verify_paths().openssl_cafile
+    try:
+        # If default OpenSSL CA file does not exist, use that from certifi
+        if not os.path.exists(cafile):
+            import certifi
+            cafile = certifi.where()
+        _ssl_context = ssl.create_default_context(cafile=cafile)
+    except:
+        # None of the above worked, disable certificate verification for now
+        _ssl_context = ssl._create_unverified_context()
+    return _ssl_context
+
+class ConnectionPool:
+    # Keeps finished HTTP(S) connections around per host so later requests can skip the
+    # TCP and TLS handshakes.  At most max_per_host idle connections are kept per host,
+    # and any that sit unused longer than idle_timeout seconds get closed.
+
+    def __init__(self, ssl_context = None, max_per_host = 4, idle_timeout = 30):
+        self.ssl_context = ssl_context
+        self.max_per_host = max(1, int(max_per_host))
+        self.idle_timeout = idle_timeout
+        self.connections_made = 0 # Every new connection means a new handshake
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self, scheme, host, port):
+        # Returns a tuple of (connection, reused)
+        key = (scheme, host, port)
+        now = time.time()
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                conn, last_used = idle.pop()
+                if now - last_used <= self.idle_timeout:
+                    return (conn, True)
+                conn.close() # Sat around too long - the server has likely dropped it
+            self.connections_made += 1
+        if scheme == "https":
+            return (httplib.HTTPSConnection(host, port, context=self.ssl_context), False)
+        return (httplib.HTTPConnection(host, port), False)
+
+    def put(self, scheme, host, port, conn):
+        with self._lock:
+            idle = self._idle.setdefault((scheme, host, port), [])
+            if len(idle) < self.max_per_host:
+                idle.append((conn, time.time()))
+                return
+        conn.close() # Pool is full for this host
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn, last_used in conns:
+                conn.close()
+
+class _PooledResponse:
+    # Thin wrapper around an httplib response which hands the connection back to
+    # the pool once the body has been read to the end
+
+    def __init__(self, response, pool, key, conn):
+        self._response = response
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self.headers = response.msg
+        self.status = response.status
+        if response.isclosed():
+            # No body to read (304, etc) - connection is free right away
+            self._release(not response.will_close)
+
+    def __getattr__(self, attr):
+        return getattr(self._response, attr)
+
+    def _release(self, reuse):
+        if self._conn is None: return
+        if reuse: self._pool.put(self._key[0], self._key[1], self._key[2], self._conn)
+        else: self._conn.close()
+        self._conn = None
+
+    def getcode(self):
+        return self.status
+
+    def read(self, amt = None):
+        data = self._response.read() if amt is None else self._response.read(amt)
+        if self._response.isclosed():
+            # Body is done - the connection is free to serve another request
+            self._release(not self._response.will_close)
+        return data
+
+    def close(self):
+        # If we didn't read everything, the connection can't be reused
+        self._release(False)
+        self._response.close()
+
+# Prefer a clock that can't jump backwards when available
+_clock = getattr(time, "monotonic", time.time)
+
+class RateLimiter:
+    # Token bucket shared by anything that should stay under rate bytes/sec.  Readers
+    # take tokens after each read and sleep off any deficit - the sleep happens
+    # outside the lock so one slow reader doesn't hold up the others' bookkeeping.
+
+    def __init__(self, rate, burst = None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate) # Allow up to a second's worth at once by default
+        # Start empty - a full bucket lets the first second run at double speed
+        self._tokens = 0.0
+        self._last = _clock()
+        self._lock = threading.Lock()
+
+    def consume(self, amount):
+        with self._lock:
+            now = _clock()
+            self._tokens = min(self.burst, self._tokens + (now-self._last)*self.rate)
+            self._last = now
+            self._tokens -= amount
+            wait = -self._tokens/self.rate if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+class ChunkSizer:
+    # Adapts the read size of a single transfer - reads that come back much faster
+    # than target seconds double the size, much slower ones halve it.  Big reads keep
+    # the per-chunk overhead down on fast links, small ones keep progress and rate
+    # limiting smooth on slow links.
+
+    def __init__(self, size, minimum = 65536, maximum = 2097152, target = 0.25, adaptive = True):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.size = max(self.minimum, min(self.maximum, size))
+        self.target = target
+        self.adaptive = adaptive
+
+    def update(self, got, asked, elapsed):
+        if not self.adaptive or got < asked:
+            return # Short reads mean we hit the end - they don't say anything about the link
+        if elapsed < self.target/2:
+            self.size = min(self.maximum, self.size*2)
+        elif elapsed > self.target*2:
+            self.size = max(self.minimum, self.size//2)
 
 class Downloader:
 
     def __init__(self,**kwargs):
         self.ua = kwargs.get("useragent",{"User-Agent":"Mozilla"})
         self.chunk = 1048576 # 1024 x 1024 i.e. 1MiB
+        # Number of simultaneous connections stream_to_file() can use when the
+        # server supports byte ranges - 1 keeps the classic single stream
+        self.connections = max(1, int(kwargs.get("connections",1)))
+        # Keep interrupted downloads as file.part + file.part.json and pick them
+        # back up on the next stream_to_file() call for the same url
+        self.resume = kwargs.get("resume",True)
         if os.name=="nt": os.system("color") # Initialize cmd for ANSI escapes
-        # Provide reasonable default logic to workaround macOS CA file handling 
-        cafile = ssl.get_default_verify_paths().openssl_cafile
-        try:
-            # If default OpenSSL CA file does not exist, use that from certifi
-            if not os.path.exists(cafile):
-                import certifi
-                cafile = certifi.where()
-            self.ssl_context = ssl.create_default_context(cafile=cafile)
-        except:
-            # None of the above worked, disable certificate verification for now
-            self.ssl_context = ssl._create_unverified_context()
+        self.ssl_context = _get_ssl_context()
+        # Reuse connections per host unless asked not to
+        self.pool = None
+        if kwargs.get("keep_alive",True):
+            self.pool = kwargs.get("pool") or ConnectionPool(
+                self.ssl_context,
+                max_per_host=kwargs.get("max_per_host",max(4,self.connections)),
+                idle_timeout=kwargs.get("idle_timeout",30)
+            )
+        self.max_redirects = 10
+        # Throughput caps in bytes/sec - max_rate is shared by every transfer this
+        # Downloader makes, download_rate applies to each download on its own
+        max_rate = kwargs.get("max_rate")
+        self.limiter = RateLimiter(max_rate) if max_rate else None
+        self.download_rate = kwargs.get("download_rate")
+        # Grow or shrink reads based on how fast they come back, between min_chunk and max_chunk
+        self.adaptive_chunk = kwargs.get("adaptive_chunk",True)
+        self.min_chunk = kwargs.get("min_chunk",65536)
+        # Reads past ~2MiB measured slower than 1MiB ones, so don't grow beyond that by default
+        self.max_chunk = kwargs.get("max_chunk",2097152)
         return
 
+    def _get_limiters(self, download_rate = None):
+        # Returns the rate limiters a new transfer has to honor
+        download_rate = self.download_rate if download_rate is None else download_rate
+        limiters = [self.limiter] if self.limiter else []
+        if download_rate:
+            limiters.append(RateLimiter(download_rate))
+        return limiters
+
+    def _get_sizer(self, limiters = None):
+        # Never read more at once than the tightest bucket can hold, or the cap gets lumpy
+        maximum = self.max_chunk
+        for limiter in limiters or []:
+            maximum = min(maximum, int(limiter.burst))
+        return ChunkSizer(min(self.chunk, maximum), min(self.min_chunk, maximum), maximum, adaptive=self.adaptive_chunk)
+
+    def _read_chunk(self, response, sizer, limiters, limit = None):
+        # One timed read - feeds the sizer, then waits on the rate limiters
+        size = sizer.size if limit is None else min(sizer.size, limit)
+        start = _clock()
+        chunk = response.read(size)
+        sizer.update(len(chunk), size, _clock()-start)
+        for limiter in limiters:
+            limiter.consume(len(chunk))
+        return chunk
+
     def _decode(self, value, encoding="utf-8", errors="ignore"):
         # Helper method to only decode if bytes type
         if sys.version_info >= (3,0) and isinstance(value, bytes):
             return value.decode(encoding,errors)
         return value
 
+    def _use_proxy(self, scheme, host):
+        # Let urllib deal with anything that needs to go through a proxy
+        try: return scheme in getproxies() and not proxy_bypass(host)
+        except: return False
+
+    def _open_pooled(self, url, headers):
+        for x in range(self.max_redirects+1):
+            parts = urlsplit(url)
+            scheme = parts.scheme.lower()
+            if not scheme in ("http","https") or self._use_proxy(scheme, parts.hostname):
+                return urlopen(Request(url, headers=headers), context=self.ssl_context)
+            port = parts.port or (443 if scheme == "https" else 80)
+            path = (parts.path or "/") + ("?"+parts.query if parts.query else "")
+            while True:
+                conn, reused = self.pool.get(scheme, parts.hostname, port)
+                try:
+                    conn.request("GET", path, headers=headers)
+                    response = conn.getresponse()
+                    break
+                except Exception:
+                    conn.close()
+                    # A reused connection may have been dropped by the server while it sat
+                    # in the pool - retry on a fresh one, otherwise it's a real failure
+                    if not reused: raise
+            response = _PooledResponse(response, self.pool, (scheme, parts.hostname, port), conn)
+            if response.status in (301, 302, 303, 307, 308) and response.headers.get("Location"):
+                # Follow the redirect like urlopen() would
+                response.read()
+                response.close()
+                url = urljoin(url, response.headers["Location"])
+                continue
+            if response.status >= 400:
+                response.close()
+                raise Exception("HTTP Error {}".format(response.status))
+            return response
+        raise Exception("Too many redirects")
+
     def open_url(self, url, headers = None):
         # Fall back on the default ua if none provided
         headers = self.ua if headers is None else headers
         # Wrap up the try/except block so we don't have to do this for each function
         try:
-            response = urlopen(Request(url, headers=headers), context=self.ssl_context)
+            if self.pool:
+                response = self._open_pooled(url, headers)
+            else:
+                response = urlopen(Request(url, headers=headers), context=self.ssl_context)
+        except HTTPError as e:
+            # urllib raises on a 304 - but to a conditional GET that's a real answer,
+            # and the error doubles as the response (getcode(), headers, close())
+            if e.code == 304:
+                return e
+            return None
         except Exception as e:
             # No fixing this - bail
             return None
@@ -95,42 +336,328 @@ class Downloader:
         if response is None: return None
         return self._decode(response)
 
-    def get_bytes(self, url, progress = True, headers = None, expand_gzip = True):
-        response = self.open_url(url, headers)
-        if response is None: return None
+    def _iter_response(self, response, progress = True, expand_gzip = True, download_rate = None):
+        # Yields the body one chunk at a time - gzip content is inflated as it
+        # arrives so we never hold the whole compressed body in memory
+        limiters = self._get_limiters(download_rate)
+        sizer = self._get_sizer(limiters)
         bytes_so_far = 0
         try: total_size = int(response.headers['Content-Length'])
         except: total_size = -1
-        chunk_so_far = b""
+        inflater = None
+        if expand_gzip and response.headers.get("Content-Encoding","unknown").lower() == "gzip":
+            # 16 + MAX_WBITS tells zlib to expect a gzip header and trailer
+            inflater = zlib.decompressobj(16+zlib.MAX_WBITS)
         while True:
-            chunk = response.read(self.chunk)
+            chunk = self._read_chunk(response, sizer, limiters)
             bytes_so_far += len(chunk)
             if progress: self._progress_hook(bytes_so_far,total_size)
             if not chunk: break
-            chunk_so_far += chunk
-        if expand_gzip and response.headers.get("Content-Encoding","unknown").lower() == "gzip":
-            fileobj = BytesIO(chunk_so_far)
-            gfile   = gzip.GzipFile(fileobj=fileobj)
-            return gfile.read()
+            if inflater:
+                chunk = inflater.decompress(chunk)
+                while inflater.unused_data:
+                    # Another gzip member follows - start a fresh inflater on the leftovers
+                    leftover = inflater.unused_data
+                    inflater = zlib.decompressobj(16+zlib.MAX_WBITS)
+                    chunk += inflater.decompress(leftover)
+            if chunk: yield chunk
+        if inflater:
+            chunk = inflater.flush()
+            if chunk: yield chunk
         if progress: print("") # Add a newline so our last progress prints completely
-        return chunk_so_far
 
-    def stream_to_file(self, url, file_path, progress = True, headers = None, ensure_size_if_present = True):
+    def iter_bytes(self, url, progress = True, headers = None, expand_gzip = True):
+        # Returns a generator over the (optionally inflated) body, or None if the url
+        # couldn't be opened - lets callers process large bodies piece by piece
         response = self.open_url(url, headers)
         if response is None: return None
-        bytes_so_far = 0
-        try: total_size = int(response.headers['Content-Length'])
-        except: total_size = -1
-        with open(file_path, 'wb') as f:
-            while True:
-                chunk = response.read(self.chunk)
-                bytes_so_far += len(chunk)
-                if progress: self._progress_hook(bytes_so_far,total_size)
+        return self._iter_response(response, progress, expand_gzip)
+
+    def read_response(self, response, progress = True, expand_gzip = True):
+        # Reads the rest of an already opened response - for callers that need
+        # to look at the status or headers first
+        return b"".join(self._iter_response(response, progress, expand_gzip))
+
+    def get_bytes(self, url, progress = True, headers = None, expand_gzip = True):
+        response = self.open_url(url, headers)
+        if response is None: return None
+        return self.read_response(response, progress, expand_gzip)
+
+    def _supports_ranges(self, response):
+        # Only split the download if the server advertises byte ranges and a size
+        try: total_size = int(response.headers["Content-Length"])
+        except: return False
+        return total_size > 0 and response.headers.get("Accept-Ranges","none").lower() == "bytes"
+
+    def _get_ranges(self, total_size, connections, missing = None):
+        # Break the file into ~4 ranges per connection so faster connections can pick
+        # up the slack from slower ones - but never make a range smaller than a chunk
+        part = max(self.chunk, -(-total_size // (connections*4)))
+        missing = [(0, total_size-1)] if missing is None else missing
+        ranges = []
+        for first, last in missing:
+            ranges.extend((start, min(start+part-1, last)) for start in range(first, last+1, part))
+        return ranges
+
+    def _get_missing(self, completed, total_size):
+        # Walk the completed [start, end] ranges and return the gaps between them
+        missing, pos = [], 0
+        for start, end in sorted(completed):
+            if start > pos: missing.append((pos, start-1))
+            pos = max(pos, end+1)
+        if total_size < 0 or pos < total_size:
+            missing.append((pos, total_size-1))
+        return missing
+
+    def _get_validators(self, response):
+        return {
+            "etag"          : response.headers.get("ETag"),
+            "last_modified" : response.headers.get("Last-Modified")
+        }
+
+    def _check_validators(self, part_info, response):
+        # Make sure the remote file is the same one we started with - if the
+        # server gives us nothing to compare, we have to assume it changed
+        v = self._get_validators(response)
+        if part_info.get("etag") and v["etag"]:
+            return part_info["etag"] == v["etag"]
+        if part_info.get("last_modified") and v["last_modified"]:
+            return part_info["last_modified"] == v["last_modified"]
+        return False
+
+    def _get_content_range_size(self, response):
+        # Content-Range: bytes start-end/total
+        try: return int(response.headers["Content-Range"].split("/")[-1])
+        except: return -1
+
+    def _load_part_info(self, url, part_path):
+        # Returns the sidecar info for a previous partial download of url, if any
+        if not os.path.exists(part_path) or not os.path.exists(part_path+".json"):
+            return None
+        try:
+            with open(part_path+".json") as f:
+                part_info = json.load(f)
+        except:
+            return None
+        if part_info.get("url") != url or not part_info.get("completed"):
+            return None
+        if not part_info.get("etag") and not part_info.get("last_modified"):
+            return None # Nothing to validate against - can't trust the prefix
+        return part_info
+
+    def _save_part_info(self, part_path, part_info):
+        part_info["bytes_written"] = sum(end-start+1 for start, end in part_info["completed"])
+        temp_path = part_path+".json.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(part_info, f)
+        if os.path.exists(part_path+".json") and os.name == "nt":
+            os.remove(part_path+".json") # Windows won't rename over an existing file
+        os.rename(temp_path, part_path+".json")
+
+    def _remove_part(self, part_path):
+        for path in (part_path, part_path+".json", part_path+".json.tmp"):
+            if os.path.exists(path): os.remove(path)
+
+    def _finish_part(self, part_path, file_path):
+        # Move the completed .part into place and drop the sidecar
+        if os.path.exists(file_path): os.remove(file_path)
+        os.rename(part_path, file_path)
+        self._remove_part(part_path)
+        return file_path if os.path.exists(file_path) else None
+
+    def _write_at(self, f, data, offset, lock):
+        # Positional write - os.pwrite() lets threads write without sharing the file position
+        if hasattr(os, "pwrite"):
+            os.pwrite(f.fileno(), data, offset)
+            return
+        with lock:
+            f.seek(offset)
+            f.write(data)
+
+    def _stream_ranges(self, url, headers, f, state):
+        # Worker thread - pull ranges off the shared list until it's empty or something failed
+        while True:
+            with state["lock"]:
+                if state["failed"] or not state["ranges"]: return
+                start, end = state["ranges"].pop(0)
+            range_headers = dict(headers)
+            range_headers["Range"] = "bytes={}-{}".format(start, end)
+            response = self.open_url(url, range_headers)
+            if response is None:
+                state["failed"] = True
+                return
+            offset = start
+            try:
+                # Anything other than 206 Partial Content means the range was ignored
+                if response.getcode() != 206:
+                    state["failed"] = True
+                    return
+                sizer = self._get_sizer(state["limiters"])
+                while offset <= end and not state["failed"]:
+                    chunk = self._read_chunk(response, sizer, state["limiters"], end-offset+1)
+                    if not chunk: break
+                    self._write_at(f, chunk, offset, state["write_lock"])
+                    offset += len(chunk)
+                    with state["lock"]:
+                        state["bytes_so_far"] += len(chunk)
+                        if state["progress"]: self._progress_hook(state["bytes_so_far"],state["total_size"])
+            except Exception as e:
+                # Keep the first error for _stream_parallel() to raise once every thread is done
+                with state["lock"]:
+                    state["failed"] = True
+                    if state["error"] is None: state["error"] = e
+                return
+            finally:
+                response.close()
+            if offset != end+1:
+                # Came up short - no point in continuing
+                state["failed"] = True
+                return
+            if state["part_info"] is not None:
+                # Record the finished range so a retry can skip it
+                with state["lock"]:
+                    f.flush()
+                    state["part_info"]["completed"].append([start, end])
+                    try: self._save_part_info(state["part_path"], state["part_info"])
+                    except: pass
+
+    def _stream_parallel(self, url, part_path, total_size, connections, progress = True, headers = None, part_info = None, limiters = None):
+        headers = self.ua if headers is None else headers
+        completed = part_info["completed"] if part_info else []
+        state = {
+            "ranges"       : self._get_ranges(total_size, connections, self._get_missing(completed, total_size)),
+            "bytes_so_far" : total_size - sum(end-start+1 for start, end in self._get_missing(completed, total_size)),
+            "total_size"   : total_size,
+            "progress"     : progress,
+            "failed"       : False,
+            "error"        : None,
+            "part_info"    : part_info,
+            "part_path"    : part_path,
+            "limiters"     : limiters or [], # Shared by every range so the caps cover the whole download
+            "lock"         : threading.Lock(),
+            "write_lock"   : threading.Lock()
+        }
+        with open(part_path, "r+b" if completed else "wb") as f:
+            # Preallocate so each range can be written in place
+            f.truncate(total_size)
+            threads = []
+            for x in range(min(connections, len(state["ranges"]))):
+                t = threading.Thread(target=self._stream_ranges, args=(url, headers, f, state))
+                t.daemon = True
+                t.start()
+                threads.append(t)
+            for t in threads:
+                t.join()
+        if progress: print("") # Add a newline so our last progress prints completely
+        if state["error"] is not None: raise state["error"]
+        return not state["failed"] and state["bytes_so_far"] == total_size
+
+    def _open_for_resume(self, url, headers, part_info):
+        # Ask for everything past the contiguous prefix we already have - If-Range makes
+        # the server send the whole file instead if it changed since we started
+        prefix = self._get_missing(part_info["completed"], part_info.get("total_size",-1))[0][0]
+        range_headers = dict(self.ua if headers is None else headers)
+        range_headers["Range"] = "bytes={}-".format(prefix)
+        range_headers["If-Range"] = part_info.get("etag") or part_info.get("last_modified")
+        return (self.open_url(url, range_headers), prefix)
+
+    def _hash_file(self, file_path, hasher, length = -1):
+        # Feeds the first length bytes (or all of them) of file_path to hasher
+        with open(file_path, "rb") as f:
+            while length != 0:
+                chunk = f.read(self.chunk if length < 0 else min(self.chunk, length))
                 if not chunk: break
-                f.write(chunk)
+                hasher.update(chunk)
+                if length > 0: length -= len(chunk)
+
+    def stream_to_file(self, url, file_path, progress = True, headers = None, ensure_size_if_present = True, connections = None, resume = None, hasher = None, download_rate = None):
+        # hasher is an optional, fresh hashlib object that gets fed the file's contents
+        # as they stream in - saves reading the whole thing back to checksum it
+        limiters = self._get_limiters(download_rate)
+        connections = self.connections if connections is None else max(1, int(connections))
+        resume = self.resume if resume is None else resume
+        part_path = file_path + ".part"
+        part_info = self._load_part_info(url, part_path) if resume else None
+        response = None
+        bytes_so_far = 0
+        if part_info and part_info.get("total_size",-1) > 0 and not self._get_missing(part_info["completed"], part_info["total_size"]):
+            # Everything made it to disk last time - we just never got to move it into place
+            if hasher is not None: self._hash_file(part_path, hasher)
+            return self._finish_part(part_path, file_path)
+        if part_info:
+            response, bytes_so_far = self._open_for_resume(url, headers, part_info)
+            if response is not None and response.getcode() == 206:
+                # Partial content - double check it's the same file and size we started with
+                if not self._check_validators(part_info, response) or \
+                self._get_content_range_size(response) != part_info.get("total_size",-1):
+                    response.close()
+                    response = None
+            elif response is not None:
+                # The server sent the whole file - start fresh with it
+                bytes_so_far = 0
+            if response is None or bytes_so_far == 0:
+                part_info = None
+        if response is None:
+            bytes_so_far = 0
+            response = self.open_url(url, headers)
+        if response is None: return None
+        if not part_info:
+            # Starting over - toss any stale partial download
+            self._remove_part(part_path)
+        if response.getcode() == 206:
+            total_size = part_info["total_size"]
+        else:
+            try: total_size = int(response.headers['Content-Length'])
+            except: total_size = -1
+        if resume and not part_info:
+            part_info = self._get_validators(response)
+            part_info.update({"url":url,"total_size":total_size,"completed":[]})
+            if not part_info["etag"] and not part_info["last_modified"]:
+                part_info = None # Nothing to validate a resume against - don't bother
+        if connections > 1 and total_size > self.chunk and (response.getcode() == 206 or self._supports_ranges(response)):
+            # We can split this up - drop the probe response and fetch the ranges in parallel
+            response.close()
+            try:
+                done = self._stream_parallel(url, part_path, total_size, connections, progress, headers, part_info, limiters)
+            except Exception:
+                if not part_info: self._remove_part(part_path)
+                raise
+            if not done:
+                if not part_info: self._remove_part(part_path)
+                return None # Something went wrong - imply it failed
+            # Ranges land out of order, so this is the one case where we hash after the fact
+            if hasher is not None: self._hash_file(part_path, hasher)
+            return self._finish_part(part_path, file_path)
+        if hasher is not None and bytes_so_far:
+            # Resuming - catch the hasher up on the prefix we already have
+            self._hash_file(part_path, hasher, bytes_so_far)
+        with open(part_path, 'r+b' if bytes_so_far else 'wb') as f:
+            f.seek(bytes_so_far)
+            f.truncate()
+            sizer = self._get_sizer(limiters)
+            try:
+                while True:
+                    chunk = self._read_chunk(response, sizer, limiters)
+                    bytes_so_far += len(chunk)
+                    if progress: self._progress_hook(bytes_so_far,total_size)
+                    if not chunk: break
+                    f.write(chunk)
+                    if hasher is not None: hasher.update(chunk)
+                    if part_info:
+                        # Keep the sidecar in step with what's actually on disk
+                        f.flush()
+                        part_info["completed"] = [[0, bytes_so_far-1]]
+                        self._save_part_info(part_path, part_info)
+            except:
+                # Dropped mid-transfer - leave the .part around to resume from
+                if progress: print("")
+                if not part_info: self._remove_part(part_path)
+                return None
         if progress: print("") # Add a newline so our last progress prints completely
         if ensure_size_if_present and total_size != -1:
             # We're verifying size - make sure we got what we asked for
             if bytes_so_far != total_size:
+                if bytes_so_far > total_size or not part_info:
+                    self._remove_part(part_path) # Nothing worth resuming from
                 return None # We didn't - imply it failed
-        return file_path if os.path.exists(file_path) else None
+        return self._finish_part(part_path, file_path)
@@ -0,0 +1,105 @@
+import sys, os, json, subprocess, threading
+
+# One long-lived privileged child for a whole session - this file run as
+# "sudo python elevated.py --serve".  It reads one JSON request per line on stdin
+# and answers each with a JSON (stdout, stderr, returncode) line - "run" requests
+# add a fourth item with run.Result's stats - or null if it can't do the request.
+# That way a batch of privileged steps costs a single elevation instead of one
+# per command.  Requests carry the caller's working directory, as the child can't
+# follow our os.chdir() calls.
+#
+#   {"op":"file", "args":["chown", "0:0", "Info.plist"], "cwd":"/tmp/x"}
+#   {"op":"run",  "args":["kextcache", "-i", "/"], "shell":false, "timeout":600, "cwd":"/tmp/x"}
+
+class ElevatedWorker:
+
+    def __init__(self, elevate):
+        # elevate is a callable returning the path to sudo (or whatever stands in
+        # for it) - or None if we can't elevate.  Only called on the first request.
+        self._elevate = elevate
+        self._proc = None
+        self._failed = False
+        self._lock = threading.Lock()
+
+    def _start(self):
+        elevate = self._elevate()
+        if not elevate:
+            return None
+        return subprocess.Popen(
+            [elevate, sys.executable, os.path.abspath(__file__), "--serve"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True
+        )
+
+    def request(self, op, args, **kwargs):
+        # Returns the worker's (stdout, stderr, returncode[, stats]) - or None if it can't
+        # help, in which case the caller should elevate the command itself
+        kwargs.update({"op":op, "args":args, "cwd":os.getcwd()})
+        # One request/response at a time - Run.run may call us from several threads
+        with self._lock:
+            if self._failed:
+                return None
+            try:
+                if self._proc is None:
+                    self._proc = self._start()
+                    if self._proc is None:
+                        raise OSError("Can't elevate")
+                self._proc.stdin.write(json.dumps(kwargs) + "\n")
+                self._proc.stdin.flush()
+                line = self._proc.stdout.readline()
+                if not line:
+                    raise OSError("Elevated worker exited")
+                out = json.loads(line)
+            except (OSError, IOError, ValueError):
+                # Don't keep trying - everything falls back on plain sudo from here
+                self._failed = True
+                self._close()
+                return None
+        if out is None:
+            return None
+        # json hands back unicode on Python 2 - keep the str the real commands give
+        return tuple(x.encode("utf-8") if isinstance(x, type(u"")) and not isinstance(x, str) else x for x in out)
+
+    def _close(self):
+        if self._proc is None:
+            return
+        try:
+            self._proc.stdin.close()
+            self._proc.wait()
+        except:
+            pass
+        self._proc = None
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+def serve(stdin = None, stdout = None):
+    # The privileged side - runs until stdin closes
+    import fileops, run
+    stdin = stdin or sys.stdin
+    stdout = stdout or sys.stdout
+    files = fileops.FileOps()
+    # Our stdin is the request pipe - commands mustn't read (or wait on) it
+    devnull = getattr(subprocess, "DEVNULL", None)
+    if devnull is None:
+        devnull = open(os.devnull, "rb")
+    r = run.Run(stdin=devnull)
+    for line in iter(stdin.readline, ""):
+        try:
+            request = json.loads(line)
+            os.chdir(request.get("cwd") or os.getcwd())
+            if request["op"] == "file":
+                out = files.run(request["args"])
+            elif request["op"] == "run":
+                out = r._run_command(request["args"], request.get("shell", False), request.get("timeout"))
+                out = list(out) + [out.stats()]
+            else:
+                out = None
+        except Exception as e:
+            out = ("", "{}\n".format(e), 1)
+        stdout.write(json.dumps(out) + "\n")
+        stdout.flush()
+
+if __name__ == '__main__':
+    if "--serve" in sys.argv[1:]:
+        serve()
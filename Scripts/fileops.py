@@ -0,0 +1,204 @@
+import os, errno, shutil
+try:
+    import pwd, grp
+except ImportError:
+    pwd = grp = None # Windows
+
+# In-process stand-ins for the handful of coreutils Run.run gets asked for - cp, mv,
+# rm, mkdir, chown and chmod - done with os/shutil and returning the same
+# (stdout, stderr, returncode) tuples the real commands would.  Anything we don't
+# understand (unknown flags, symbolic modes, etc) comes back as None so the caller
+# can spawn the real thing instead.  Operations that need root go to the
+# elevated.ElevatedWorker we're given, so a whole batch costs a single sudo.
+
+class FileOps:
+
+    def __init__(self, worker = None):
+        # worker is the elevated.ElevatedWorker that runs our privileged operations
+        self.worker = worker
+        self.commands = {
+            "cp"    : (self.cp,    "fpRr"),
+            "mv"    : (self.mv,    "f"),
+            "rm"    : (self.rm,    "fRr"),
+            "mkdir" : (self.mkdir, "p"),
+            "chown" : (self.chown, "R"),
+            "chmod" : (self.chmod, "R"),
+        }
+
+    def _parse(self, args):
+        # Splits ["rm", "-rf", "x"] into ("rm", set("rf"), ["x"]) - or None if
+        # there's a flag we don't handle
+        name, allowed = args[0], self.commands[args[0]][1]
+        flags = set()
+        operands = []
+        for i, arg in enumerate(args[1:], 1):
+            if arg == "--":
+                operands.extend(args[i+1:])
+                break
+            if arg.startswith("-") and len(arg) > 1 and not operands:
+                for c in arg[1:]:
+                    if not c in allowed: return None
+                    flags.add(c)
+                continue
+            operands.append(arg)
+        return (name, flags, operands)
+
+    def run(self, args, sudo = False):
+        # Returns (stdout, stderr, returncode) - or None if args isn't something we do
+        if not isinstance(args, list) or not args or not args[0] in self.commands:
+            return None
+        parsed = self._parse(args)
+        if parsed is None:
+            return None
+        if sudo and hasattr(os, "geteuid") and os.geteuid() != 0:
+            return self.worker.request("file", args) if self.worker else None
+        name, flags, operands = parsed
+        errors = []
+        try:
+            self.commands[name][0](flags, operands, errors)
+        except _Unsupported:
+            return None
+        return self._result(errors)
+
+    def _result(self, errors):
+        return ("", "".join(x + "\n" for x in errors), 1 if errors else 0)
+
+    def _error(self, errors, name, path, e):
+        errors.append("{}: {}: {}".format(name, path, getattr(e, "strerror", None) or str(e)))
+
+    def cp(self, flags, operands, errors):
+        if len(operands) < 2:
+            raise _Unsupported()
+        dest = operands[-1]
+        if len(operands) > 2 and not os.path.isdir(dest):
+            errors.append("cp: {} is not a directory".format(dest))
+            return
+        recursive = "R" in flags or "r" in flags
+        copy = shutil.copy2 if "p" in flags else shutil.copy
+        for source in operands[:-1]:
+            target = os.path.join(dest, os.path.basename(source.rstrip("/"))) if os.path.isdir(dest) else dest
+            try:
+                if os.path.isdir(source) and not os.path.islink(source):
+                    if not recursive:
+                        errors.append("cp: {} is a directory (not copied).".format(source))
+                        continue
+                    shutil.copytree(source, target, symlinks=True)
+                else:
+                    if "f" in flags and os.path.lexists(target) and not os.access(target, os.W_OK):
+                        os.remove(target)
+                    copy(source, target)
+            except (OSError, IOError, shutil.Error) as e:
+                self._error(errors, "cp", source, e)
+
+    def mv(self, flags, operands, errors):
+        if len(operands) < 2:
+            raise _Unsupported()
+        dest = operands[-1]
+        if len(operands) > 2 and not os.path.isdir(dest):
+            errors.append("mv: {} is not a directory".format(dest))
+            return
+        for source in operands[:-1]:
+            target = os.path.join(dest, os.path.basename(source.rstrip("/"))) if os.path.isdir(dest) else dest
+            try:
+                if not os.path.lexists(source):
+                    raise OSError(2, "No such file or directory")
+                try:
+                    os.rename(source, target)
+                except OSError as e:
+                    if e.errno != errno.EXDEV:
+                        raise
+                    # Different filesystem - copy then remove
+                    shutil.move(source, target)
+            except (OSError, IOError, shutil.Error) as e:
+                self._error(errors, "mv", source, e)
+
+    def rm(self, flags, operands, errors):
+        recursive = "R" in flags or "r" in flags
+        force = "f" in flags
+        if not operands and not force:
+            raise _Unsupported()
+        for path in operands:
+            try:
+                if not os.path.lexists(path):
+                    if not force:
+                        errors.append("rm: {}: No such file or directory".format(path))
+                    continue
+                if os.path.isdir(path) and not os.path.islink(path):
+                    if not recursive:
+                        errors.append("rm: {}: is a directory".format(path))
+                        continue
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            except (OSError, IOError) as e:
+                self._error(errors, "rm", path, e)
+
+    def mkdir(self, flags, operands, errors):
+        if not operands:
+            raise _Unsupported()
+        for path in operands:
+            try:
+                if "p" in flags:
+                    if not os.path.isdir(path):
+                        os.makedirs(path)
+                else:
+                    os.mkdir(path)
+            except (OSError, IOError) as e:
+                self._error(errors, "mkdir", path, e)
+
+    def _walk(self, path, recursive):
+        # path, then (with -R) everything under it without following symlinks
+        yield path
+        if not recursive or os.path.islink(path) or not os.path.isdir(path):
+            return
+        for root, dirs, files in os.walk(path):
+            for name in dirs + files:
+                yield os.path.join(root, name)
+
+    def _owner(self, spec):
+        # "user:group", "user", ":group" - names or ids - to (uid, gid)
+        user, _, group = spec.partition(":")
+        def lookup(value, db, attr):
+            if not value: return -1
+            if value.isdigit(): return int(value)
+            if db is None: raise _Unsupported()
+            try: return getattr(db(value), attr)
+            except KeyError: raise _Unsupported() # Let the real chown explain it
+        return (lookup(user, pwd and pwd.getpwnam, "pw_uid"), lookup(group, grp and grp.getgrnam, "gr_gid"))
+
+    def chown(self, flags, operands, errors):
+        if len(operands) < 2 or not hasattr(os, "chown"):
+            raise _Unsupported()
+        uid, gid = self._owner(operands[0])
+        for path in operands[1:]:
+            try:
+                if not os.path.lexists(path):
+                    raise OSError(2, "No such file or directory")
+                for item in self._walk(path, "R" in flags):
+                    if item != path and os.path.islink(item):
+                        if hasattr(os, "lchown"): os.lchown(item, uid, gid)
+                        continue
+                    os.chown(item, uid, gid)
+            except (OSError, IOError) as e:
+                self._error(errors, "chown", path, e)
+
+    def chmod(self, flags, operands, errors):
+        if len(operands) < 2:
+            raise _Unsupported()
+        try:
+            mode = int(operands[0], 8)
+        except ValueError:
+            raise _Unsupported() # Symbolic modes are left to the real chmod
+        for path in operands[1:]:
+            try:
+                if not os.path.lexists(path):
+                    raise OSError(2, "No such file or directory")
+                for item in self._walk(path, "R" in flags):
+                    if item != path and os.path.islink(item):
+                        continue
+                    os.chmod(item, mode)
+            except (OSError, IOError) as e:
+                self._error(errors, "chmod", path, e)
+
+class _Unsupported(Exception):
+    pass
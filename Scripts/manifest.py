@@ -0,0 +1,114 @@
+import re, bisect
+
+alpha = "abcdefghijklmnopqrstuvwxyz"
+
+def get_os(build_number):
+    # Returns the best-guess OS version for the build number
+    os_version = "Unknown"
+    major = minor = ""
+    try:
+        # Formula looks like this:  AAB; AA - 4 = 10.## version
+        # B index in "ABCDEFGHIJKLMNOPQRSTUVXYZ" = 10.##.## version
+        split = re.findall(r"[^\W\d_]+|\d+", build_number)
+        major = int(split[0])-4
+        minor = alpha.index(split[1].lower())
+        os_version = "10.{}.{}".format(major, minor)
+    except:
+        pass
+    return os_version
+
+def get_value(build_number):
+    # Split them up
+    split = re.findall(r"[^\W\d_]+|\d+", build_number)
+    start = split[0].rjust(4, "0")
+    alph  = split[1]
+    end   = split[2].rjust(6, "0")
+    alpha_num = str(alpha.index(alph.lower())).rjust(2, "0")
+    return int(start + alpha_num + end)
+
+class Manifest:
+    # Lookup tables over the manifest's "updates" list - built once when the
+    # manifest is loaded so the menus never have to walk the whole list:
+    #
+    # _by_build    - lower-cased build number -> update (first entry wins)
+    # _values      - sorted get_value() keys for range and nearest-build queries
+    # _os_versions - sorted 10.x.y versions (with _os_positions) for prefix searches
+
+    def __init__(self, web_drivers = None):
+        self.updates = []
+        if isinstance(web_drivers, dict):
+            self.updates = [x for x in web_drivers.get("updates", []) if isinstance(x, dict) and "OS" in x]
+        self._by_build = {}
+        values = []
+        os_index = []
+        for index, update in enumerate(self.updates):
+            build = update["OS"]
+            os_index.append((get_os(build), index))
+            key = build.lower()
+            if key in self._by_build:
+                continue
+            self._by_build[key] = update
+            try:
+                values.append((get_value(build), index))
+            except:
+                pass # Not something we can place numerically
+        values.sort()
+        os_index.sort()
+        self._values = [x[0] for x in values]
+        self._value_updates = [self.updates[x[1]] for x in values]
+        self._os_versions = [x[0] for x in os_index]
+        self._os_positions = [x[1] for x in os_index]
+
+    def __len__(self):
+        return len(self.updates)
+
+    def __contains__(self, build):
+        return build.lower() in self._by_build
+
+    def get(self, build, default = None):
+        # Case-insensitive exact match on the build number
+        return self._by_build.get(build.lower(), default)
+
+    def builds(self):
+        # Build numbers in manifest order
+        return [x["OS"] for x in self.updates]
+
+    def sorted_builds(self):
+        # Build numbers ordered by get_value() - unparseable builds are left out
+        return [x["OS"] for x in self._value_updates]
+
+    def search_os(self, prefix):
+        # All updates whose derived 10.x.y version starts with prefix - in manifest order
+        start = bisect.bisect_left(self._os_versions, prefix)
+        positions = []
+        for i in range(start, len(self._os_versions)):
+            if not self._os_versions[i].startswith(prefix):
+                break
+            positions.append(self._os_positions[i])
+        return [self.updates[x] for x in sorted(positions)]
+
+    def in_range(self, first_build, last_build):
+        # All updates with first_build <= build <= last_build, ordered by value
+        try:
+            low, high = get_value(first_build), get_value(last_build)
+        except:
+            return []
+        start = bisect.bisect_left(self._values, low)
+        end = bisect.bisect_right(self._values, high)
+        return self._value_updates[start:end]
+
+    def nearest(self, build):
+        # The update closest in value to build - or None if we can't tell
+        try:
+            value = get_value(build)
+        except:
+            return None
+        if not self._values:
+            return None
+        i = bisect.bisect_left(self._values, value)
+        if i == 0:
+            return self._value_updates[0]
+        if i == len(self._values):
+            return self._value_updates[-1]
+        before, after = self._values[i-1], self._values[i]
+        return self._value_updates[i] if after - value < value - before else self._value_updates[i-1]
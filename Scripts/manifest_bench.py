@@ -0,0 +1,104 @@
+import sys, time, random, argparse, gc, manifest
+
+# Benchmarks manifest.Manifest's lookups against the linear scans WebDriver used to
+# do over the manifest's "updates" list, on a synthetic manifest (100k entries by
+# default).  Every indexed answer is checked against the linear one first.  in_range
+# and nearest had no linear version before - theirs here are the obvious filter and
+# min() over get_value().
+#
+#   python manifest_bench.py --entries 100000 --queries 10000
+
+def synthetic(entries, seed):
+    # Unique build numbers shaped like the real ones - 17G65, 16A323 and so on
+    r = random.Random(seed)
+    builds = set()
+    while len(builds) < entries:
+        builds.add("{}{}{}".format(r.randint(12, 18), r.choice("ABCDEFGH"), r.randint(1, 99999)))
+    updates = [{"OS":b, "version":"387.10.10.10.{}".format(i), "downloadURL":"https://example.com/{}.pkg".format(b)} for i, b in enumerate(builds)]
+    r.shuffle(updates)
+    return {"updates":updates}
+
+###            ###
+# Linear Lookups #
+###            ###
+
+def linear_get(updates, build):
+    return next((x for x in updates if x["OS"].lower() == build.lower()), None)
+
+def linear_search_os(updates, prefix):
+    return [x for x in updates if manifest.get_os(x["OS"]).startswith(prefix)]
+
+def linear_in_range(updates, first_build, last_build):
+    low, high = manifest.get_value(first_build), manifest.get_value(last_build)
+    return sorted((x for x in updates if low <= manifest.get_value(x["OS"]) <= high), key=lambda x: manifest.get_value(x["OS"]))
+
+def linear_nearest(updates, build):
+    value = manifest.get_value(build)
+    return min(updates, key=lambda x: abs(manifest.get_value(x["OS"]) - value)) if updates else None
+
+def queries(updates, count, seed):
+    # (op, args) pairs - a mix of hits and misses for each op
+    r = random.Random(seed + 1)
+    builds = [x["OS"] for x in updates]
+    def some_build():
+        return r.choice(builds) if r.random() < 0.8 else "{}{}{}".format(r.randint(12, 18), r.choice("ABCDEFGH"), r.randint(100000, 200000))
+    ops = []
+    for x in range(count):
+        ops.append(("get", (some_build().lower(),)))
+        ops.append(("search_os", ("10.{}.{}".format(r.randint(8, 14), r.randint(0, 7)),)))
+        a, b = sorted((some_build(), some_build()), key=manifest.get_value)
+        ops.append(("in_range", (a, b)))
+        ops.append(("nearest", (some_build(),)))
+    return ops
+
+def same(op, indexed, linear, args):
+    if op == "nearest":
+        # Ties can go either way - the distance is what has to match
+        value = manifest.get_value(args[0])
+        return abs(manifest.get_value(indexed["OS"]) - value) == abs(manifest.get_value(linear["OS"]) - value)
+    return indexed == linear
+
+def timed(func, args):
+    # Returns (results, microseconds per call) - with the collector off, as the big
+    # result lists would otherwise have it walking millions of objects mid-run
+    gc.collect()
+    gc.disable()
+    try:
+        start = time.time()
+        results = [func(*a) for a in args]
+        elapsed = time.time() - start
+    finally:
+        gc.enable()
+    return (results, elapsed / max(1, len(args)) * 1000000)
+
+def bench(entries, count, linear_count, seed):
+    data = synthetic(entries, seed)
+    updates = data["updates"]
+    start = time.time()
+    m = manifest.Manifest(data)
+    print("Indexed {} entries in {:.3f}s\n".format(len(m), time.time() - start))
+    linear = {"get":linear_get, "search_os":linear_search_os, "in_range":linear_in_range, "nearest":linear_nearest}
+    ops = queries(updates, count, seed)
+    print("{:<12} {:>8} {:>12} {:>8} {:>12} {:>10}".format("op", "queries", "indexed us", "queries", "linear us", "speedup"))
+    for name in ("get", "search_os", "in_range", "nearest"):
+        args = [a for op, a in ops if op == name]
+        results, indexed = timed(getattr(m, name), args)
+        checked, slow = timed(lambda *a: linear[name](updates, *a), args[:linear_count])
+        for a, got, want in zip(args, results, checked):
+            if not same(name, got, want, a):
+                raise RuntimeError("{}{} doesn't match the linear scan".format(name, a))
+        results = checked = None
+        print("{:<12} {:>8} {:>12.1f} {:>8} {:>12.1f} {:>9.0f}x".format(name, len(args), indexed, len(args[:linear_count]), slow, slow / indexed))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark manifest.Manifest against linear scans.")
+    parser.add_argument("-e", "--entries", type=int, default=100000, help="updates in the synthetic manifest (default 100000)")
+    parser.add_argument("-q", "--queries", type=int, default=10000, help="indexed queries per op (default 10000)")
+    parser.add_argument("-l", "--linear-queries", type=int, default=20, help="linear queries per op - each walks the whole list (default 20)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the manifest and queries (default 0)")
+    args = parser.parse_args()
+    bench(args.entries, args.queries, args.linear_queries, args.seed)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,8 +2,10 @@
 # Imports #
 ###     ###
 
-import datetime, os, plistlib, struct, sys, itertools, binascii
+import datetime, os, plistlib, struct, sys, itertools, binascii, mmap, re, codecs, threading, array, shutil
+from collections import OrderedDict
 from io import BytesIO
+from xml.parsers.expat import ParserCreate
 
 if sys.version_info < (3,0):
     # Force use of StringIO instead of cStringIO as the latter
@@ -15,9 +17,16 @@ else:
 try:
     basestring  # Python 2
     unicode
+    long
 except NameError:
     basestring = str  # Python 3
     unicode = str
+    long = int
+
+try:
+    from collections.abc import MutableMapping, MutableSequence, Iterator
+except ImportError:
+    from collections import MutableMapping, MutableSequence, Iterator # Python 2
 
 try:
     FMT_XML = plistlib.FMT_XML
@@ -41,6 +50,33 @@ def extract_data(value):
 def _check_py3():
     return sys.version_info >= (3, 0)
 
+def _intern_key(key):
+    # sys.intern() on Python 3 - Python 2 can only intern str, not unicode
+    try:
+        return sys.intern(key) if _check_py3() else intern(key)
+    except TypeError:
+        return key
+
+try:
+    array.array("q")
+    _ARRAY_INT = "q"
+except ValueError:
+    _ARRAY_INT = None # No long long arrays on Python 2
+
+def compact_list(items):
+    # list_type for scalar-only arrays - packs all-int and all-float arrays into
+    # an array.array and freezes anything else into a tuple
+    if items:
+        types = set(type(x) for x in items)
+        if _ARRAY_INT and types <= set((int, long)) and -1 << 63 <= min(items) and max(items) < 1 << 63:
+            return array.array(_ARRAY_INT, items)
+        if types == set((float,)):
+            return array.array("d", items)
+    return tuple(items)
+
+# Preset for large documents - plist.load(f, **plist.COMPACT)
+COMPACT = {"list_type":compact_list, "intern_keys":True}
+
 def _is_binary(fp):
     if isinstance(fp, basestring):
         return fp.startswith(b"bplist00")
@@ -64,6 +100,105 @@ def _seek_past_whitespace(fp):
     fp.seek(offset)
     return offset
 
+def _copy_plist(value):
+    # Copies the dicts and lists of a parsed plist - everything else in there is
+    # immutable (or plistlib.Data, which we treat as such) and can be shared
+    if not isinstance(value, (dict, list)):
+        return value
+    root = value.__class__()
+    stack = [(value, root)]
+    while stack:
+        source, dest = stack.pop()
+        items = source.items() if isinstance(source, dict) else enumerate(source)
+        for key, item in items:
+            if isinstance(item, (dict, list)):
+                copy = item.__class__()
+                stack.append((item, copy))
+                item = copy
+            if isinstance(dest, dict):
+                dest[key] = item
+            else:
+                dest.append(item)
+    return root
+
+###                ###
+# Parsed Plist Cache #
+###                ###
+
+class _PlistCache:
+    # Bounded LRU of parsed plists keyed by (realpath, mtime, size, inode) - so an
+    # edited or replaced file never matches its old entry.  Entries are never handed
+    # out directly; callers get copies so they can't poison the cache.
+
+    def __init__(self, maxsize = 32):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, path, f):
+        # Stat the open file so the key describes what we're actually reading
+        st = os.fstat(f.fileno())
+        return (os.path.realpath(path), getattr(st, "st_mtime_ns", st.st_mtime), st.st_size, st.st_ino)
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.pop(key, _undefined)
+            if value is _undefined:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries[key] = value # Most recently used goes last
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            if self.maxsize <= 0:
+                return
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, path):
+        path = os.path.realpath(path)
+        with self._lock:
+            for key in [x for x in self._entries if x[0] == path]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+_cache = _PlistCache()
+
+def _read_cached(path, f):
+    # Returns the cached parse of path (read from f on a miss) - callers must copy
+    # anything they hand back out
+    key = _cache.key(path, f)
+    value = _cache.get(key)
+    if value is _undefined:
+        value = load(f)
+        _cache.put(key, value)
+    return value
+
+def cache_info():
+    # Hit/miss counters for the parsed plist cache used by readPlist() and get_path()
+    with _cache._lock:
+        return {"hits":_cache.hits,"misses":_cache.misses,"size":len(_cache._entries),"maxsize":_cache.maxsize}
+
+def cache_clear():
+    _cache.clear()
+
+def set_cache_size(maxsize):
+    # 0 turns the cache off
+    with _cache._lock:
+        _cache.maxsize = maxsize
+        while len(_cache._entries) > max(maxsize, 0):
+            _cache._entries.popitem(last=False)
+
 ###                             ###
 # Deprecated Functions - Remapped #
 ###                             ###
@@ -72,125 +207,130 @@ def readPlist(pathOrFile):
     if not isinstance(pathOrFile, basestring):
         return load(pathOrFile)
     with open(pathOrFile, "rb") as f:
-        return load(f)
+        return _copy_plist(_read_cached(pathOrFile, f))
 
 def writePlist(value, pathOrFile):
     if not isinstance(pathOrFile, basestring):
         return dump(value, pathOrFile, fmt=FMT_XML, sort_keys=True, skipkeys=False)
-    with open(pathOrFile, "wb") as f:
-        return dump(value, f, fmt=FMT_XML, sort_keys=True, skipkeys=False)
+    try:
+        with open(pathOrFile, "wb") as f:
+            return dump(value, f, fmt=FMT_XML, sort_keys=True, skipkeys=False)
+    finally:
+        _cache.invalidate(pathOrFile)
+
+def _split_keypath(keypath):
+    if isinstance(keypath, basestring):
+        return [x for x in keypath.split("/") if x]
+    return list(keypath)
+
+def get_path(pathOrFile, keypath, default=None):
+    # Returns the value at keypath - either "a/b/c" or a list of keys, with list
+    # indexes as ints or digit strings - or default if it's not there.  Binary
+    # plists only decode the containers along that path; XML is loaded in full.
+    keypath = _split_keypath(keypath)
+    if isinstance(pathOrFile, basestring):
+        with open(pathOrFile, "rb") as f:
+            if _is_binary(f):
+                return get_path(f, keypath, default)
+            # XML has to be parsed in full - so keep it around for next time
+            value = _read_cached(pathOrFile, f)
+    else:
+        value = load(pathOrFile, lazy=True)
+    try:
+        for key in keypath:
+            if isinstance(value, (list, _LazyList)):
+                key = int(key)
+            value = value[key]
+    except (KeyError, IndexError, ValueError, TypeError):
+        return default
+    return value.materialize() if isinstance(value, (_LazyDict, _LazyList)) else _copy_plist(value)
+
+def patch_value(path, keypath, new_value):
+    # Sets the value at keypath (as in get_path()) in the plist at path, leaving
+    # every other byte of the file alone - XML gets just that element spliced out
+    # and replaced, binary gets the new objects appended and the offset table
+    # rewritten.  A missing last key is added to its dict; anything else missing
+    # raises KeyError.  Anything we can't patch in place (non utf-8 XML, or a binary
+    # plist whose refs would need to grow) is loaded and rewritten in full instead.
+    keypath = _split_keypath(keypath)
+    with open(path, "rb") as f:
+        data = f.read()
+    if data.startswith(b"bplist00"):
+        patched = _patch_binary(data, keypath, new_value)
+        fmt = FMT_BINARY
+    else:
+        patched = _patch_xml(data, keypath, new_value)
+        fmt = FMT_XML
+    if patched is None:
+        value = loads(data)
+        value = _set_path(value, keypath, new_value)
+        out = BytesIO()
+        # Keep the existing key order as best we can
+        dump(value, out, fmt=fmt, sort_keys=False)
+        patched = out.getvalue()
+    # Write to a temp file first so a crash can't leave a half-written plist
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        f.write(patched)
+    try:
+        shutil.copymode(path, temp_path)
+    except OSError:
+        pass
+    if os.name == "nt":
+        os.remove(path) # Windows won't rename over an existing file
+    os.rename(temp_path, path)
+    _cache.invalidate(path)
+
+def _set_path(value, keypath, new_value):
+    # Sets keypath in an already loaded plist - returns the (possibly new) root
+    if not keypath:
+        return new_value
+    parent = value
+    for key in keypath[:-1]:
+        parent = parent[int(key)] if isinstance(parent, list) else parent[key]
+    if isinstance(parent, list):
+        parent[int(keypath[-1])] = new_value
+    elif isinstance(parent, dict):
+        parent[keypath[-1]] = new_value
+    else:
+        raise KeyError("/".join(str(x) for x in keypath))
+    return value
 
 ###                ###
 # Remapped Functions #
 ###                ###
 
-def load(fp, fmt=None, use_builtin_types=None, dict_type=dict):
+def load(fp, fmt=None, use_builtin_types=None, dict_type=dict, zero_copy=False, lazy=False, list_type=list, intern_keys=False):
     if _is_binary(fp):
         use_builtin_types = False if use_builtin_types is None else use_builtin_types
-        try:
-            p = _BinaryPlistParser(use_builtin_types=use_builtin_types, dict_type=dict_type)
-        except:
-            # Python 3.9 removed use_builtin_types
-            p = _BinaryPlistParser(dict_type=dict_type)
-        return p.parse(fp)
-    elif _check_py3():
-        offset = _seek_past_whitespace(fp)
-        use_builtin_types = True if use_builtin_types is None else use_builtin_types
-        # We need to monkey patch this to allow for hex integers - code taken/modified from 
-        # https://github.com/python/cpython/blob/3.8/Lib/plistlib.py
-        if fmt is None:
-            header = fp.read(32)
-            fp.seek(offset)
-            for info in plistlib._FORMATS.values():
-                if info['detect'](header):
-                    P = info['parser']
-                    break
-            else:
-                raise plistlib.InvalidFileException()
-        else:
-            P = plistlib._FORMATS[fmt]['parser']
-        try:
-            p = P(use_builtin_types=use_builtin_types, dict_type=dict_type)
-        except:
-            # Python 3.9 removed use_builtin_types
-            p = P(dict_type=dict_type)
-        if isinstance(p,plistlib._PlistParser):
-            # Monkey patch!
-            def end_integer():
-                d = p.get_data()
-                value = int(d,16) if d.lower().startswith("0x") else int(d)
-                if -1 << 63 <= value < 1 << 64:
-                    p.add_object(value)
-                else:
-                    raise OverflowError("Integer overflow at line {}".format(p.parser.CurrentLineNumber))
-            def end_data():
-                try:
-                    p.add_object(plistlib._decode_base64(p.get_data()))
-                except Exception as e:
-                    raise Exception("Data error at line {}: {}".format(p.parser.CurrentLineNumber,e))
-            p.end_integer = end_integer
-            p.end_data = end_data
+        p = _BinaryPlistParser(use_builtin_types=use_builtin_types, dict_type=dict_type, zero_copy=zero_copy, lazy=lazy,
+                               list_type=list_type, intern_keys=intern_keys)
         return p.parse(fp)
     else:
-        offset = _seek_past_whitespace(fp)
-        # Is not binary - assume a string - and try to load
-        # We avoid using readPlistFromString() as that uses
-        # cStringIO and fails when Unicode strings are detected
-        # Don't subclass - keep the parser local
-        from xml.parsers.expat import ParserCreate
-        # Create a new PlistParser object - then we need to set up
-        # the values and parse.
-        p = plistlib.PlistParser()
-        parser = ParserCreate()
-        parser.StartElementHandler = p.handleBeginElement
-        parser.EndElementHandler = p.handleEndElement
-        parser.CharacterDataHandler = p.handleData
-        # We also need to monkey patch this to allow for other dict_types, hex int support
-        # proper line output for data errors, and for unicode string decoding
-        def begin_dict(attrs):
-            d = dict_type()
-            p.addObject(d)
-            p.stack.append(d)
-        def end_integer():
-            d = p.getData()
-            value = int(d,16) if d.lower().startswith("0x") else int(d)
-            if -1 << 63 <= value < 1 << 64:
-                p.addObject(value)
-            else:
-                raise OverflowError("Integer overflow at line {}".format(parser.CurrentLineNumber))
-        def end_data():
-            try:
-                p.addObject(plistlib.Data.fromBase64(p.getData()))
-            except Exception as e:
-                raise Exception("Data error at line {}: {}".format(parser.CurrentLineNumber,e))
-        def end_string():
-            d = p.getData()
-            if isinstance(d,unicode):
-                d = d.encode("utf-8")
-            p.addObject(d)
-        p.begin_dict = begin_dict
-        p.end_integer = end_integer
-        p.end_data = end_data
-        p.end_string = end_string
         if isinstance(fp, unicode):
             # Encode unicode -> string; use utf-8 for safety
             fp = fp.encode("utf-8")
         if isinstance(fp, basestring):
             # It's a string - let's wrap it up
-            fp = StringIO(fp)
-        # Parse it
-        parser.ParseFile(fp)
-        return p.root
+            fp = BytesIO(fp)
+        offset = _seek_past_whitespace(fp)
+        if fmt is None:
+            header = fp.read(32)
+            fp.seek(offset)
+            if not _is_xml(header):
+                raise InvalidFileException()
+        elif fmt != FMT_XML:
+            raise InvalidFileException()
+        use_builtin_types = True if use_builtin_types is None else use_builtin_types
+        p = _XMLPlistParser(use_builtin_types=use_builtin_types, dict_type=dict_type, list_type=list_type, intern_keys=intern_keys)
+        return p.parse(fp)
 
-def loads(value, fmt=None, use_builtin_types=None, dict_type=dict):
+def loads(value, fmt=None, use_builtin_types=None, dict_type=dict, zero_copy=False, lazy=False, list_type=list, intern_keys=False):
     if _check_py3() and isinstance(value, basestring):
         # If it's a string - encode it
         value = value.encode()
-    try:
-        return load(BytesIO(value),fmt=fmt,use_builtin_types=use_builtin_types,dict_type=dict_type)
-    except:
-        # Python 3.9 removed use_builtin_types
-        return load(BytesIO(value),fmt=fmt,dict_type=dict_type)
+    return load(BytesIO(value),fmt=fmt,use_builtin_types=use_builtin_types,dict_type=dict_type,zero_copy=zero_copy,lazy=lazy,
+                list_type=list_type,intern_keys=intern_keys)
 
 def dump(value, fp, fmt=FMT_XML, sort_keys=True, skipkeys=False):
     if fmt == FMT_BINARY:
@@ -198,30 +338,8 @@ def dump(value, fp, fmt=FMT_XML, sort_keys=True, skipkeys=False):
         writer = _BinaryPlistWriter(fp, sort_keys=sort_keys, skipkeys=skipkeys)
         writer.write(value)
     elif fmt == FMT_XML:
-        if _check_py3():
-            plistlib.dump(value, fp, fmt=fmt, sort_keys=sort_keys, skipkeys=skipkeys)
-        else:
-            # We need to monkey patch a bunch here too in order to avoid auto-sorting
-            # of keys
-            writer = plistlib.PlistWriter(fp)
-            def writeDict(d):
-                if d:
-                    writer.beginElement("dict")
-                    items = sorted(d.items()) if sort_keys else d.items()
-                    for key, value in items:
-                        if not isinstance(key, basestring):
-                            if skipkeys:
-                                continue
-                            raise TypeError("keys must be strings")
-                        writer.simpleElement("key", key)
-                        writer.writeValue(value)
-                    writer.endElement("dict")
-                else:
-                    writer.simpleElement("dict")
-            writer.writeDict = writeDict
-            writer.writeln("<plist version=\"1.0\">")
-            writer.writeValue(value)
-            writer.writeln("</plist>")
+        writer = _XMLPlistWriter(fp, sort_keys=sort_keys, skipkeys=skipkeys)
+        writer.write(value)
     else:
         # Not a proper format
         raise ValueError("Unsupported format: {}".format(fmt))
@@ -232,10 +350,511 @@ def dumps(value, fmt=FMT_XML, skipkeys=False, sort_keys=True):
     f = BytesIO() if _check_py3() else StringIO()
     dump(value, f, fmt=fmt, skipkeys=skipkeys, sort_keys=sort_keys)
     value = f.getvalue()
-    if _check_py3():
+    if _check_py3() and fmt == FMT_XML:
+        # Binary output stays bytes - there's no text to decode
         value = value.decode("utf-8")
     return value
 
+###               ###
+# XML Plist Parsing #
+###               ###
+
+# Taken from the python 3 plistlib.py source - \d\d\d\d-\d\d-\d\dT\d\d:\d\d:\d\dZ with
+# everything after the year optional
+_DATE_RE = re.compile(r"(?P<year>\d\d\d\d)(?:-(?P<month>\d\d)(?:-(?P<day>\d\d)(?:T(?P<hour>\d\d)(?::(?P<minute>\d\d)(?::(?P<second>\d\d))?)?)?)?)?Z")
+
+def _date_from_string(s):
+    order = ('year', 'month', 'day', 'hour', 'minute', 'second')
+    gd = _DATE_RE.match(s).groupdict()
+    lst = []
+    for key in order:
+        val = gd[key]
+        if val is None:
+            break
+        lst.append(int(val))
+    return datetime.datetime(*lst)
+
+def _is_xml(header):
+    # Mirrors plistlib's detection - an optional BOM, then <?xml or <plist
+    for bom, encoding in ((codecs.BOM_UTF8, "utf-8"), (codecs.BOM_UTF16_BE, "utf-16-be"),
+                          (codecs.BOM_UTF16_LE, "utf-16-le"), (codecs.BOM_UTF32_BE, "utf-32-be"),
+                          (codecs.BOM_UTF32_LE, "utf-32-le"), (b"", "utf-8")):
+        if not header.startswith(bom):
+            continue
+        for start in ("<?xml", "<plist"):
+            if header[len(bom):].startswith(start.encode(encoding)):
+                return True
+    return False
+
+class _XMLPlistParser:
+    """
+    Builds the plist straight from expat callbacks - containers are created and
+    filled as their elements open and close, repeated keys share one string, and
+    the file is fed to expat in large buffered reads.  Hex integers are accepted,
+    and value errors report the line they happened on.
+
+    Arrays holding only scalars are passed through list_type once they close, and
+    intern_keys shares key strings across documents too via sys.intern().
+    """
+    def __init__(self, use_builtin_types=True, dict_type=dict, list_type=list, intern_keys=False):
+        self._use_builtin_types = use_builtin_types
+        self._dict_type = dict_type
+        self._list_type = list_type
+        self._intern_keys = intern_keys
+        self._py3 = _check_py3()
+        self._data_class = getattr(plistlib, "Data", None)
+        self._ends = {
+            "key": self._end_key,
+            "string": self._end_string,
+            "integer": self._end_integer,
+            "real": self._end_real,
+            "date": self._end_date,
+            "data": self._end_data,
+            "true": self._end_true,
+            "false": self._end_false,
+            "dict": self._end_dict,
+            "array": self._end_array,
+        }
+
+    def parse(self, fp):
+        self._stack = []
+        self._slots = []
+        self._nested = set()
+        self._key = None
+        self._root = None
+        self._keys = {}
+        self._data = []
+        self._parser = ParserCreate()
+        self._parser.buffer_text = True
+        try:
+            self._parser.buffer_size = 65536
+        except (AttributeError, ValueError):
+            pass
+        self._parser.StartElementHandler = self._start
+        self._parser.EndElementHandler = self._end
+        self._parser.CharacterDataHandler = self._data.append
+        if isinstance(fp, basestring):
+            self._parser.Parse(fp, True)
+        else:
+            self._parser.ParseFile(fp)
+        return self._root
+
+    def _error(self, message):
+        return ValueError("{} at line {}".format(message, self._parser.CurrentLineNumber))
+
+    def _add(self, value):
+        # Returns where value landed as (container, key) - key is None for arrays
+        # and container is None for the root object
+        if self._key is not None:
+            if not isinstance(self._stack[-1], dict):
+                raise self._error("unexpected element")
+            key, self._key = self._key, None
+            self._stack[-1][key] = value
+            return (self._stack[-1], key)
+        elif not self._stack:
+            # this is the root object
+            self._root = value
+            return (None, None)
+        else:
+            if not isinstance(self._stack[-1], list):
+                raise self._error("unexpected element")
+            self._stack[-1].append(value)
+            return (self._stack[-1], None)
+
+    def _get_data(self):
+        data = "".join(self._data)
+        if not self._py3:
+            try:
+                # Python 2's plistlib hands back str for ascii-only text
+                data = data.encode("ascii")
+            except UnicodeError:
+                pass
+        return data
+
+    def _start(self, name, attrs):
+        del self._data[:]
+        if name == "dict":
+            d = self._dict_type()
+            self._note_nested(self._add(d))
+            self._stack.append(d)
+        elif name == "array":
+            a = []
+            slot = self._add(a)
+            self._note_nested(slot)
+            self._slots.append(slot)
+            self._stack.append(a)
+
+    def _note_nested(self, slot):
+        # Remember which arrays hold containers - they never go through list_type
+        parent, key = slot
+        if parent is not None and key is None:
+            self._nested.add(id(parent))
+
+    def _end(self, name):
+        handler = self._ends.get(name)
+        if handler:
+            handler()
+
+    def _end_key(self):
+        if self._key is not None or not self._stack or not isinstance(self._stack[-1], dict):
+            raise self._error("unexpected key")
+        key = self._get_data()
+        # Share one string between every occurrence of the same key
+        self._key = self._keys.get(key)
+        if self._key is None:
+            self._key = self._keys[key] = _intern_key(key) if self._intern_keys else key
+
+    def _end_string(self):
+        data = self._get_data()
+        if not self._py3 and isinstance(data, unicode):
+            data = data.encode("utf-8")
+        self._add(data)
+
+    def _end_integer(self):
+        d = self._get_data()
+        try:
+            value = int(d,16) if d.lower().startswith("0x") else int(d)
+        except ValueError:
+            raise self._error("Invalid integer {!r}".format(d))
+        if -1 << 63 <= value < 1 << 64:
+            self._add(value)
+        else:
+            raise OverflowError("Integer overflow at line {}".format(self._parser.CurrentLineNumber))
+
+    def _end_real(self):
+        try:
+            self._add(float(self._get_data()))
+        except ValueError:
+            raise self._error("Invalid real")
+
+    def _end_date(self):
+        try:
+            self._add(_date_from_string(self._get_data()))
+        except (AttributeError, ValueError) as e:
+            raise self._error("Date error: {}".format(e))
+
+    def _end_data(self):
+        try:
+            d = self._get_data()
+            value = binascii.a2b_base64(d.encode("utf-8") if isinstance(d, unicode) else d)
+        except Exception as e:
+            raise Exception("Data error at line {}: {}".format(self._parser.CurrentLineNumber,e))
+        if self._data_class is not None and not (self._py3 and self._use_builtin_types):
+            value = self._data_class(value)
+        self._add(value)
+
+    def _end_true(self):
+        self._add(True)
+
+    def _end_false(self):
+        self._add(False)
+
+    def _end_dict(self):
+        if self._key is not None:
+            raise self._error("missing value for key '{}'".format(self._key))
+        self._stack.pop()
+
+    def _end_array(self):
+        a = self._stack.pop()
+        parent, key = self._slots.pop()
+        if id(a) in self._nested:
+            self._nested.discard(id(a))
+            return
+        if self._list_type is list:
+            return
+        # Scalars only - swap in the list_type version wherever we put it
+        a = self._list_type(a)
+        if parent is None:
+            self._root = a
+        elif key is None:
+            parent[-1] = a
+        else:
+            parent[key] = a
+
+###               ###
+# XML Plist Writing #
+###               ###
+
+_controlCharPat = re.compile(
+    u"[\x00\x01\x02\x03\x04\x05\x06\x07\x08\x0b\x0c\x0e\x0f"
+    u"\x10\x11\x12\x13\x14\x15\x16\x17\x18\x19\x1a\x1b\x1c\x1d\x1e\x1f]")
+
+def _escape(text):
+    m = _controlCharPat.search(text)
+    if m is not None:
+        raise ValueError("strings can't contain control characters; "
+                         "use bytes instead")
+    text = text.replace("\r\n", "\n")       # convert DOS line endings
+    text = text.replace("\r", "\n")         # convert Mac line endings
+    text = text.replace("&", "&amp;")       # escape '&'
+    text = text.replace("<", "&lt;")        # escape '<'
+    text = text.replace(">", "&gt;")        # escape '>'
+    return text
+
+class _XMLPlistWriter:
+    """
+    Writes the same XML as plistlib, but streams it to fp in buffered chunks
+    rather than building it up in memory first.  Data is base64 encoded a line
+    at a time, and generators/iterators are written out as arrays as they're
+    consumed - so memory stays flat no matter how large the blobs are.
+    """
+    _header = (
+        b'<?xml version="1.0" encoding="UTF-8"?>\n'
+        b'<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" '
+        b'"http://www.apple.com/DTDs/PropertyList-1.0.dtd">\n'
+        b'<plist version="1.0">\n'
+    )
+
+    def __init__(self, fp, sort_keys=True, skipkeys=False, indent=b"\t", buffer_size=65536):
+        self._fp = fp
+        self._sort_keys = sort_keys
+        self._skipkeys = skipkeys
+        self._indent = indent
+        self._buffer_size = buffer_size
+        self._data_class = getattr(plistlib, "Data", None)
+        self._py3 = _check_py3()
+
+    def write(self, value):
+        self._chunks = []
+        self._buffered = 0
+        self._level = 0
+        self._emit(self._header)
+        self._write_value(value)
+        self._emit(b"</plist>\n")
+        self._flush()
+
+    def fragment(self, value, level=0, key=None):
+        # Just the element(s) for value (preceded by its <key> if given), indented
+        # for level - for splicing into an existing document
+        fp, self._fp = self._fp, BytesIO()
+        try:
+            self._chunks = []
+            self._buffered = 0
+            self._level = level
+            if key is not None:
+                self._element("key", self._text(key))
+            self._write_value(value)
+            self._flush()
+            return self._fp.getvalue()
+        finally:
+            self._fp = fp
+
+    def _emit(self, data):
+        self._chunks.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self._buffer_size:
+            self._flush()
+
+    def _flush(self):
+        if self._chunks:
+            self._fp.write(b"".join(self._chunks))
+        self._chunks = []
+        self._buffered = 0
+
+    def _line(self, line):
+        self._emit(self._indent * self._level + line + b"\n")
+
+    def _element(self, element, value=None):
+        if value is None:
+            self._line(u"<{}/>".format(element).encode("utf-8"))
+        else:
+            self._line(u"<{0}>{1}</{0}>".format(element, value).encode("utf-8"))
+
+    def _text(self, value):
+        if not self._py3 and not isinstance(value, unicode):
+            value = value.decode("utf-8")
+        return _escape(value)
+
+    def _write_value(self, value):
+        if isinstance(value, basestring):
+            self._element("string", self._text(value))
+
+        elif value is True:
+            self._element("true")
+
+        elif value is False:
+            self._element("false")
+
+        elif isinstance(value, (int, long)):
+            if -1 << 63 <= value < 1 << 64:
+                self._element("integer", "%d" % value)
+            else:
+                raise OverflowError(value)
+
+        elif isinstance(value, float):
+            self._element("real", repr(value))
+
+        elif isinstance(value, dict):
+            self._write_dict(value)
+
+        elif self._data_class is not None and isinstance(value, self._data_class):
+            self._write_data(value.data)
+
+        elif isinstance(value, (bytes, bytearray, memoryview)):
+            self._write_data(value)
+
+        elif isinstance(value, datetime.datetime):
+            self._element("date", value.strftime("%Y-%m-%dT%H:%M:%SZ"))
+
+        elif isinstance(value, (list, tuple, array.array, Iterator)):
+            self._write_array(value)
+
+        else:
+            raise TypeError("unsupported type: %s" % type(value))
+
+    def _write_data(self, data):
+        self._line(b"<data>")
+        # Same line length as plistlib - 76 chars, less the indent (tabs count as 8)
+        indent = self._indent * self._level
+        maxlinelength = max(16, 76 - len(indent.replace(b"\t", b" " * 8)))
+        step = (maxlinelength // 4) * 3
+        length = (step // 3) * 4
+        view = memoryview(data) if self._py3 else data
+        # Encode a block of lines per call, then split it back up - the block is a
+        # multiple of the line size so it comes out the same as line by line
+        block = step * 1024
+        for i in range(0, len(data), block):
+            encoded = binascii.b2a_base64(view[i:i + block])[:-1]
+            lines = [encoded[j:j + length] for j in range(0, len(encoded), length)]
+            self._emit(indent + (b"\n" + indent).join(lines) + b"\n")
+        self._line(b"</data>")
+
+    def _write_dict(self, d):
+        if not d:
+            self._element("dict")
+            return
+        self._line(b"<dict>")
+        self._level += 1
+        items = sorted(d.items()) if self._sort_keys else d.items()
+        for key, value in items:
+            if not isinstance(key, basestring):
+                if self._skipkeys:
+                    continue
+                raise TypeError("keys must be strings")
+            self._element("key", self._text(key))
+            self._write_value(value)
+        self._level -= 1
+        self._line(b"</dict>")
+
+    def _write_array(self, array):
+        # Generators get consumed as we go - peek at the first value to spot empty ones
+        items = iter(array)
+        first = next(items, _undefined)
+        if first is _undefined:
+            self._element("array")
+            return
+        self._line(b"<array>")
+        self._level += 1
+        self._write_value(first)
+        for value in items:
+            self._write_value(value)
+        self._level -= 1
+        self._line(b"</array>")
+
+class _FoundSpan(Exception):
+    pass
+
+def _patch_xml(data, keypath, value):
+    # Finds the byte span of the element at keypath in one expat pass (stopping as
+    # soon as we have it) and splices the new element in its place.  Returns None
+    # if the document isn't utf-8 - expat's byte offsets wouldn't match our output.
+    header = data.lstrip()[:100]
+    if not _is_xml(header) or header[:2] in (codecs.BOM_UTF16_BE, codecs.BOM_UTF16_LE) or header[:4] in (codecs.BOM_UTF32_BE, codecs.BOM_UTF32_LE):
+        return None
+    declared = re.search(br'encoding=["\']([^"\']+)', header)
+    if declared and declared.group(1).lower().replace(b"_", b"-") not in (b"utf-8", b"utf8", b"us-ascii", b"ascii"):
+        return None
+    target = [unicode(x) for x in keypath]
+    parser = ParserCreate()
+    frames = [] # [kind, path, current key, next index, start offset]
+    state = {"depth":0, "found":None, "key":None, "start":None, "level":None, "insert":None}
+
+    def start(name, attrs):
+        if name == "plist":
+            return
+        if name == "key":
+            state["key"] = []
+            return
+        state["depth"] += 1
+        if frames:
+            parent = frames[-1]
+            if parent[0] == "dict":
+                path = parent[1] + [parent[2]]
+            else:
+                path = parent[1] + [unicode(parent[3])]
+                parent[3] += 1
+        else:
+            path = []
+        if state["start"] is None and path == target:
+            state["start"] = parser.CurrentByteIndex
+            state["found"] = state["depth"]
+            state["level"] = len(frames)
+        if name in ("dict", "array"):
+            frames.append([name, path, None, 0, parser.CurrentByteIndex])
+
+    def end(name):
+        if name == "plist":
+            return
+        if name == "key":
+            frames[-1][2] = "".join(state["key"])
+            state["key"] = None
+            return
+        if name in ("dict", "array"):
+            frame = frames.pop()
+            if state["start"] is None and frame[0] == "dict" and frame[1] == target[:-1]:
+                # Got to the end of the parent dict without seeing our key
+                state["insert"] = (parser.CurrentByteIndex, frame[4], len(frames))
+                raise _FoundSpan()
+        if state["found"] == state["depth"]:
+            state["end"] = parser.CurrentByteIndex
+            raise _FoundSpan()
+        state["depth"] -= 1
+
+    def chars(text):
+        if state["key"] is not None:
+            state["key"].append(text)
+
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    parser.CharacterDataHandler = chars
+    try:
+        parser.Parse(data, True)
+    except _FoundSpan:
+        pass
+    if state["start"] is None and state["insert"] is None:
+        raise KeyError("/".join(target))
+
+    def indent_for(pos, level):
+        # Work out the document's indent from the line pos sits on
+        line_start = data.rfind(b"\n", 0, pos) + 1
+        prefix = data[line_start:pos]
+        if level and prefix and not prefix.strip() and len(prefix) % level == 0:
+            return prefix[:len(prefix) // level]
+        return b"\t"
+
+    def tag_end(pos):
+        return data.index(b">", pos) + 1
+
+    if state["start"] is not None:
+        start_pos, level = state["start"], state["level"]
+        end_pos = tag_end(state["end"])
+        writer = _XMLPlistWriter(None, sort_keys=True, indent=indent_for(start_pos, level))
+        element = writer.fragment(value, level).strip()
+        return data[:start_pos] + element + data[end_pos:]
+
+    # Adding a key to its dict
+    pos, start_pos, level = state["insert"]
+    if data[pos:pos + 2] != b"</":
+        # <dict/> - replace it with a dict holding just our key
+        writer = _XMLPlistWriter(None, sort_keys=True, indent=indent_for(start_pos, level))
+        element = writer.fragment({target[-1]: value}, level).strip()
+        return data[:start_pos] + element + data[tag_end(start_pos):]
+    writer = _XMLPlistWriter(None, sort_keys=True, indent=indent_for(pos, level or 1))
+    line_start = data.rfind(b"\n", 0, pos) + 1
+    if data[line_start:pos].strip():
+        line_start = pos # </dict> doesn't start its own line - just go right before it
+    return data[:line_start] + writer.fragment(value, level + 1, key=target[-1]) + data[line_start:]
+
 ###                        ###
 # Binary Plist Stuff For Py2 #
 ###                        ###
@@ -243,7 +862,10 @@ def dumps(value, fmt=FMT_XML, skipkeys=False, sort_keys=True):
 # From the python 3 plistlib.py source:  https://github.com/python/cpython/blob/3.11/Lib/plistlib.py
 # Tweaked to function on both Python 2 and 3
 
-class UID:
+class UID(object):
+    # Keyed archives can hold millions of these - no per-instance __dict__
+    __slots__ = ("data",)
+
     def __init__(self, data):
         if not isinstance(data, int):
             raise TypeError("data must be an int")
@@ -277,6 +899,12 @@ class UID:
             return NotImplemented
         return self.data == other.data
 
+    def __ne__(self, other):
+        # Python 2 doesn't derive this from __eq__
+        if not isinstance(other, UID):
+            return NotImplemented
+        return self.data != other.data
+
     def __hash__(self):
         return hash(self.data)
 
@@ -288,84 +916,178 @@ _BINARY_FORMAT = {1: 'B', 2: 'H', 4: 'L', 8: 'Q'}
 
 _undefined = object()
 
+def _int_from_bytes(data, signed=False):
+    # int.from_bytes() for Python 2 and 3
+    if _check_py3():
+        return int.from_bytes(data, 'big', signed=signed)
+    value = int(binascii.hexlify(data), 16) if data else 0
+    if signed and data and ord(data[0]) & 0x80:
+        value -= 1 << (len(data) * 8)
+    return value
+
 class _BinaryPlistParser:
     """
     Read or write a binary plist file, following the description of the binary
     format.  Raise InvalidFileException in case of error, otherwise return the
     root object.
     see also: http://opensource.apple.com/source/CF/CF-744.18/CFBinaryPList.c
+
+    The whole file is parsed out of one buffer - an mmap of the file when it has
+    a fileno, otherwise its contents read once - using struct.unpack_from() on
+    offsets instead of a seek() and read() per object.  With zero_copy=True, data
+    objects come back as memoryview slices of that buffer instead of bytes.
+
+    With lazy=True, arrays and dicts come back as _LazyList/_LazyDict proxies that
+    only decode a child the first time it's accessed - so reading one key out of
+    a large plist doesn't decode the rest of it.
+
+    Arrays holding only scalars are built with list_type, and intern_keys shares
+    key strings across documents too via sys.intern().
     """
-    def __init__(self, use_builtin_types, dict_type):
+    def __init__(self, use_builtin_types, dict_type, zero_copy=False, lazy=False, list_type=list, intern_keys=False):
         self._use_builtin_types = use_builtin_types
         self._dict_type = dict_type
+        self._list_type = list_type
+        self._intern_keys = intern_keys
+        self._lazy = lazy
+        # memoryview slicing of an mmap is Python 3 only
+        self._zero_copy = zero_copy and _check_py3()
+        self._py3 = _check_py3()
+        # Look this up once - it's a failed module attribute lookup per key on 3.9+
+        self._data_class = getattr(plistlib, "Data", None)
+
+    def _get_buffer(self, fp):
+        # Map the file if it's a real one - otherwise just grab its contents
+        try:
+            return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            pass
+        if hasattr(fp, "getvalue"):
+            return fp.getvalue() # BytesIO hands back its buffer without a copy
+        fp.seek(0)
+        return fp.read()
 
     def parse(self, fp):
+        self._buf = self._get_buffer(fp)
         try:
-            # The basic file format:
-            # HEADER
-            # object...
-            # refid->offset...
-            # TRAILER
-            self._fp = fp
-            self._fp.seek(-32, os.SEEK_END)
-            trailer = self._fp.read(32)
-            if len(trailer) != 32:
-                raise InvalidFileException()
-            (
-                offset_size, self._ref_size, num_objects, top_object,
-                offset_table_offset
-            ) = struct.unpack('>6xBBQQQ', trailer)
-            self._fp.seek(offset_table_offset)
-            self._object_offsets = self._read_ints(num_objects, offset_size)
-            self._objects = [_undefined] * num_objects
-            return self._read_object(top_object)
+            self._read_trailer()
+            return self._read_object(self._top_object)
 
         except (OSError, IndexError, struct.error, OverflowError,
                 UnicodeDecodeError):
             raise InvalidFileException()
-
-    def _get_size(self, tokenL):
-        """ return the size of the next object."""
+        finally:
+            if isinstance(self._buf, mmap.mmap) and not (self._zero_copy or self._lazy):
+                # Nothing points into the map anymore - let it go now
+                self._buf.close()
+
+    def _read_trailer(self):
+        # The basic file format:
+        # HEADER
+        # object...
+        # refid->offset...
+        # TRAILER
+        if len(self._buf) < 40:
+            raise InvalidFileException()
+        self._view = memoryview(self._buf) if self._zero_copy else None
+        (
+            self._sort_version, offset_size, self._ref_size, num_objects,
+            self._top_object, self._offset_table_offset
+        ) = struct.unpack_from('>5xBBBQQQ', self._buf, len(self._buf) - 32)
+        self._object_offsets = self._read_ints(self._offset_table_offset, num_objects, offset_size)
+        self._objects = [_undefined] * num_objects
+
+    def _token(self, offset):
+        return self._buf[offset] if self._py3 else ord(self._buf[offset])
+
+    def _get_size(self, tokenL, offset):
+        """ return the size of the next object and the offset of its contents."""
         if tokenL == 0xF:
-            m = self._fp.read(1)[0]
-            if not _check_py3():
-                m = ord(m)
-            m = m & 0x3
-            s = 1 << m
-            f = '>' + _BINARY_FORMAT[s]
-            return struct.unpack(f, self._fp.read(s))[0]
-
-        return tokenL
-
-    def _read_ints(self, n, size):
-        data = self._fp.read(size * n)
+            s = 1 << (self._token(offset) & 0x3)
+            return (struct.unpack_from('>' + _BINARY_FORMAT[s], self._buf, offset + 1)[0], offset + 1 + s)
+
+        return (tokenL, offset)
+
+    def _read_ints(self, offset, n, size):
         if size in _BINARY_FORMAT:
-            return struct.unpack('>' + _BINARY_FORMAT[size] * n, data)
+            return struct.unpack_from('>{}{}'.format(n, _BINARY_FORMAT[size]), self._buf, offset)
         else:
+            data = self._buf[offset: offset + size * n]
             if not size or len(data) != size * n:
                 raise InvalidFileException()
-            return tuple(int(binascii.hexlify(data[i: i + size]),16)
+            return tuple(_int_from_bytes(data[i: i + size])
                          for i in range(0, size * n, size))
-            '''return tuple(int.from_bytes(data[i: i + size], 'big')
-                         for i in range(0, size * n, size))'''
 
-    def _read_refs(self, n):
-        return self._read_ints(n, self._ref_size)
+    def _read_refs(self, offset, n):
+        return self._read_ints(offset, n, self._ref_size)
 
     def _read_object(self, ref):
         """
         read the object by reference.
-        May recursively read sub-objects (content of an array/dict/set)
+        Sub-objects (content of an array/dict/set) are filled in from an explicit
+        stack rather than by recursing, so nesting depth isn't limited by the
+        interpreter - unless we're lazy, in which case containers defer to their
+        proxies
         """
         result = self._objects[ref]
         if result is not _undefined:
             return result
 
+        result, refs, key_count = self._decode(ref)
+        if refs is None:
+            return result
+
+        # Each frame is [container, child refs, next index, key count, decoded keys] -
+        # dict frames list their key refs ahead of their value refs
+        objects = self._objects
+        decode = self._decode
+        data_class = self._data_class
+        stack = [[result, refs, 0, key_count, []]]
+        while stack:
+            frame = stack[-1]
+            container, refs, i, key_count, keys = frame
+            n = len(refs)
+            pushed = None
+            # Run through this container's children until we hit a new container
+            while i < n:
+                child = objects[refs[i]]
+                if child is _undefined:
+                    child, child_refs, child_keys = decode(refs[i])
+                    if child_refs is not None:
+                        # Containers are registered before they're filled - so we
+                        # can hook them up to their parent right away
+                        pushed = [child, child_refs, 0, child_keys, []]
+                if key_count is None:
+                    container.append(child)
+                elif i < key_count:
+                    if data_class is not None and isinstance(child, data_class):
+                        child = child.data
+                    keys.append(_intern_key(child) if self._intern_keys else child)
+                else:
+                    container[keys[i - key_count]] = child
+                i += 1
+                if pushed is not None:
+                    break
+            frame[2] = i
+            if pushed is not None:
+                stack.append(pushed)
+            elif i == n:
+                stack.pop()
+
+        return result
+
+    def _decode(self, ref):
+        """
+        decode the object by reference - without reading sub-objects.
+        Returns (object, child refs, key count); arrays and dicts come back empty
+        with the refs still to be read (key count is None for arrays), anything
+        else has None for its child refs
+        """
+        refs = key_count = None
+
         offset = self._object_offsets[ref]
-        self._fp.seek(offset)
-        token = self._fp.read(1)[0]
-        if not _check_py3():
-            token = ord(token)
+        token = self._token(offset)
+        offset += 1
         tokenH, tokenL = token & 0xF0, token & 0x0F
 
         if token == 0x00: # \x00 or 0x00
@@ -384,49 +1106,62 @@ class _BinaryPlistParser:
             result = b''
 
         elif tokenH == 0x10:  # int
-            result = int(binascii.hexlify(self._fp.read(1 << tokenL)),16)
-            if tokenL >= 3: # Signed - adjust
-                result = result-((result & 0x8000000000000000) << 1)
+            s = 1 << tokenL
+            if s in _BINARY_FORMAT:
+                # 8 byte ints are signed, smaller ones are not
+                result = struct.unpack_from('>' + (_BINARY_FORMAT[s] if s < 8 else 'q'), self._buf, offset)[0]
+            else:
+                result = _int_from_bytes(self._buf[offset: offset + s], signed=tokenL >= 3)
 
         elif token == 0x22: # real
-            result = struct.unpack('>f', self._fp.read(4))[0]
+            result = struct.unpack_from('>f', self._buf, offset)[0]
 
         elif token == 0x23: # real
-            result = struct.unpack('>d', self._fp.read(8))[0]
+            result = struct.unpack_from('>d', self._buf, offset)[0]
 
         elif token == 0x33:  # date
-            f = struct.unpack('>d', self._fp.read(8))[0]
+            f = struct.unpack_from('>d', self._buf, offset)[0]
             # timestamp 0 of binary plists corresponds to 1/1/2001
             # (year of Mac OS X 10.0), instead of 1/1/1970.
             result = (datetime.datetime(2001, 1, 1) +
                       datetime.timedelta(seconds=f))
 
         elif tokenH == 0x40:  # data
-            s = self._get_size(tokenL)
-            if self._use_builtin_types or not hasattr(plistlib, "Data"):
-                result = self._fp.read(s)
+            s, offset = self._get_size(tokenL, offset)
+            if self._zero_copy:
+                result = self._view[offset: offset + s]
+            elif self._use_builtin_types or self._data_class is None:
+                result = self._buf[offset: offset + s]
             else:
-                result = plistlib.Data(self._fp.read(s))
+                result = self._data_class(self._buf[offset: offset + s])
 
         elif tokenH == 0x50:  # ascii string
-            s = self._get_size(tokenL)
-            result =  self._fp.read(s).decode('ascii')
-            result = result
+            s, offset = self._get_size(tokenL, offset)
+            result = self._buf[offset: offset + s].decode('ascii')
 
         elif tokenH == 0x60:  # unicode string
-            s = self._get_size(tokenL)
-            result = self._fp.read(s * 2).decode('utf-16be')
+            s, offset = self._get_size(tokenL, offset)
+            result = self._buf[offset: offset + s * 2].decode('utf-16be')
 
         elif tokenH == 0x80:  # UID
             # used by Key-Archiver plist files
-            result = UID(int(binascii.hexlify(self._fp.read(1 + tokenL)),16))
+            s = 1 + tokenL
+            if s in _BINARY_FORMAT:
+                result = UID(struct.unpack_from('>' + _BINARY_FORMAT[s], self._buf, offset)[0])
+            else:
+                result = UID(_int_from_bytes(self._buf[offset: offset + s]))
 
         elif tokenH == 0xA0:  # array
-            s = self._get_size(tokenL)
-            obj_refs = self._read_refs(s)
-            result = []
-            self._objects[ref] = result
-            result.extend(self._read_object(x) for x in obj_refs)
+            s, offset = self._get_size(tokenL, offset)
+            obj_refs = self._read_refs(offset, s)
+            if self._lazy:
+                result = _LazyList(self, obj_refs)
+            elif self._list_type is not list and not any(
+                    self._token(self._object_offsets[x]) & 0xF0 in (0xA0, 0xD0) for x in obj_refs):
+                # Scalars only - nothing to nest, so build it with list_type right away
+                result = self._list_type([self._read_object(x) for x in obj_refs])
+            else:
+                result, refs = [], obj_refs
 
         # tokenH == 0xB0 is documented as 'ordset', but is not actually
         # implemented in the Apple reference code.
@@ -435,23 +1170,126 @@ class _BinaryPlistParser:
         # plists.
 
         elif tokenH == 0xD0:  # dict
-            s = self._get_size(tokenL)
-            key_refs = self._read_refs(s)
-            obj_refs = self._read_refs(s)
+            s, offset = self._get_size(tokenL, offset)
+            key_refs = self._read_refs(offset, s)
+            obj_refs = self._read_refs(offset + s * self._ref_size, s)
             result = self._dict_type()
-            self._objects[ref] = result
-            for k, o in zip(key_refs, obj_refs):
-                key = self._read_object(k)
-                if hasattr(plistlib, "Data") and isinstance(key, plistlib.Data):
-                    key = key.data
-                result[key] = self._read_object(o)
+            if self._lazy:
+                # Lazy dicts only hold the value's ref until it's asked for
+                for k, o in zip(key_refs, obj_refs):
+                    key = self._read_object(k)
+                    if self._data_class is not None and isinstance(key, self._data_class):
+                        key = key.data
+                    result[key] = o
+                result = _LazyDict(self, result)
+            else:
+                refs, key_count = key_refs + obj_refs, s
 
         else:
             raise InvalidFileException()
 
         self._objects[ref] = result
+        return (result, refs, key_count)
+
+class _LazyDict(MutableMapping):
+    # Dict proxy over a lazily parsed binary plist - keys are decoded up front, and
+    # each value is decoded (and memoized by the parser) on first access
+
+    def __init__(self, parser, refs):
+        self._parser = parser
+        self._refs = refs # key -> object ref, in file order
+        self._values = {}
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+        value = self._values[key] = self._parser._read_object(self._refs[key])
+        return value
+
+    def __setitem__(self, key, value):
+        if not key in self._refs:
+            self._refs[key] = None
+        self._values[key] = value
+
+    def __delitem__(self, key):
+        del self._refs[key]
+        self._values.pop(key, None)
+
+    def __iter__(self):
+        return iter(self._refs)
+
+    def __len__(self):
+        return len(self._refs)
+
+    def __repr__(self):
+        return "<_LazyDict of {} keys>".format(len(self))
+
+    def materialize(self):
+        # Decodes everything below us into plain dict_type/list objects
+        result = self._parser._dict_type()
+        for key in self:
+            value = self[key]
+            result[key] = value.materialize() if isinstance(value, (_LazyDict, _LazyList)) else value
         return result
 
+class _LazyList(MutableSequence):
+    # List proxy over a lazily parsed binary plist - items are decoded (and
+    # memoized by the parser) on first access
+
+    def __init__(self, parser, refs):
+        self._parser = parser
+        self._items = [_undefined] * len(refs)
+        self._refs = list(refs)
+
+    def _get(self, index):
+        value = self._items[index]
+        if value is _undefined:
+            value = self._items[index] = self._parser._read_object(self._refs[index])
+        return value
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._get(i) for i in range(*index.indices(len(self)))]
+        return self._get(index)
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            # Just resolve everything and let a plain list sort out the slice
+            items = list(self)
+            items[index] = value
+            self._items, self._refs = items, [None] * len(items)
+        else:
+            self._items[index] = value
+
+    def __delitem__(self, index):
+        del self._items[index]
+        del self._refs[index]
+
+    def __len__(self):
+        return len(self._items)
+
+    def insert(self, index, value):
+        self._items.insert(index, value)
+        self._refs.insert(index, None)
+
+    def __eq__(self, other):
+        if not isinstance(other, (list, _LazyList)):
+            return NotImplemented
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __repr__(self):
+        return "<_LazyList of {} items>".format(len(self))
+
+    def materialize(self):
+        # Decodes everything below us into plain dict_type/list objects
+        return [x.materialize() if isinstance(x, (_LazyDict, _LazyList)) else x for x in self]
+
 def _count_to_size(count):
     if count < 1 << 8:
         return 1
@@ -467,11 +1305,60 @@ def _count_to_size(count):
 
 _scalars = (str, int, float, datetime.datetime, bytes)
 
+# How _BinaryPlistWriter tracks each type - scalars and Data are deduplicated by
+# value, everything else by identity, and containers have children to walk
+_SCALAR, _DATA, _DICT, _ARRAY, _OTHER = range(5)
+
+_PACK_B = struct.Struct('>B').pack
+_PACK_BB = struct.Struct('>BB').pack
+_PACK_BH = struct.Struct('>BH').pack
+_PACK_BL = struct.Struct('>BL').pack
+_PACK_BQ = struct.Struct('>BQ').pack
+_PACK_Bq = struct.Struct('>Bq').pack
+_PACK_Bd = struct.Struct('>Bd').pack
+_PACK_BBB = struct.Struct('>BBB').pack
+_PACK_BBH = struct.Struct('>BBH').pack
+_PACK_BBL = struct.Struct('>BBL').pack
+_PACK_BBQ = struct.Struct('>BBQ').pack
+_TRAILER = struct.Struct('>5xBBBQQQ')
+
+_EPOCH_2001 = datetime.datetime(2001, 1, 1)
+
 class _BinaryPlistWriter (object):
+    """
+    Flattens the value into a list of unique objects, then encodes each one into a
+    single bytearray through a table of per-type encoders, and hands the whole
+    thing to fp in one write.  Container refs are collected while flattening so
+    the encoding pass never has to look them up again.
+    """
     def __init__(self, fp, sort_keys, skipkeys):
         self._fp = fp
         self._sort_keys = sort_keys
         self._skipkeys = skipkeys
+        self._data_class = getattr(plistlib, "Data", None)
+        self._kinds = {}
+        self._encoders = {
+            type(None): self._write_none,
+            bool: self._write_bool,
+            int: self._write_int,
+            long: self._write_int,
+            float: self._write_float,
+            datetime.datetime: self._write_date,
+            bytearray: self._write_data,
+            memoryview: self._write_data,
+            unicode: self._write_string,
+            UID: self._write_uid,
+            list: self._write_array,
+            tuple: self._write_array,
+            array.array: self._write_array,
+            dict: self._write_dict,
+        }
+        # bytes are data on Python 3 - on Python 2 they're just str
+        self._encoders[bytes] = self._write_data if _check_py3() else self._write_string
+        if self._data_class is not None:
+            self._encoders[self._data_class] = self._write_data
+        if hasattr(plistlib, "UID"):
+            self._encoders[plistlib.UID] = self._write_uid
 
     def write(self, value):
 
@@ -485,204 +1372,319 @@ class _BinaryPlistWriter (object):
         self._objtable = {}
         self._objidtable = {}
 
+        # refnum -> refs of that container's children (keys first for dicts)
+        self._child_refs = {}
+
         # Create list of all objects in the plist
-        self._flatten(value)
+        top_object = self._flatten(value)
 
         # Size of object references in serialized containers
         # depends on the number of objects in the plist.
         num_objects = len(self._objlist)
-        self._object_offsets = [0]*num_objects
         self._ref_size = _count_to_size(num_objects)
-
         self._ref_format = _BINARY_FORMAT[self._ref_size]
 
-        # Write file header
-        self._fp.write(b'bplist00')
-
-        # Write object list
-        for obj in self._objlist:
-            self._write_object(obj)
-
-        # Write refnum->object offset table
-        top_object = self._getrefnum(value)
-        offset_table_offset = self._fp.tell()
+        # File header
+        self._buf = buf = bytearray(b'bplist00')
+
+        # Object list
+        offsets = [0] * num_objects
+        encoders = self._encoders
+        for ref, obj in enumerate(self._objlist):
+            offsets[ref] = len(buf)
+            encoder = encoders.get(type(obj))
+            if encoder is None:
+                encoder = self._find_encoder(obj)
+            encoder(obj, ref)
+
+        # refnum->object offset table
+        offset_table_offset = len(buf)
         offset_size = _count_to_size(offset_table_offset)
-        offset_format = '>' + _BINARY_FORMAT[offset_size] * num_objects
-        self._fp.write(struct.pack(offset_format, *self._object_offsets))
+        buf += struct.pack('>{}{}'.format(num_objects, _BINARY_FORMAT[offset_size]), *offsets)
 
-        # Write trailer
+        # Trailer
         sort_version = 0
-        trailer = (
+        buf += _TRAILER.pack(
             sort_version, offset_size, self._ref_size, num_objects,
             top_object, offset_table_offset
         )
-        self._fp.write(struct.pack('>5xBBBQQQ', *trailer))
+        self._fp.write(buf)
+        self._buf = None
+
+    def _kind(self, t):
+        if issubclass(t, _scalars):
+            kind = _SCALAR
+        elif self._data_class is not None and issubclass(t, self._data_class):
+            kind = _DATA
+        elif issubclass(t, dict):
+            kind = _DICT
+        elif issubclass(t, (list, tuple, array.array)):
+            kind = _ARRAY
+        else:
+            kind = _OTHER
+        self._kinds[t] = kind
+        return kind
+
+    def _find_encoder(self, value):
+        # Subclasses of the types we know - look them up once and remember them
+        for t, encoder in list(self._encoders.items()):
+            if t is not bool and isinstance(value, t):
+                self._encoders[type(value)] = encoder
+                return encoder
+        raise TypeError(value)
 
     def _flatten(self, value):
-        # First check if the object is in the object table, not used for
-        # containers to ensure that two subcontainers with the same contents
-        # will be serialized as distinct values.
-        if isinstance(value, _scalars):
-            if (type(value), value) in self._objtable:
-                return
+        # Walk the tree depth first with an explicit stack of child iterators rather
+        # than recursing - objects still land in _objlist in the same order.  Each
+        # frame also collects its container's child refs for the encoding pass.
+        objlist = self._objlist
+        objtable = self._objtable
+        objidtable = self._objidtable
+        kinds = self._kinds
+        top_refs = []
+        stack = [(iter((value,)), top_refs)]
+        while stack:
+            items, refs = stack[-1]
+            pushed = None
+            # Run through this container's children until we hit a new container
+            for value in items:
+                t = type(value)
+                kind = kinds.get(t)
+                if kind is None:
+                    kind = self._kind(t)
+
+                # First check if the object is in the object table, not used for
+                # containers to ensure that two subcontainers with the same contents
+                # will be serialized as distinct values.
+                if kind == _SCALAR:
+                    table, key = objtable, (t, value)
+                elif kind == _DATA:
+                    table, key = objtable, (type(value.data), value.data)
+                else:
+                    table, key = objidtable, id(value)
+                refnum = table.get(key)
+                if refnum is not None:
+                    refs.append(refnum)
+                    continue
+
+                # Add to objectreference map
+                refnum = table[key] = len(objlist)
+                objlist.append(value)
+                refs.append(refnum)
+
+                # And finally queue up the contents of containers
+                if kind == _DICT:
+                    keys = []
+                    values = []
+                    pairs = value.items()
+                    if self._sort_keys:
+                        pairs = sorted(pairs)
+
+                    for k, v in pairs:
+                        if not isinstance(k, basestring):
+                            if self._skipkeys:
+                                continue
+                            raise TypeError("keys must be strings")
+                        keys.append(k)
+                        values.append(v)
 
-        elif hasattr(plistlib, "Data") and isinstance(value, plistlib.Data):
-            if (type(value.data), value.data) in self._objtable:
-                return
+                    child_refs = self._child_refs[refnum] = []
+                    pushed = (itertools.chain(keys, values), child_refs)
+                    break
 
-        elif id(value) in self._objidtable:
-            return
+                elif kind == _ARRAY:
+                    child_refs = self._child_refs[refnum] = []
+                    pushed = (iter(value), child_refs)
+                    break
 
-        # Add to objectreference map
-        refnum = len(self._objlist)
-        self._objlist.append(value)
-        if isinstance(value, _scalars):
-            self._objtable[(type(value), value)] = refnum
-        elif hasattr(plistlib, "Data") and isinstance(value, plistlib.Data):
-            self._objtable[(type(value.data), value.data)] = refnum
-        else:
-            self._objidtable[id(value)] = refnum
-
-        # And finally recurse into containers
-        if isinstance(value, dict):
-            keys = []
-            values = []
-            items = value.items()
-            if self._sort_keys:
-                items = sorted(items)
-
-            for k, v in items:
-                if not isinstance(k, basestring):
-                    if self._skipkeys:
-                        continue
-                    raise TypeError("keys must be strings")
-                keys.append(k)
-                values.append(v)
-
-            for o in itertools.chain(keys, values):
-                self._flatten(o)
-
-        elif isinstance(value, (list, tuple)):
-            for o in value:
-                self._flatten(o)
-
-    def _getrefnum(self, value):
-        if isinstance(value, _scalars):
-            return self._objtable[(type(value), value)]
-        elif hasattr(plistlib, "Data") and isinstance(value, plistlib.Data):
-            return self._objtable[(type(value.data), value.data)]
-        else:
-            return self._objidtable[id(value)]
+            if pushed is None:
+                stack.pop()
+            else:
+                stack.append(pushed)
+
+        return top_refs[0]
 
     def _write_size(self, token, size):
         if size < 15:
-            self._fp.write(struct.pack('>B', token | size))
+            self._buf += _PACK_B(token | size)
 
         elif size < 1 << 8:
-            self._fp.write(struct.pack('>BBB', token | 0xF, 0x10, size))
+            self._buf += _PACK_BBB(token | 0xF, 0x10, size)
 
         elif size < 1 << 16:
-            self._fp.write(struct.pack('>BBH', token | 0xF, 0x11, size))
+            self._buf += _PACK_BBH(token | 0xF, 0x11, size)
 
         elif size < 1 << 32:
-            self._fp.write(struct.pack('>BBL', token | 0xF, 0x12, size))
+            self._buf += _PACK_BBL(token | 0xF, 0x12, size)
 
         else:
-            self._fp.write(struct.pack('>BBQ', token | 0xF, 0x13, size))
-
-    def _write_object(self, value):
-        ref = self._getrefnum(value)
-        self._object_offsets[ref] = self._fp.tell()
-        if value is None:
-            self._fp.write(b'\x00')
+            self._buf += _PACK_BBQ(token | 0xF, 0x13, size)
 
-        elif value is False:
-            self._fp.write(b'\x08')
-
-        elif value is True:
-            self._fp.write(b'\x09')
-
-        elif isinstance(value, int):
-            if value < 0:
-                try:
-                    self._fp.write(struct.pack('>Bq', 0x13, value))
-                except struct.error:
-                    raise OverflowError(value) # from None
-            elif value < 1 << 8:
-                self._fp.write(struct.pack('>BB', 0x10, value))
-            elif value < 1 << 16:
-                self._fp.write(struct.pack('>BH', 0x11, value))
-            elif value < 1 << 32:
-                self._fp.write(struct.pack('>BL', 0x12, value))
-            elif value < 1 << 63:
-                self._fp.write(struct.pack('>BQ', 0x13, value))
-            elif value < 1 << 64:
-                self._fp.write(b'\x14' + value.to_bytes(16, 'big', signed=True))
-            else:
-                raise OverflowError(value)
-
-        elif isinstance(value, float):
-            self._fp.write(struct.pack('>Bd', 0x23, value))
+    def _write_refs(self, refs):
+        self._buf += struct.pack('>{}{}'.format(len(refs), self._ref_format), *refs)
 
-        elif isinstance(value, datetime.datetime):
-            f = (value - datetime.datetime(2001, 1, 1)).total_seconds()
-            self._fp.write(struct.pack('>Bd', 0x33, f))
+    def _write_none(self, value, ref):
+        self._buf += b'\x00'
 
-        elif (_check_py3() and isinstance(value, (bytes, bytearray))) or (hasattr(plistlib, "Data") and isinstance(value, plistlib.Data)):
-            if not isinstance(value, (bytes, bytearray)):
-                value = value.data # Unpack it
-            self._write_size(0x40, len(value))
-            self._fp.write(value)
+    def _write_bool(self, value, ref):
+        self._buf += b'\x09' if value else b'\x08'
 
-        elif isinstance(value, basestring):
+    def _write_int(self, value, ref):
+        if value < 0:
             try:
-                t = value.encode('ascii')
-                self._write_size(0x50, len(value))
-            except UnicodeEncodeError:
-                t = value.encode('utf-16be')
-                self._write_size(0x60, len(t) // 2)
-            self._fp.write(t)
-
-        elif isinstance(value, UID) or (hasattr(plistlib,"UID") and isinstance(value, plistlib.UID)):
-            if value.data < 0:
-                raise ValueError("UIDs must be positive")
-            elif value.data < 1 << 8:
-                self._fp.write(struct.pack('>BB', 0x80, value))
-            elif value.data < 1 << 16:
-                self._fp.write(struct.pack('>BH', 0x81, value))
-            elif value.data < 1 << 32:
-                self._fp.write(struct.pack('>BL', 0x83, value))
-            # elif value.data < 1 << 64:
-            #    self._fp.write(struct.pack('>BQ', 0x87, value))
-            else:
-                raise OverflowError(value)
-
-        elif isinstance(value, (list, tuple)):
-            refs = [self._getrefnum(o) for o in value]
-            s = len(refs)
-            self._write_size(0xA0, s)
-            self._fp.write(struct.pack('>' + self._ref_format * s, *refs))
-
-        elif isinstance(value, dict):
-            keyRefs, valRefs = [], []
+                self._buf += _PACK_Bq(0x13, value)
+            except struct.error:
+                raise OverflowError(value) # from None
+        elif value < 1 << 8:
+            self._buf += _PACK_BB(0x10, value)
+        elif value < 1 << 16:
+            self._buf += _PACK_BH(0x11, value)
+        elif value < 1 << 32:
+            self._buf += _PACK_BL(0x12, value)
+        elif value < 1 << 63:
+            self._buf += _PACK_BQ(0x13, value)
+        elif value < 1 << 64:
+            # 16 byte signed int - the high 8 bytes are always zero here
+            self._buf += b'\x14' + b'\x00' * 8 + struct.pack('>Q', value)
+        else:
+            raise OverflowError(value)
 
-            if self._sort_keys:
-                rootItems = sorted(value.items())
-            else:
-                rootItems = value.items()
+    def _write_float(self, value, ref):
+        self._buf += _PACK_Bd(0x23, value)
 
-            for k, v in rootItems:
-                if not isinstance(k, basestring):
-                    if self._skipkeys:
-                        continue
-                    raise TypeError("keys must be strings")
-                keyRefs.append(self._getrefnum(k))
-                valRefs.append(self._getrefnum(v))
+    def _write_date(self, value, ref):
+        f = (value - _EPOCH_2001).total_seconds()
+        self._buf += _PACK_Bd(0x33, f)
 
-            s = len(keyRefs)
-            self._write_size(0xD0, s)
-            self._fp.write(struct.pack('>' + self._ref_format * s, *keyRefs))
-            self._fp.write(struct.pack('>' + self._ref_format * s, *valRefs))
+    def _write_data(self, value, ref):
+        if self._data_class is not None and isinstance(value, self._data_class):
+            value = value.data # Unpack it
+        self._write_size(0x40, len(value))
+        self._buf += value
 
+    def _write_string(self, value, ref):
+        if not isinstance(value, unicode):
+            # Python 2 str - assume utf-8
+            value = value.decode('utf-8')
+        try:
+            t = value.encode('ascii')
+            self._write_size(0x50, len(value))
+        except UnicodeEncodeError:
+            t = value.encode('utf-16be')
+            self._write_size(0x60, len(t) // 2)
+        self._buf += t
+
+    def _write_uid(self, value, ref):
+        if value.data < 0:
+            raise ValueError("UIDs must be positive")
+        elif value.data < 1 << 8:
+            self._buf += _PACK_BB(0x80, value.data)
+        elif value.data < 1 << 16:
+            self._buf += _PACK_BH(0x81, value.data)
+        elif value.data < 1 << 32:
+            self._buf += _PACK_BL(0x83, value.data)
+        # elif value.data < 1 << 64:
+        #    self._buf += _PACK_BQ(0x87, value.data)
         else:
-            raise TypeError(value)
+            raise OverflowError(value)
+
+    def _write_array(self, value, ref):
+        refs = self._child_refs[ref]
+        self._write_size(0xA0, len(refs))
+        self._write_refs(refs)
+
+    def _write_dict(self, value, ref):
+        # Key refs followed by value refs - just as _flatten collected them
+        refs = self._child_refs[ref]
+        self._write_size(0xD0, len(refs) // 2)
+        self._write_refs(refs)
+
+def _patch_binary(data, keypath, value):
+    # Appends the objects for value where the offset table used to start, points
+    # the parent container at them, then writes a fresh offset table and trailer.
+    # Everything before the old offset table stays byte-identical apart from the
+    # one ref we swap (or the parent dict we re-append when adding a key).  Returns
+    # None if the new object count won't fit in the existing ref size.
+    p = _BinaryPlistParser(use_builtin_types=True, dict_type=dict)
+    p._buf = data
+    try:
+        p._read_trailer()
+    except (IndexError, struct.error, OverflowError):
+        raise InvalidFileException()
+    ref_size = p._ref_size
+    ref = p._top_object
+    slot = None   # Where the ref to our target lives
+    insert = None # (dict ref, key refs, value refs) if we're adding a key
+    for i, key in enumerate(keypath):
+        offset = p._object_offsets[ref]
+        token = p._token(offset)
+        size, offset = p._get_size(token & 0x0F, offset + 1)
+        if token & 0xF0 == 0xD0:
+            key_refs = p._read_refs(offset, size)
+            keys = [p._read_object(x) for x in key_refs]
+            if key in keys:
+                index = keys.index(key)
+                slot = offset + (size + index) * ref_size
+                ref = p._read_refs(offset + size * ref_size, size)[index]
+                continue
+            if i == len(keypath) - 1:
+                insert = (ref, list(key_refs), list(p._read_refs(offset + size * ref_size, size)))
+                break
+        elif token & 0xF0 == 0xA0:
+            try:
+                index = int(key)
+                if not 0 <= index < size:
+                    raise ValueError()
+            except ValueError:
+                pass
+            else:
+                slot = offset + index * ref_size
+                ref = p._read_refs(offset, size)[index]
+                continue
+        raise KeyError("/".join(str(x) for x in keypath))
+
+    # Flatten the new objects on their own, then shift their refs past the existing ones
+    base = len(p._object_offsets)
+    w = _BinaryPlistWriter(None, sort_keys=True, skipkeys=False)
+    w._objlist = []
+    w._objtable = {}
+    w._objidtable = {}
+    w._child_refs = {}
+    key_ref = w._flatten(keypath[-1]) if insert else None
+    value_ref = w._flatten(value)
+    if _count_to_size(base + len(w._objlist)) != ref_size:
+        return None
+    for refs in w._child_refs.values():
+        refs[:] = [x + base for x in refs]
+    w._ref_size = ref_size
+    w._ref_format = _BINARY_FORMAT[ref_size]
+    w._buf = buf = bytearray(data[:p._offset_table_offset])
+    offsets = list(p._object_offsets)
+    encoders = w._encoders
+    for index, obj in enumerate(w._objlist):
+        offsets.append(len(buf))
+        encoder = encoders.get(type(obj))
+        if encoder is None:
+            encoder = w._find_encoder(obj)
+        encoder(obj, index)
+
+    top_object = p._top_object
+    if insert:
+        # Re-append the parent dict with our key on the end and point its ref there
+        dict_ref, key_refs, value_refs = insert
+        offsets[dict_ref] = len(buf)
+        w._write_size(0xD0, len(key_refs) + 1)
+        w._write_refs(key_refs + [key_ref + base] + value_refs + [value_ref + base])
+    elif slot is None:
+        top_object = value_ref + base # New root
+    else:
+        struct.pack_into('>' + w._ref_format, buf, slot, value_ref + base)
+
+    offset_table_offset = len(buf)
+    offset_size = _count_to_size(offset_table_offset)
+    buf += struct.pack('>{}{}'.format(len(offsets), _BINARY_FORMAT[offset_size]), *offsets)
+    buf += _TRAILER.pack(
+        p._sort_version, offset_size, ref_size, len(offsets),
+        top_object, offset_table_offset
+    )
+    return bytes(buf)
@@ -0,0 +1,504 @@
+import sys, os, time, json, random, datetime, platform, argparse, plistlib, gc, tempfile, plist
+from io import BytesIO
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None # Python 2 - no peak memory numbers
+
+# Benchmarks plist.py's load/loads/dump/dumps against the stdlib plistlib over a
+# synthetic corpus (tunable size, depth and type mix), wide and deep documents, plus
+# fixtures shaped like a kext Info.plist, the NVIDIA manifest and an NSKeyedArchiver
+# archive full of UIDs - in both XML and binary (the archive is binary only, as XML
+# has no UIDs).  Loads are also timed with the plist.COMPACT preset ("compact"), and
+# the peak memory column shows what it saves.  load_file reads from a real file on
+# disk - which the binary reader maps rather than reads - and "zero_copy" repeats the
+# binary loads with zero_copy=True, so data comes back as views into that map (on
+# Python 3 - Python 2 ignores the flag).  Every corpus entry is round-tripped first,
+# and a chain --deep-check levels deep (100k by default) goes through the binary
+# writer and reader to show nesting isn't bound by the recursion limit.  Results can
+# be saved as a JSON baseline, and a later run compared against it flags anything
+# that got slower than the threshold (and exits 1, so it can gate a commit).
+#
+#   python plist_bench.py --save baseline.json
+#   python plist_bench.py --compare baseline.json --threshold 0.15
+#
+# The binary writer at a million objects - --corpora keeps the other entries (and
+# their setup time) out of it:
+#
+#   python plist_bench.py --size 1000000 --corpora synthetic --formats binary --ops dump,dumps --deep-check 0 --repeat 3 --no-memory
+
+OPS = ("load", "load_file", "loads", "dump", "dumps")
+FORMATS = {"xml":plist.FMT_XML, "binary":plist.FMT_BINARY}
+DEFAULT_MIX = "string=5,int=3,float=1,bool=1,date=1,data=1"
+BINARY_ONLY = ("keyed_archive",)
+CORPORA = ("synthetic", "wide", "deep", "kext_info", "manifest", "keyed_archive")
+
+###               ###
+# Corpus Generation #
+###               ###
+
+def parse_mix(mix):
+    # "string=5,int=3" -> [("string",5),("int",3)]
+    weights = []
+    for item in mix.split(","):
+        name, _, weight = item.partition("=")
+        name = name.strip().lower()
+        if not name in _SCALARS:
+            raise ValueError("Unknown type in mix: {}".format(name))
+        weights.append((name, float(weight or 1)))
+    return weights
+
+def _random_string(r):
+    return "".join(r.choice("abcdefghijklmnopqrstuvwxyz0123456789 _-.") for _ in range(r.randint(4, 40)))
+
+_SCALARS = {
+    "string": _random_string,
+    "int": lambda r: r.randint(-2**40, 2**40),
+    "float": lambda r: r.uniform(-1e6, 1e6),
+    "bool": lambda r: r.random() < 0.5,
+    "date": lambda r: datetime.datetime(2001, 1, 1) + datetime.timedelta(seconds=r.randint(0, 2**30)),
+    "data": lambda r: plist.wrap_data(bytes(bytearray(r.getrandbits(8) for _ in range(r.randint(8, 256))))),
+}
+
+def generate(size = 10000, depth = 4, mix = DEFAULT_MIX, fanout = 8, seed = 0):
+    # Builds a tree of dicts and arrays holding roughly size scalars, nested no
+    # deeper than depth, with scalar types picked by the mix weights
+    r = random.Random(seed)
+    weights = parse_mix(mix)
+    total = sum(x[1] for x in weights)
+    def scalar():
+        pick = r.random() * total
+        for name, weight in weights:
+            pick -= weight
+            if pick < 0: break
+        return _SCALARS[name](r)
+    root = {}
+    # Explicit stack of (container, level, scalars left for it)
+    stack = [(root, 1, size)]
+    while stack:
+        container, level, left = stack.pop()
+        children = 1 if level >= depth else min(fanout, max(1, left // fanout))
+        share = max(1, left // (children + 1))
+        for i in range(children):
+            if level < depth and left > share:
+                child = {} if r.random() < 0.6 else []
+                stack.append((child, level + 1, share))
+                left -= share
+                _add(container, "node{}".format(i), child)
+        for i in range(left):
+            _add(container, "key{}".format(i), scalar())
+    return root
+
+def _add(container, key, value):
+    if isinstance(container, dict):
+        container[key] = value
+    else:
+        container.append(value)
+
+def wide(size = 10000, seed = 0):
+    # Everything at the top - one long array and one dict with a key per value
+    r = random.Random(seed)
+    return {
+        "array": [r.randint(-2**40, 2**40) for _ in range(size // 2)],
+        "dict": dict(("key{}".format(i), _random_string(r)) for i in range(size // 2)),
+    }
+
+def deep(levels = 200):
+    # A single chain levels deep - alternating arrays and dicts, a string at the bottom
+    root = value = []
+    for level in range(1, levels):
+        child = {} if level % 2 else []
+        _add(value, "child", child)
+        value = child
+    _add(value, "leaf", "bottom")
+    return root
+
+def kext_info(personalities = 200, seed = 0):
+    # Shaped like a kext's Contents/Info.plist - lots of near-identical IOKitPersonalities
+    r = random.Random(seed)
+    info = {
+        "BuildMachineOSBuild": "17G65",
+        "CFBundleDevelopmentRegion": "English",
+        "CFBundleExecutable": "NVDAStartupWeb",
+        "CFBundleGetInfoString": "NVDAStartupWeb 387.10.10.10.40.105 (Web)",
+        "CFBundleIdentifier": "com.nvidia.NVDAStartupWeb",
+        "CFBundleInfoDictionaryVersion": "6.0",
+        "CFBundlePackageType": "KEXT",
+        "CFBundleVersion": "387.10.10.10.40.105",
+        "IOKitPersonalities": {
+            "NVDAStartup": {
+                "CFBundleIdentifier": "com.nvidia.NVDAStartupWeb",
+                "IOClass": "NVDAStartup",
+                "IOMatchCategory": "IOFramebuffer",
+                "IOPCIClassMatch": "0x03000000&0xff000000",
+                "IOProviderClass": "IOPCIDevice",
+                "NVDARequiredOS": "17G65",
+            },
+        },
+        "OSBundleLibraries": {
+            "com.apple.iokit.IOPCIFamily": "2.0",
+            "com.apple.kpi.bsd": "8.0.0",
+            "com.apple.kpi.iokit": "8.0.0",
+            "com.apple.kpi.libkern": "8.0.0",
+        },
+    }
+    for i in range(personalities):
+        info["IOKitPersonalities"]["NVDAGK100HAL{}".format(i)] = {
+            "CFBundleIdentifier": "com.nvidia.web.NVDAGK100HalWeb",
+            "IOClass": "NVDAGK100HAL",
+            "IOMatchCategory": "NVDAGK100HAL",
+            "IONameMatch": ["display", "NVDA,Display-{}".format(chr(65 + i % 26))],
+            "IOPCIPrimaryMatch": "0x{:08x}&0xffe0ffff".format(r.getrandbits(32)),
+            "IOProbeScore": r.randint(0, 300000),
+            "IOProviderClass": "IOPCIDevice",
+            "NVDAType": "Web",
+            "NVDAMemoryLimit": r.randint(0, 2**32),
+            "NVDAEnabled": r.random() < 0.5,
+        }
+    return info
+
+def nvidia_manifest(updates = 300, seed = 0):
+    # Shaped like the NVIDIA web driver manifest - a flat "updates" list of small dicts
+    r = random.Random(seed)
+    entries = []
+    for i in range(updates):
+        build = "{}{}{}".format(r.randint(13, 17), chr(65 + r.randint(0, 7)), r.randint(1, 9999))
+        version = "{}.10.10.{}.{}".format(r.choice((346, 355, 367, 378, 387)), r.randint(10, 40), r.randint(100, 200))
+        entries.append({
+            "OS": build,
+            "version": version,
+            "downloadURL": "https://images.nvidia.com/mac/pkg/{0}/WebDriver-{0}.pkg".format(version),
+            "checksum": "".join(r.choice("0123456789abcdef") for _ in range(64)),
+            "size": r.randint(50000000, 70000000),
+        })
+    return {"updates": entries}
+
+def keyed_archive(records = 1000, seed = 0):
+    # Shaped like an NSKeyedArchiver archive - one flat $objects list, with every
+    # reference (classes, keys, values, members) a UID into it
+    r = random.Random(seed)
+    objects = ["$null"]
+    def add(obj):
+        objects.append(obj)
+        return plist.UID(len(objects) - 1)
+    dict_class = add({"$classname": "NSDictionary", "$classes": ["NSDictionary", "NSObject"]})
+    array_class = add({"$classname": "NSArray", "$classes": ["NSArray", "NSObject"]})
+    keys = [add("key{}".format(i)) for i in range(8)]
+    members = []
+    for i in range(records):
+        values = [add(_random_string(r)) if r.random() < 0.5 else r.randint(0, 2**31) for _ in keys]
+        members.append(add({"NS.keys": list(keys), "NS.objects": values, "$class": dict_class}))
+    root = add({"NS.objects": members, "$class": array_class})
+    return {"$archiver": "NSKeyedArchiver", "$version": 100000, "$top": {"root": root}, "$objects": objects}
+
+def corpus(size = 10000, depth = 4, mix = DEFAULT_MIX, seed = 0, deep_levels = 200, names = CORPORA):
+    # name -> plist value - only the entries in names get built
+    builders = {
+        "synthetic": lambda: generate(size, depth, mix, seed=seed),
+        "wide": lambda: wide(size, seed=seed),
+        "deep": lambda: deep(deep_levels),
+        "kext_info": lambda: kext_info(max(1, size // 50), seed=seed),
+        "manifest": lambda: nvidia_manifest(max(1, size // 5), seed=seed),
+        "keyed_archive": lambda: keyed_archive(max(1, size // 10), seed=seed),
+    }
+    return dict((name, builders[name]()) for name in names)
+
+def formats_for(name, formats):
+    return [x for x in sorted(formats) if x == "binary" or not name in BINARY_ONLY]
+
+def write_corpus(folder, values):
+    # Dumps every corpus entry to folder in both formats - handy for profiling by hand
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    for name, value in values.items():
+        for fmt_name in formats_for(name, FORMATS):
+            with open(os.path.join(folder, "{}.{}.plist".format(name, fmt_name)), "wb") as f:
+                plist.dump(value, f, fmt=FORMATS[fmt_name])
+
+###         ###
+# Correctness #
+###         ###
+
+def same(a, b):
+    # == for plist values without recursing - deep documents would blow the limit
+    stack = [(a, b)]
+    while stack:
+        a, b = stack.pop()
+        if isinstance(a, dict):
+            if not isinstance(b, dict) or set(a) != set(b):
+                return False
+            stack.extend((a[k], b[k]) for k in a)
+        elif isinstance(a, (list, tuple)):
+            if not isinstance(b, (list, tuple)) or len(a) != len(b):
+                return False
+            stack.extend(zip(a, b))
+        elif isinstance(a, bool) != isinstance(b, bool) or a != b:
+            return False
+    return True
+
+def check_round_trip(values, formats):
+    # Returns the corpus/format pairs that don't come back from dumps -> loads intact
+    failed = []
+    for name in sorted(values):
+        for fmt_name in formats_for(name, formats):
+            try:
+                ok = same(values[name], plist.loads(plist.dumps(values[name], fmt=FORMATS[fmt_name])))
+            except Exception:
+                ok = False
+            if not ok:
+                failed.append("{}/{}".format(name, fmt_name))
+    return failed
+
+def check_deep(levels):
+    # A levels-deep chain through the binary writer and reader - returns True if it
+    # came back intact, printing the time per level either way
+    value = deep(levels)
+    start = time.time()
+    data = plist.dumps(value, fmt=plist.FMT_BINARY)
+    dumped = time.time() - start
+    start = time.time()
+    back = plist.loads(data)
+    loaded = time.time() - start
+    ok = same(value, back)
+    print("deep/binary {} levels: dumps {:.2f} us/level, loads {:.2f} us/level - {}".format(
+        levels, dumped / levels * 1000000, loaded / levels * 1000000, "round trip OK" if ok else "round trip FAILED"))
+    if hasattr(plistlib, "dumps"):
+        # Just for reference - the stdlib recurses per level
+        outcome = []
+        for name, func in (("dumps", lambda: plistlib.dumps(value, fmt=plistlib.FMT_BINARY)), ("loads", lambda: plistlib.loads(data))):
+            try:
+                func()
+                outcome.append("{} OK".format(name))
+            except Exception as e:
+                outcome.append("{} {}".format(name, type(e).__name__))
+        print("deep/binary {} levels: plistlib {}".format(levels, ", ".join(outcome)))
+    return ok
+
+###          ###
+# Benchmarking #
+###          ###
+
+def _stdlib_ops(fmt):
+    # The stdlib equivalents - or None where this Python's plistlib can't do fmt
+    if hasattr(plistlib, "loads"):
+        std_fmt = plistlib.FMT_BINARY if fmt == plist.FMT_BINARY else plistlib.FMT_XML
+        return {
+            "load": lambda data: plistlib.load(BytesIO(data)),
+            "load_file": lambda path: _load_path(plistlib.load, path),
+            "loads": lambda data: plistlib.loads(data),
+            "dump": lambda value: plistlib.dump(value, BytesIO(), fmt=std_fmt),
+            "dumps": lambda value: plistlib.dumps(value, fmt=std_fmt),
+        }
+    if fmt == plist.FMT_BINARY:
+        return None # Python 2's plistlib only knows XML
+    return {
+        "load": lambda data: plistlib.readPlist(BytesIO(data)),
+        "load_file": lambda path: _load_path(plistlib.readPlist, path),
+        "loads": lambda data: plistlib.readPlistFromString(data),
+        "dump": lambda value: plistlib.writePlist(value, BytesIO()),
+        "dumps": lambda value: plistlib.writePlistToString(value),
+    }
+
+def _load_path(load, path, **kwargs):
+    with open(path, "rb") as f:
+        return load(f, **kwargs)
+
+def _plist_ops(fmt):
+    return {
+        "load": lambda data: plist.load(BytesIO(data)),
+        "load_file": lambda path: _load_path(plist.load, path),
+        "loads": lambda data: plist.loads(data),
+        "dump": lambda value: plist.dump(value, BytesIO(), fmt=fmt),
+        "dumps": lambda value: plist.dumps(value, fmt=fmt),
+    }
+
+def _compact_ops(fmt):
+    # Loads only - the preset doesn't change what gets written
+    return {
+        "load": lambda data: plist.load(BytesIO(data), **plist.COMPACT),
+        "load_file": lambda path: _load_path(plist.load, path, **plist.COMPACT),
+        "loads": lambda data: plist.loads(data, **plist.COMPACT),
+    }
+
+def _zero_copy_ops(fmt):
+    # Binary loads only - the XML reader has nothing to hand out views of
+    if fmt != plist.FMT_BINARY:
+        return {}
+    return {
+        "load": lambda data: plist.load(BytesIO(data), zero_copy=True),
+        "load_file": lambda path: _load_path(plist.load, path, zero_copy=True),
+        "loads": lambda data: plist.loads(data, zero_copy=True),
+    }
+
+def _measure(func, arg, repeat, memory):
+    # Best-of-repeat wall time, plus the peak traced allocation of one extra run
+    best = None
+    gc.collect()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = time.time()
+            func(arg)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+    finally:
+        gc.enable()
+    peak = None
+    if memory and tracemalloc:
+        tracemalloc.start()
+        try:
+            func(arg)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return best, peak
+
+def run(values, repeat = 5, memory = True, libs = ("plist", "compact", "zero_copy", "plistlib"), ops = OPS, formats = FORMATS, progress = True):
+    # Returns a list of result dicts - one per corpus entry/format/op/library
+    results = []
+    handle, path = tempfile.mkstemp(suffix=".plist")
+    os.close(handle)
+    try:
+        for name in sorted(values):
+            for fmt_name in formats_for(name, formats):
+                results.extend(_run_one(name, values[name], fmt_name, path, repeat, memory, libs, ops, progress))
+    finally:
+        os.remove(path)
+    return results
+
+def _run_one(name, value, fmt_name, path, repeat, memory, libs, ops, progress):
+    # Times one corpus entry in one format - path is where load_file reads it from
+    results = []
+    fmt = FORMATS[fmt_name]
+    out = BytesIO()
+    plist.dump(value, out, fmt=fmt)
+    data = out.getvalue()
+    with open(path, "wb") as f:
+        f.write(data)
+    impls = {"plist":_plist_ops(fmt), "compact":_compact_ops(fmt), "zero_copy":_zero_copy_ops(fmt), "plistlib":_stdlib_ops(fmt)}
+    for op in ops:
+        for lib in libs:
+            if impls[lib] is not None and not op in impls[lib]:
+                continue
+            result = {"corpus":name, "format":fmt_name, "op":op, "lib":lib, "bytes":len(data)}
+            if impls[lib] is None:
+                result["error"] = "unsupported"
+            else:
+                arg = path if op == "load_file" else data if op.startswith("load") else value
+                try:
+                    seconds, peak = _measure(impls[lib][op], arg, repeat, memory)
+                    result.update({
+                        "seconds": seconds,
+                        "mb_per_sec": len(data) / 1048576.0 / seconds if seconds else None,
+                        "peak_bytes": peak,
+                    })
+                except Exception as e:
+                    result["error"] = "{}: {}".format(type(e).__name__, e)
+            results.append(result)
+            if progress: print(format_result(result))
+    return results
+
+def _key(result):
+    return "{corpus}/{format}/{op}/{lib}".format(**result)
+
+def format_result(result):
+    if "error" in result:
+        return "{:<40} {}".format(_key(result), result["error"])
+    peak = "" if result.get("peak_bytes") is None else "{:>10.1f} KiB peak".format(result["peak_bytes"] / 1024.0)
+    return "{:<40} {:>10.2f} ms {:>9.2f} MB/s {}".format(_key(result), result["seconds"] * 1000, result["mb_per_sec"] or 0, peak)
+
+###       ###
+# Baselines #
+###       ###
+
+def save_baseline(path, results, settings):
+    baseline = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "created": datetime.datetime.now().isoformat(),
+        "settings": settings,
+        "results": results,
+    }
+    with open(path, "w") as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+
+def compare(baseline, results, threshold = 0.15):
+    # Returns (key, old seconds, new seconds, ratio) for everything that got more
+    # than threshold slower than the baseline
+    old = dict((_key(x), x) for x in baseline.get("results", []) if "seconds" in x)
+    regressions = []
+    for result in results:
+        before = old.get(_key(result))
+        if not before or not "seconds" in result or not before["seconds"]:
+            continue
+        ratio = result["seconds"] / before["seconds"]
+        if ratio > 1 + threshold:
+            regressions.append((_key(result), before["seconds"], result["seconds"], ratio))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark plist.py against the stdlib plistlib.")
+    parser.add_argument("-s", "--size", type=int, default=10000, help="roughly how many scalars in the synthetic corpus (default 10000)")
+    parser.add_argument("-d", "--depth", type=int, default=4, help="max nesting depth of the synthetic corpus (default 4)")
+    parser.add_argument("-m", "--mix", default=DEFAULT_MIX, help="scalar type weights (default {})".format(DEFAULT_MIX))
+    parser.add_argument("-c", "--corpora", default=",".join(CORPORA), help="comma separated corpus entries (default all)")
+    parser.add_argument("--deep-levels", type=int, default=200, help="nesting of the deep corpus entry - kept within plistlib's reach (default 200)")
+    parser.add_argument("--deep-check", type=int, default=100000, help="levels for the binary deep nesting check - 0 skips it (default 100000)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the corpus (default 0)")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="runs per measurement - the best is kept (default 5)")
+    parser.add_argument("-o", "--ops", default=",".join(OPS), help="comma separated ops to time (default all)")
+    parser.add_argument("-f", "--formats", default=",".join(sorted(FORMATS)), help="comma separated formats (default all)")
+    parser.add_argument("--plist-only", action="store_true", help="skip the stdlib plistlib timings")
+    parser.add_argument("--no-memory", action="store_true", help="skip the peak memory measurement")
+    parser.add_argument("--write-corpus", help="also dump the corpus into this folder")
+    parser.add_argument("--save", help="save the results as a JSON baseline")
+    parser.add_argument("--compare", help="compare against this JSON baseline and exit 1 on a regression")
+    parser.add_argument("-t", "--threshold", type=float, default=0.15, help="slowdown that counts as a regression (default 0.15 - i.e. 15%%)")
+    args = parser.parse_args()
+    ops = [x.strip() for x in args.ops.split(",") if x.strip()]
+    formats = [x.strip() for x in args.formats.split(",") if x.strip()]
+    corpora = [x.strip() for x in args.corpora.split(",") if x.strip()]
+    for x in ops:
+        if not x in OPS: parser.error("unknown op: {}".format(x))
+    for x in formats:
+        if not x in FORMATS: parser.error("unknown format: {}".format(x))
+    for x in corpora:
+        if not x in CORPORA: parser.error("unknown corpus entry: {}".format(x))
+    try:
+        values = corpus(args.size, args.depth, args.mix, args.seed, args.deep_levels, corpora)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.write_corpus:
+        write_corpus(args.write_corpus, values)
+    print("Python {} - plist.py vs plistlib\n".format(platform.python_version()))
+    failed = check_round_trip(values, formats)
+    if failed:
+        print("Round trip FAILED for: {}".format(", ".join(failed)))
+        return 1
+    print("Round trip OK for every corpus entry")
+    if args.deep_check > 0 and not check_deep(args.deep_check):
+        return 1
+    print("")
+    libs = ("plist", "compact", "zero_copy") if args.plist_only else ("plist", "compact", "zero_copy", "plistlib")
+    results = run(values, args.repeat, not args.no_memory, libs, ops, formats)
+    settings = {"size":args.size, "depth":args.depth, "mix":args.mix, "seed":args.seed, "repeat":args.repeat, "deep_levels":args.deep_levels}
+    if args.save:
+        save_baseline(args.save, results, settings)
+        print("\nSaved baseline to {}".format(args.save))
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get("settings") != settings:
+            print("\nWarning: baseline was recorded with different settings: {}".format(baseline.get("settings")))
+        regressions = compare(baseline, results, args.threshold)
+        if not regressions:
+            print("\nNo regressions past {:.0f}% against {}".format(args.threshold * 100, args.compare))
+            return 0
+        print("\nRegressions past {:.0f}% against {}:".format(args.threshold * 100, args.compare))
+        for key, before, after, ratio in regressions:
+            print("  {:<40} {:>10.2f} ms -> {:>10.2f} ms ({:.0f}% slower)".format(key, before * 1000, after * 1000, (ratio - 1) * 100))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
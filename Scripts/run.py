@@ -1,151 +1,455 @@
-import sys, subprocess, time, threading, shlex
-try:
-    from Queue import Queue, Empty
-except:
-    from queue import Queue, Empty
-
-ON_POSIX = 'posix' in sys.builtin_module_names
-
-class Run:
-
-    def __init__(self):
-        return
-
-    def _read_output(self, pipe, q):
-        try:
-            for line in iter(lambda: pipe.read(1), b''):
-                q.put(line)
-        except ValueError:
-            pass
-        pipe.close()
-
-    def _create_thread(self, output):
-        # Creates a new queue and thread object to watch based on the output pipe sent
-        q = Queue()
-        t = threading.Thread(target=self._read_output, args=(output, q))
-        t.daemon = True
-        return (q,t)
-
-    def _stream_output(self, comm, shell = False):
-        output = error = ""
-        p = None
-        try:
-            if shell and type(comm) is list:
-                comm = " ".join(shlex.quote(x) for x in comm)
-            if not shell and type(comm) is str:
-                comm = shlex.split(comm)
-            p = subprocess.Popen(comm, shell=shell, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=0, universal_newlines=True, close_fds=ON_POSIX)
-            # Setup the stdout thread/queue
-            q,t   = self._create_thread(p.stdout)
-            qe,te = self._create_thread(p.stderr)
-            # Start both threads
-            t.start()
-            te.start()
-
-            while True:
-                c = z = ""
-                try: c = q.get_nowait()
-                except Empty: pass
-                else:
-                    sys.stdout.write(c)
-                    output += c
-                    sys.stdout.flush()
-                try: z = qe.get_nowait()
-                except Empty: pass
-                else:
-                    sys.stderr.write(z)
-                    error += z
-                    sys.stderr.flush()
-                if not c==z=="": continue # Keep going until empty
-                # No output - see if still running
-                p.poll()
-                if p.returncode != None:
-                    # Subprocess ended
-                    break
-                # No output, but subprocess still running - stall for 20ms
-                time.sleep(0.02)
-
-            o, e = p.communicate()
-            return (output+o, error+e, p.returncode)
-        except:
-            if p:
-                try: o, e = p.communicate()
-                except: o = e = ""
-                return (output+o, error+e, p.returncode)
-            return ("", "Command not found!", 1)
-
-    def _decode(self, value, encoding="utf-8", errors="ignore"):
-        # Helper method to only decode if bytes type
-        if sys.version_info >= (3,0) and isinstance(value, bytes):
-            return value.decode(encoding,errors)
-        return value
-
-    def _run_command(self, comm, shell = False):
-        c = None
-        try:
-            if shell and type(comm) is list:
-                comm = " ".join(shlex.quote(x) for x in comm)
-            if not shell and type(comm) is str:
-                comm = shlex.split(comm)
-            p = subprocess.Popen(comm, shell=shell, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            c = p.communicate()
-        except:
-            if c == None:
-                return ("", "Command not found!", 1)
-        return (self._decode(c[0]), self._decode(c[1]), p.returncode)
-
-    def run(self, command_list, leave_on_fail = False):
-        # Command list should be an array of dicts
-        if type(command_list) is dict:
-            # We only have one command
-            command_list = [command_list]
-        output_list = []
-        for comm in command_list:
-            args   = comm.get("args",   [])
-            shell  = comm.get("shell",  False)
-            stream = comm.get("stream", False)
-            sudo   = comm.get("sudo",   False)
-            stdout = comm.get("stdout", False)
-            stderr = comm.get("stderr", False)
-            mess   = comm.get("message", None)
-            show   = comm.get("show",   False)
-            
-            if not mess == None:
-                print(mess)
-
-            if not len(args):
-                # nothing to process
-                continue
-            if sudo:
-                # Check if we have sudo
-                out = self._run_command(["which", "sudo"])
-                if "sudo" in out[0]:
-                    # Can sudo
-                    if type(args) is list:
-                        args.insert(0, out[0].replace("\n", "")) # add to start of list
-                    elif type(args) is str:
-                        args = out[0].replace("\n", "") + " " + args # add to start of string
-            
-            if show:
-                print(" ".join(args))
-
-            if stream:
-                # Stream it!
-                out = self._stream_output(args, shell)
-            else:
-                # Just run and gather output
-                out = self._run_command(args, shell)
-                if stdout and len(out[0]):
-                    print(out[0])
-                if stderr and len(out[1]):
-                    print(out[1])
-            # Append output
-            output_list.append(out)
-            # Check for errors
-            if leave_on_fail and out[2] != 0:
-                # Got an error - leave
-                break
-        if len(output_list) == 1:
-            # We only ran one command - just return that output
-            return output_list[0]
-        return output_list
+import sys, os, subprocess, threading, shlex, select, signal, time, elevated, fileops
+try:
+    from Queue import Queue
+except:
+    from queue import Queue
+try:
+    import selectors
+except ImportError:
+    selectors = None # Python 2 - fall back on select.select()
+
+ON_POSIX = 'posix' in sys.builtin_module_names
+CHUNK = 65536
+KILL_GRACE = 5 # Seconds between SIGTERM and SIGKILL when a command times out
+
+class Result(tuple):
+    # The usual (stdout, stderr, returncode) tuple - so existing callers don't notice -
+    # with what we measured while running it hung off the side:
+    #
+    # wall      - seconds from spawn to exit
+    # utime     - user CPU seconds (the command and anything it waited on)
+    # stime     - system CPU seconds
+    # maxrss    - peak resident set size in bytes
+    # timed_out - True if we killed it for running past its timeout
+    #
+    # Anything we couldn't measure (in-process operations, no os.wait4) is None.
+
+    def __new__(cls, stdout, stderr, returncode, wall = None, utime = None, stime = None, maxrss = None, timed_out = False):
+        self = tuple.__new__(cls, (stdout, stderr, returncode))
+        self.wall = wall
+        self.utime = utime
+        self.stime = stime
+        self.maxrss = maxrss
+        self.timed_out = timed_out
+        return self
+
+    stdout     = property(lambda self: self[0])
+    stderr     = property(lambda self: self[1])
+    returncode = property(lambda self: self[2])
+
+    def stats(self):
+        return {"wall":self.wall, "utime":self.utime, "stime":self.stime, "maxrss":self.maxrss, "timed_out":self.timed_out}
+
+class Run:
+
+    def __init__(self, sudo = None, elevated_worker = False, stdin = None):
+        # sudo is the path to sudo (or a stand-in) - found with "which sudo" the first
+        # time we need it if not given.  With elevated_worker, non-streamed sudo
+        # commands go to one long-lived privileged child instead of a sudo apiece.
+        # stdin is handed to every command we spawn - None shares ours.
+        self._sudo = sudo
+        self.stdin = stdin
+        self._sudo_lock = threading.Lock()
+        self.elevated_worker = elevated_worker
+        # Only started on the first privileged request - and only if asked for, as
+        # nothing shuts it down but close()
+        self.worker = elevated.ElevatedWorker(self._sudo_path) if elevated_worker else None
+        # cp/mv/rm/mkdir/chown/chmod are done in-process - set to None to always spawn
+        self.files = fileops.FileOps(worker=self.worker)
+
+    def _read_output(self, pipe, q):
+        # Thread side of the non-POSIX fallback - hands over whole chunks, then None at EOF
+        fd = pipe.fileno()
+        try:
+            for chunk in iter(lambda: os.read(fd, CHUNK), b''):
+                q.put((pipe, chunk))
+        except (OSError, ValueError):
+            pass
+        q.put((pipe, None))
+
+    def _tee(self, stream, data):
+        # Echoes raw bytes to the terminal - text-only streams get them decoded
+        buf = getattr(stream, "buffer", None)
+        if buf is None:
+            stream.write(self._decode(data))
+        else:
+            stream.flush() # Keep ordering with anything already written as text
+            buf.write(data)
+        stream.flush()
+
+    def _pump_select(self, p, sinks, stats):
+        # Waits on both pipes at once and reads whatever is ready in CHUNK sized
+        # pieces.  The timeout only matters if the child exits while something it
+        # spawned still holds the pipes open - we don't wait around for those.
+        fds = dict((pipe.fileno(), pipe) for pipe in sinks)
+        selector = None
+        if selectors:
+            selector = selectors.DefaultSelector()
+            for fd in fds:
+                selector.register(fd, selectors.EVENT_READ)
+        try:
+            exited = False
+            while fds:
+                if selector:
+                    ready = [key.fd for key, _ in selector.select(0 if exited else 0.5)]
+                else:
+                    ready = select.select(list(fds), [], [], 0 if exited else 0.5)[0]
+                if not ready:
+                    if exited: break
+                    exited = self._reap(p, stats)
+                    continue
+                for fd in ready:
+                    data = os.read(fd, CHUNK)
+                    if not data:
+                        if selector: selector.unregister(fd)
+                        del fds[fd]
+                        continue
+                    chunks, stream = sinks[fds[fd]]
+                    chunks.append(data)
+                    if stream: self._tee(stream, data)
+        finally:
+            if selector: selector.close()
+
+    def _pump_threads(self, p, sinks, stats):
+        # Windows can't select() on pipes - one reader thread per pipe feeding a queue
+        q = Queue()
+        for pipe in sinks:
+            t = threading.Thread(target=self._read_output, args=(pipe, q))
+            t.daemon = True
+            t.start()
+        left = len(sinks)
+        while left:
+            pipe, data = q.get()
+            if data is None:
+                left -= 1
+                continue
+            chunks, stream = sinks[pipe]
+            chunks.append(data)
+            if stream: self._tee(stream, data)
+
+    def _reap(self, p, stats, block = False):
+        # Collects p's exit status if it's done (waiting for it with block) - through
+        # os.wait4 where we have it so stats picks up its CPU time and peak RSS.
+        # Returns True once it's gone.
+        if p.returncode is not None:
+            return True
+        if not hasattr(os, "wait4"):
+            if block: p.wait()
+            else: p.poll()
+            return p.returncode is not None
+        try:
+            pid, status, usage = os.wait4(p.pid, 0 if block else os.WNOHANG)
+        except OSError:
+            # Someone else reaped it
+            p.poll()
+            if p.returncode is None: p.returncode = 1
+            return True
+        if pid == 0:
+            return False
+        p.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        stats["utime"] = usage.ru_utime
+        stats["stime"] = usage.ru_stime
+        # Linux counts KiB, macOS counts bytes
+        stats["maxrss"] = usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+        return True
+
+    def _kill(self, p, force = False):
+        # Signals p's whole process group where we gave it one - falling back on p alone
+        if not ON_POSIX:
+            try: p.kill()
+            except OSError: pass
+            return
+        sig = signal.SIGKILL if force else signal.SIGTERM
+        try:
+            os.killpg(p.pid, sig)
+        except OSError:
+            try: p.send_signal(sig)
+            except OSError: pass
+
+    def _start_timer(self, p, timeout, stats):
+        # SIGTERMs p's process group once timeout runs out, then SIGKILLs it if it's
+        # still around KILL_GRACE seconds later.  Returns the timers to cancel.
+        timers = []
+        def expire(force):
+            if p.returncode is not None: return
+            stats["timed_out"] = True
+            self._kill(p, force)
+            if not force:
+                t = threading.Timer(KILL_GRACE, expire, [True])
+                t.daemon = True
+                timers.append(t)
+                t.start()
+        t = threading.Timer(timeout, expire, [False])
+        t.daemon = True
+        timers.append(t)
+        t.start()
+        return timers
+
+    def _popen(self, comm, shell, timeout):
+        if shell and type(comm) is list:
+            comm = " ".join(shlex.quote(x) for x in comm)
+        if not shell and type(comm) is str:
+            comm = shlex.split(comm)
+        kwargs = {}
+        if timeout and ON_POSIX:
+            # Own process group so a timeout takes out everything it started - note
+            # that leaves it unable to prompt on the terminal (e.g. for a sudo password)
+            kwargs["preexec_fn"] = os.setpgrp
+        return subprocess.Popen(comm, shell=shell, stdin=self.stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=0, close_fds=ON_POSIX, **kwargs)
+
+    def _text(self, chunks, newlines = False):
+        # Joins the collected chunks - newlines gives the same line endings
+        # universal_newlines would
+        text = self._decode(b"".join(chunks))
+        return text.replace("\r\n", "\n").replace("\r", "\n") if newlines else text
+
+    def _execute(self, comm, shell, timeout, tee):
+        # Spawns comm, gathers both pipes (echoing them to the terminal with tee) and
+        # reaps it - killing it if it runs past timeout - then returns a Result
+        output = []
+        error  = []
+        stats  = {}
+        p = None
+        timers = []
+        start = time.time()
+        try:
+            p = self._popen(comm, shell, timeout)
+            if timeout:
+                timers = self._start_timer(p, timeout, stats)
+            sinks = {p.stdout:(output, sys.stdout if tee else None), p.stderr:(error, sys.stderr if tee else None)}
+            if ON_POSIX:
+                self._pump_select(p, sinks, stats)
+            else:
+                self._pump_threads(p, sinks, stats)
+            self._reap(p, stats, True)
+        except:
+            if not p:
+                return Result("", "Command not found!", 1)
+            try: self._reap(p, stats, True)
+            except: pass
+        finally:
+            for t in timers:
+                t.cancel()
+            if p:
+                for pipe in (p.stdout, p.stderr):
+                    try: pipe.close()
+                    except: pass
+        err = self._text(error, tee)
+        if stats.get("timed_out"):
+            err += "Timed out after {}s\n".format(timeout)
+        return Result(self._text(output, tee), err, p.returncode, wall=time.time()-start, **stats)
+
+    def _stream_output(self, comm, shell = False, timeout = None):
+        return self._execute(comm, shell, timeout, True)
+
+    def _decode(self, value, encoding="utf-8", errors="ignore"):
+        # Helper method to only decode if bytes type
+        if sys.version_info >= (3,0) and isinstance(value, bytes):
+            return value.decode(encoding,errors)
+        return value
+
+    def _run_command(self, comm, shell = False, timeout = None):
+        return self._execute(comm, shell, timeout, False)
+
+    def _sudo_path(self):
+        # Returns the path to sudo - or None if we don't have it.  Only looked up once.
+        with self._sudo_lock:
+            if self._sudo is None:
+                out = self._run_command(["which", "sudo"])
+                self._sudo = out[0].replace("\n", "") if "sudo" in out[0] else ""
+        return self._sudo or None
+
+    def close(self):
+        # Lets the elevated worker (if we started one) exit
+        if self.worker:
+            self.worker.close()
+
+    def _run_one(self, comm):
+        # Runs a single command dict - returns its Result, or None if it had no args
+        args   = comm.get("args",   [])
+        shell  = comm.get("shell",  False)
+        stream = comm.get("stream", False)
+        sudo   = comm.get("sudo",   False)
+        stdout = comm.get("stdout", False)
+        stderr = comm.get("stderr", False)
+        mess   = comm.get("message", None)
+        show   = comm.get("show",   False)
+        timeout = comm.get("timeout", None)
+        
+        if not mess == None:
+            print(mess)
+
+        if not len(args):
+            # nothing to process
+            return None
+        start = time.time()
+        out = None
+        if self.files and not shell and not stream:
+            # Plain file operations skip the spawn entirely
+            out = self.files.run(args, sudo)
+        if out is None and sudo and self.worker and not stream:
+            out = self.worker.request("run", args, shell=shell, timeout=timeout)
+        if out is None and sudo:
+            # Check if we have sudo
+            sudo_path = self._sudo_path()
+            if sudo_path:
+                # Can sudo
+                if type(args) is list:
+                    args.insert(0, sudo_path) # add to start of list
+                elif type(args) is str:
+                    args = sudo_path + " " + args # add to start of string
+        
+        if show:
+            print(" ".join(args))
+
+        if out is not None:
+            if stdout and len(out[0]):
+                print(out[0])
+            if stderr and len(out[1]):
+                print(out[1])
+        elif stream:
+            # Stream it!
+            out = self._stream_output(args, shell, timeout)
+        else:
+            # Just run and gather output
+            out = self._run_command(args, shell, timeout)
+            if stdout and len(out[0]):
+                print(out[0])
+            if stderr and len(out[1]):
+                print(out[1])
+        if not isinstance(out, Result):
+            # In-process, or from the elevated worker (which sends its stats along)
+            stats = out[3] if len(out) > 3 else {"wall":time.time()-start}
+            out = Result(out[0], out[1], out[2], **stats)
+        return out
+
+    def _dependencies(self, command_list):
+        # Resolves each command's "after" (an id or list of ids) to indexes - commands
+        # without one wait on the command before them, just like a plain list
+        ids = {}
+        for i, comm in enumerate(command_list):
+            if "id" in comm:
+                if comm["id"] in ids:
+                    raise ValueError("Duplicate command id: {}".format(comm["id"]))
+                ids[comm["id"]] = i
+        deps = []
+        for i, comm in enumerate(command_list):
+            if not "after" in comm:
+                deps.append(set([i-1]) if i else set())
+                continue
+            after = comm["after"]
+            if after is None:
+                after = []
+            elif not isinstance(after, (list, tuple)):
+                after = [after]
+            try:
+                deps.append(set(ids[x] for x in after))
+            except KeyError as e:
+                raise ValueError("Unknown command id in after: {}".format(e.args[0]))
+        # Make sure it's all runnable (Kahn's algorithm) before anything gets started
+        waiting = [len(d) for d in deps]
+        dependents = [[] for x in deps]
+        for i, d in enumerate(deps):
+            for x in d:
+                dependents[x].append(i)
+        ready = [i for i, count in enumerate(waiting) if not count]
+        seen = 0
+        while ready:
+            i = ready.pop()
+            seen += 1
+            for x in dependents[i]:
+                waiting[x] -= 1
+                if not waiting[x]:
+                    ready.append(x)
+        if seen < len(deps):
+            raise ValueError("Command dependencies form a cycle")
+        return deps
+
+    def _graph_worker(self, jobs, done):
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            index, comm = job
+            try:
+                out = self._run_one(comm)
+            except Exception as e:
+                out = Result("", str(e), 1)
+            done.put((index, out))
+
+    def _run_graph(self, command_list, leave_on_fail, workers):
+        # Runs each command as soon as everything it's after has finished, on at
+        # most workers threads.  With leave_on_fail, a failed command cancels
+        # everything that (directly or not) depends on it.
+        deps = self._dependencies(command_list)
+        dependents = [[] for x in command_list]
+        for i, d in enumerate(deps):
+            for x in d:
+                dependents[x].append(i)
+        waiting = [len(d) for d in deps]
+        outputs = [None]*len(command_list)
+        cancelled = set()
+        jobs = Queue()
+        done = Queue()
+        threads = []
+        for x in range(max(1, min(workers, len(command_list)))):
+            t = threading.Thread(target=self._graph_worker, args=(jobs, done))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        running = 0
+        try:
+            for i, count in enumerate(waiting):
+                if not count:
+                    jobs.put((i, command_list[i]))
+                    running += 1
+            while running:
+                index, out = done.get()
+                running -= 1
+                outputs[index] = out
+                if leave_on_fail and out is not None and out[2] != 0:
+                    # Cancel everything downstream of the failure
+                    stack = list(dependents[index])
+                    while stack:
+                        x = stack.pop()
+                        if x in cancelled: continue
+                        cancelled.add(x)
+                        stack.extend(dependents[x])
+                for x in dependents[index]:
+                    waiting[x] -= 1
+                    if not waiting[x] and not x in cancelled:
+                        jobs.put((x, command_list[x]))
+                        running += 1
+        finally:
+            for t in threads:
+                jobs.put(None)
+            for t in threads:
+                t.join()
+        # Same shape as the sequential path - outputs in submission order, skipping
+        # anything with no args or that was cancelled
+        return [x for x in outputs if x is not None]
+
+    def run(self, command_list, leave_on_fail = False, workers = 4):
+        # Command list should be an array of dicts
+        if type(command_list) is dict:
+            # We only have one command
+            command_list = [command_list]
+        if any("id" in x or "after" in x for x in command_list):
+            # Got a dependency graph - run what we can side by side
+            output_list = self._run_graph(command_list, leave_on_fail, workers)
+        else:
+            output_list = []
+            for comm in command_list:
+                out = self._run_one(comm)
+                if out is None:
+                    continue
+                # Append output
+                output_list.append(out)
+                # Check for errors
+                if leave_on_fail and out[2] != 0:
+                    # Got an error - leave
+                    break
+        if len(output_list) == 1:
+            # We only ran one command - just return that output
+            return output_list[0]
+        return output_list
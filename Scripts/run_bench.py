@@ -0,0 +1,215 @@
+import sys, os, time, subprocess, threading, argparse, tempfile, shutil, run
+try:
+    from Queue import Queue, Empty
+except:
+    from queue import Queue, Empty
+
+# Benchmarks run.Run:
+#
+# stream  - the streaming engine against the old byte-at-a-time one (kept below as
+#           a reference) on a local command that writes tens of MB, reporting wall
+#           time plus our own and the child's CPU time.  Terminal output is sent to
+#           os.devnull while timing so the terminal's speed doesn't skew the numbers.
+# fileops - a patch job's worth of cp/mv/rm/mkdir/chown/chmod in a temp folder, done
+#           in-process and by spawning the real commands, counting the spawns.
+# elevated - the same patch jobs run with sudo against a stub sudo that logs each
+#           call and runs the command unprivileged, counting elevations with a sudo
+#           per command and with the persistent elevated worker.
+#
+#   python run_bench.py --mb 32 --jobs 20
+#   python run_bench.py -b elevated --jobs 5
+
+def emitter(mb, line = 100):
+    # A command that writes mb MiB of lines to stdout (and a little to stderr)
+    code = (
+        "import sys\n"
+        "out = getattr(sys.stdout, 'buffer', sys.stdout)\n"
+        "line = b'x' * {0} + b'\\n'\n"
+        "for i in range({1}):\n"
+        "    out.write(line)\n"
+        "    if i % 10000 == 0: sys.stderr.write('progress {{}}\\n'.format(i)); sys.stderr.flush()\n"
+    ).format(line - 1, int(mb * 1048576 // line))
+    return [sys.executable, "-c", code]
+
+def legacy_stream_output(comm):
+    # The previous Run._stream_output - one byte per read, a queue item per byte,
+    # and a 20ms sleep whenever both queues are empty
+    def reader(pipe, q):
+        for c in iter(lambda: pipe.read(1), ''):
+            q.put(c)
+        pipe.close()
+    p = subprocess.Popen(comm, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=0, universal_newlines=True, close_fds=run.ON_POSIX)
+    q, qe = Queue(), Queue()
+    for pipe, queue in ((p.stdout, q), (p.stderr, qe)):
+        t = threading.Thread(target=reader, args=(pipe, queue))
+        t.daemon = True
+        t.start()
+    output = error = ""
+    while True:
+        c = z = ""
+        try: c = q.get_nowait()
+        except Empty: pass
+        else:
+            sys.stdout.write(c)
+            output += c
+            sys.stdout.flush()
+        try: z = qe.get_nowait()
+        except Empty: pass
+        else:
+            sys.stderr.write(z)
+            error += z
+            sys.stderr.flush()
+        if not c==z=="": continue
+        if p.poll() != None: break
+        time.sleep(0.02)
+    o, e = p.communicate()
+    return (output+o, error+e, p.returncode)
+
+def measure(func, comm):
+    # Returns (wall, our cpu, child cpu, bytes of stdout) with the terminal muted
+    devnull = open(os.devnull, "w")
+    real = (sys.stdout, sys.stderr)
+    sys.stdout = sys.stderr = devnull
+    try:
+        before = os.times()
+        start = time.time()
+        out = func(comm)
+        wall = time.time() - start
+        after = os.times()
+    finally:
+        sys.stdout, sys.stderr = real
+        devnull.close()
+    ours  = (after[0] - before[0]) + (after[1] - before[1])
+    child = (after[2] - before[2]) + (after[3] - before[3])
+    return (wall, ours, child, len(out[0]))
+
+def patch_job(folder):
+    # The file shuffling set_build/restore_backup/patch_pkg do - unprivileged, and
+    # chown'd to ourselves so it works anywhere
+    owner = "{}:{}".format(os.getuid(), os.getgid()) if hasattr(os, "getuid") else None
+    kext = os.path.join(folder, "NVDAStartupWeb.kext")
+    info = os.path.join(kext, "Contents", "Info.plist")
+    c = [
+        {"args":["mkdir", "-p", os.path.join(kext, "Contents")]},
+        {"args":["cp", __file__, info]},
+        {"args":["cp", info, info + ".bak"]},
+        {"args":["cp", info, os.path.join(folder, "Info.plist")]},
+        {"args":["mv", "-f", os.path.join(folder, "Info.plist"), info]},
+        {"args":["chmod", "755", info]},
+        {"args":["rm", info]},
+        {"args":["mv", "-f", info + ".bak", info]},
+        {"args":["chmod", "-R", "755", kext]},
+        {"args":["mkdir", os.path.join(folder, "temp")]},
+        {"args":["cp", "-R", kext, os.path.join(folder, "temp")]},
+        {"args":["rm", "-rf", os.path.join(folder, "temp")]},
+        {"args":["rm", "-rf", kext]},
+    ]
+    if owner:
+        c.insert(6, {"args":["chown", owner, info]})
+        c.insert(10, {"args":["chown", "-R", owner, kext]})
+    return c
+
+class _CountingPopen(subprocess.Popen):
+    count = 0
+    def __init__(self, *args, **kwargs):
+        _CountingPopen.count += 1
+        super(_CountingPopen, self).__init__(*args, **kwargs)
+
+def bench_fileops(jobs):
+    print("{:<12} {:>8} {:>10} {:>10} {:>10} {:>10}".format("fileops", "jobs", "wall s", "our cpu s", "child cpu", "spawns"))
+    real_popen = subprocess.Popen
+    for name, in_process in (("in-process", True), ("spawn", False)):
+        r = run.Run()
+        if not in_process:
+            r.files = None
+        folder = tempfile.mkdtemp()
+        subprocess.Popen = _CountingPopen
+        _CountingPopen.count = 0
+        try:
+            before = os.times()
+            start = time.time()
+            for x in range(jobs):
+                out = r.run(patch_job(folder), True)
+                if any(o[2] != 0 for o in out):
+                    raise RuntimeError("Patch job failed: {}".format([o for o in out if o[2] != 0]))
+            wall = time.time() - start
+            after = os.times()
+        finally:
+            subprocess.Popen = real_popen
+            shutil.rmtree(folder, ignore_errors=True)
+        ours  = (after[0] - before[0]) + (after[1] - before[1])
+        child = (after[2] - before[2]) + (after[3] - before[3])
+        print("{:<12} {:>8} {:>10.3f} {:>10.3f} {:>10.3f} {:>10}".format(name, jobs, wall, ours, child, _CountingPopen.count))
+
+def stub_sudo(folder):
+    # Returns (path to a sudo stand-in, its log) - every call appends a line to the log
+    path = os.path.join(folder, "sudo")
+    log = os.path.join(folder, "sudo.log")
+    with open(path, "w") as f:
+        f.write('#!/bin/sh\necho "$@" >> "{}"\nexec "$@"\n'.format(log))
+    os.chmod(path, 0o755)
+    return (path, log)
+
+def bench_elevated(jobs):
+    if os.name == "nt":
+        print("elevated - skipped, the stub sudo needs a POSIX shell")
+        return
+    print("{:<12} {:>8} {:>10} {:>10} {:>10}".format("elevated", "commands", "wall s", "cmd/s", "elevations"))
+    for name, worker in (("per command", False), ("worker", True)):
+        folder = tempfile.mkdtemp()
+        sudo, log = stub_sudo(folder)
+        work = os.path.join(folder, "work")
+        os.mkdir(work)
+        r = run.Run(sudo=sudo, elevated_worker=worker)
+        count = 0
+        try:
+            start = time.time()
+            for x in range(jobs):
+                # Plus one the in-process file operations can't do
+                c = patch_job(work) + [{"args":["ls", work]}]
+                for comm in c:
+                    comm["sudo"] = True
+                out = r.run(c, True)
+                if any(o[2] != 0 for o in out):
+                    raise RuntimeError("Patch job failed: {}".format([o for o in out if o[2] != 0]))
+                count += len(c)
+            wall = time.time() - start
+            elevations = 0
+            if os.path.exists(log):
+                with open(log) as f:
+                    elevations = len(f.readlines())
+        finally:
+            r.close()
+            shutil.rmtree(folder, ignore_errors=True)
+        print("{:<12} {:>8} {:>10.3f} {:>10.1f} {:>10}".format(name, count, wall, count / wall, elevations))
+
+def bench_stream(mb, legacy_mb):
+    r = run.Run()
+    engines = [("stream", mb, r._stream_output), ("communicate", mb, r._run_command)]
+    if legacy_mb:
+        engines.append(("legacy", legacy_mb, legacy_stream_output))
+    print("{:<12} {:>8} {:>10} {:>10} {:>10} {:>10}".format("engine", "MiB", "wall s", "our cpu s", "child cpu", "MiB/s"))
+    for name, size_mb, func in engines:
+        wall, ours, child, size = measure(func, emitter(size_mb))
+        print("{:<12} {:>8.1f} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.1f}".format(name, size / 1048576.0, wall, ours, child, size / 1048576.0 / wall))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark run.Run's output streaming.")
+    parser.add_argument("-m", "--mb", type=float, default=32, help="MiB the test command writes (default 32)")
+    parser.add_argument("-l", "--legacy-mb", type=float, default=2, help="MiB for the old engine, which is far slower (default 2)")
+    parser.add_argument("--no-legacy", action="store_true", help="skip the old engine")
+    parser.add_argument("-j", "--jobs", type=int, default=20, help="patch jobs for the file operation benchmark (default 20)")
+    parser.add_argument("-b", "--bench", choices=("all", "stream", "fileops", "elevated"), default="all", help="which benchmark to run (default all)")
+    args = parser.parse_args()
+    if args.bench in ("all", "stream"):
+        bench_stream(args.mb, None if args.no_legacy else args.legacy_mb)
+    if args.bench == "all": print("")
+    if args.bench in ("all", "fileops"):
+        bench_fileops(args.jobs)
+    if args.bench == "all": print("")
+    if args.bench in ("all", "elevated"):
+        bench_elevated(args.jobs)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())